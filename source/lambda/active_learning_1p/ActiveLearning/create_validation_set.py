@@ -1,14 +1,52 @@
-from ActiveLearning.s3_helper import S3Ref, copy_with_query, create_ref_at_parent_key, download_stringio
+from ActiveLearning.s3_helper import S3Ref, create_ref_at_parent_key, iter_query_lines, upload
+from idempotency import get_completed_result, get_fingerprint, mark_completed, merge_result
+from metrics import instrument_handler, timer
+from profiling import profile_handler
+from sampling import StratifiedReservoir
 
+import json
 import logging
+import random
+from collections import Counter
+from io import StringIO
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+def get_stratum(row, label_attribute_name):
+    """
+    Return the class a labeled record is balanced on: the most frequent class of its boxes,
+    None for an image without objects, or the label itself for other label types.
+    """
+    label = row.get(label_attribute_name)
+    if isinstance(label, dict) and "annotations" in label:
+        classes = Counter(int(annotation["class_id"]) for annotation in label["annotations"])
+        if not classes:
+            return None
+        return min(classes, key=lambda class_id: (-classes[class_id], class_id))
+    return json.dumps(label, sort_keys=True)
+
+
+def sample_validation_set(lines, label_attribute_name, size, seed):
+    """
+    Sample a class balanced validation set of at most size records from the labeled lines,
+    in one pass holding at most size records. Returns the lines ordered by record id.
+    """
+    reservoir = StratifiedReservoir(size, random.Random(seed))
+    for line in lines:
+        row = json.loads(line)
+        reservoir.add(get_stratum(row, label_attribute_name), (row["id"], line))
+    logger.info("Sampled {} records per class.".format(reservoir.get_counts()))
+    return [line for _, line in sorted(reservoir.items())]
+
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This method selects 10% of the input manifest as validation and creates an s3 file containing the validation objects.
+    The validation records are a class balanced sample of all human labeled records.
     """
     label_attribute_name = event['LabelAttributeName']
     meta_data = event['meta_data']
@@ -19,17 +57,31 @@ def lambda_handler(event, context):
     validation_set_size = input_total // 10
 
     source = S3Ref.from_uri(s3_input_uri)
+    fingerprint = get_fingerprint([s3_input_uri], {
+        'LabelAttributeName': label_attribute_name,
+        'validation_set_size': validation_set_size
+    })
+    completed_result = get_completed_result(s3_input_uri, "create_validation_set", fingerprint)
+    if completed_result is not None:
+        return merge_result(meta_data, completed_result)
 
-    validation_labeled_query = """select * from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes') LIMIT {}""".format(
-        label_attribute_name, validation_set_size)
+    validation_labeled_query = """select * from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes')""".format(
+        label_attribute_name)
     dest = create_ref_at_parent_key(source, "validation_input.manifest")
-    copy_with_query(source, dest, validation_labeled_query)
+    with timer("query"):
+        validation_lines = sample_validation_set(iter_query_lines(source, validation_labeled_query),
+                                                 label_attribute_name, validation_set_size, fingerprint)
+    with timer("upload"):
+        upload(StringIO("".join(line + "\n" for line in validation_lines)), dest)
     logger.info("Uploaded validation set of size {} to {}.".format(
-        validation_set_size, dest.get_uri()))
+        len(validation_lines), dest.get_uri()))
 
-    meta_data['counts']['validation'] = validation_set_size
-    meta_data['ValidationS3Uri'] = dest.get_uri()
-    return meta_data
+    result = {
+        'counts': {'validation': len(validation_lines)},
+        'ValidationS3Uri': dest.get_uri()
+    }
+    mark_completed(s3_input_uri, "create_validation_set", fingerprint, result)
+    return merge_result(meta_data, result)
 
 # def lambda_handler(event, context):
 #     """
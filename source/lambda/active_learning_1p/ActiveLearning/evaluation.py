@@ -0,0 +1,102 @@
+'''
+Vectorized mean average precision (mAP) of the detector on the validation set.
+
+The validation images are scored by the transform job together with the unlabeled images. Their
+post-processed detections are matched to the human labels in the Pascal VOC way: detections of an
+image are visited by decreasing score and each is a true positive when its best overlapping
+ground truth box of the same class has an IoU of IOU_THRESHOLD at least and was not matched yet.
+The IoUs of an image are one (detections, ground truth boxes) array. The detections of all
+images are then sorted per class once, and cumulative sums give the precision and recall at every
+score, whose monotone precision envelope integrates to the average precision (AP) of the class.
+'''
+import numpy as np
+
+from ActiveLearning.propagation import get_normalized_boxes, iou_matrix
+
+IOU_THRESHOLD = 0.5
+
+CLASS_ID, SCORE = 0, 1
+
+
+def match_detections(detections, boxes, classes, iou_threshold=IOU_THRESHOLD):
+    """
+    Return the detections of an image sorted by decreasing score and whether each is a true positive.
+    """
+    detections = detections[np.argsort(-detections[:, SCORE], kind="stable")]
+    true_positives = np.zeros(len(detections), dtype=bool)
+    if len(detections) == 0 or len(boxes) == 0:
+        return detections, true_positives
+    same_class = detections[:, CLASS_ID, np.newaxis].astype(np.int64) == classes[np.newaxis, :]
+    ious = np.where(same_class, iou_matrix(detections[:, 2:6], boxes), 0.0)
+    best = np.argmax(ious, axis=1)
+    best_iou = ious[np.arange(len(detections)), best]
+    matched = np.zeros(len(boxes), dtype=bool)
+    for detection in np.flatnonzero(best_iou >= iou_threshold):
+        if not matched[best[detection]]:
+            matched[best[detection]] = True
+            true_positives[detection] = True
+    return detections, true_positives
+
+
+def average_precision(true_positives, n_ground_truth):
+    """
+    Area under the precision envelope of detections sorted by decreasing score.
+    """
+    true_positive_count = np.cumsum(true_positives)
+    recall = true_positive_count / n_ground_truth
+    precision = true_positive_count / np.arange(1, len(true_positives) + 1)
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+    return float(np.sum(np.diff(np.concatenate(([0.0], recall))) * envelope))
+
+
+def evaluate_detections(ground_truths, detections, iou_threshold=IOU_THRESHOLD):
+    """
+    Compute the AP of every class with ground truth boxes and their mean.
+
+    ground_truths: (boxes, classes) of every image, normalized [xmin, ymin, xmax, ymax] boxes.
+    detections: (n, 6) [class_id, score, xmin, ymin, xmax, ymax] array of every image.
+    """
+    matched = [match_detections(np.asarray(image_detections, dtype=float).reshape(-1, 6), boxes, classes,
+                                iou_threshold)
+               for (boxes, classes), image_detections in zip(ground_truths, detections)]
+    all_detections = np.concatenate([image_detections for image_detections, _ in matched] + [np.zeros((0, 6))])
+    all_true_positives = np.concatenate([true_positives for _, true_positives in matched] + [np.zeros(0, bool)])
+    all_classes = np.concatenate([classes for _, classes in ground_truths] + [np.zeros(0, np.int64)])
+    class_ids, n_ground_truth = np.unique(all_classes, return_counts=True)
+
+    detection_classes = all_detections[:, CLASS_ID].astype(np.int64)
+    # One sort by class, then decreasing score, leaves every class a contiguous run.
+    order = np.lexsort((-all_detections[:, SCORE], detection_classes))
+    detection_classes, all_true_positives = detection_classes[order], all_true_positives[order]
+    starts = np.searchsorted(detection_classes, class_ids, side="left")
+    ends = np.searchsorted(detection_classes, class_ids, side="right")
+
+    average_precisions = {
+        str(class_id): average_precision(all_true_positives[start:end], count)
+        for class_id, count, start, end in zip(class_ids.tolist(), n_ground_truth.tolist(), starts, ends)
+    }
+    return {
+        'map': float(np.mean(list(average_precisions.values()))) if average_precisions else 0.0,
+        'ap': average_precisions,
+        'images': len(ground_truths),
+        'ground_truth_boxes': int(len(all_classes)),
+        'detections': int(len(all_detections)),
+        'iou_threshold': iou_threshold
+    }
+
+
+def evaluate_validation_set(validation_predictions, label_attribute_name, iou_threshold=IOU_THRESHOLD):
+    """
+    Evaluate (validation row, prediction) pairs, post-processing the predictions like the ones
+    which are autoannotated. Rows without an image size are left out.
+    """
+    from ActiveLearning.postprocess import POSTPROCESS_BATCH_SIZE, postprocess_predictions
+
+    evaluated = [(get_normalized_boxes(row[label_attribute_name]), prediction['prediction'])
+                 for row, prediction in validation_predictions]
+    evaluated = [(ground_truth, prediction) for ground_truth, prediction in evaluated if ground_truth is not None]
+    detections = []
+    for start in range(0, len(evaluated), POSTPROCESS_BATCH_SIZE):
+        detections += postprocess_predictions(
+            [prediction for _, prediction in evaluated[start:start + POSTPROCESS_BATCH_SIZE]])
+    return evaluate_detections([ground_truth for ground_truth, _ in evaluated], detections, iou_threshold)
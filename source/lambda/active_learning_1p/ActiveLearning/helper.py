@@ -1,15 +1,27 @@
 import logging
 import random
 from datetime import datetime
-from PIL import Image
-import numpy as np
+from itertools import islice
 
 from ActiveLearning.s3_helper import S3Ref, download_bytesio
+from metrics import increment
 
 AUTOANNOTATION_THRESHOLD = 0.50
 JOB_TYPE = "groundtruth/object-detection"
 
 
+def get_selection_margin(raw_boxes, detections):
+    """
+    Distance of the least certain detection of an image to AUTOANNOTATION_THRESHOLD, the smaller
+    the more the image needs a human label. When no box survived post-processing, the best raw
+    box stands for the image.
+    """
+    scores = [confidence_score for _, confidence_score, *_ in detections]
+    if not scores:
+        scores = [max((box[1] for box in raw_boxes), default=0.0)]
+    return min(abs(confidence_score - AUTOANNOTATION_THRESHOLD) for confidence_score in scores)
+
+
 class SimpleActiveLearning:
 
     def __init__(self, job_name, label_category_name,
@@ -70,32 +82,38 @@ class SimpleActiveLearning:
         sources_by_id = {
             source['id']: source for source in sources
         }
-        autoannotations = []
-        for prediction in predictions:
+        return list(self.generate_autoannotations(
+            (sources_by_id[prediction['id']], prediction) for prediction in predictions
+        ))
+
+    def generate_autoannotations(self, aligned_predictions):
+        """
+         Lazily auto annotate (source, prediction) pairs with confidence above AUTOANNOTATION_THRESHOLD.
+       """
+        for source, prediction in aligned_predictions:
             probabilities = prediction['prob']
             labels = prediction['label']
             margin, best_label = self.compute_margin(probabilities, labels)
             if margin > AUTOANNOTATION_THRESHOLD:
-                autoannotations.append(self.make_autoannotation(
-                    prediction, sources_by_id[prediction['id']],
-                    margin, best_label
-                ))
-
-        return autoannotations
+                yield self.make_autoannotation(prediction, source, margin, best_label)
 
     def select_for_labeling(self, predictions, autoannotations):
         """
          Select the next set of records to be labeled by humans.
        """
-        initial_ids = {
-            prediction['id'] for prediction in predictions
-        }
-        autoannotation_ids = {
-            autoannotation['id'] for autoannotation in autoannotations
-        }
-        remaining_ids = initial_ids - autoannotation_ids
+        return self.select_ids_for_labeling(
+            (prediction['id'] for prediction in predictions),
+            (autoannotation['id'] for autoannotation in autoannotations)
+        )
+
+    def select_ids_for_labeling(self, candidate_ids, autoannotation_ids):
+        """
+         Select up to max_selections of the candidate ids which were not auto annotated.
+       """
+        remaining_ids = set(candidate_ids) - set(autoannotation_ids)
+        # random.sample requires a sequence, sets are not accepted since python 3.11.
         selections = random.sample(
-            remaining_ids, min(self.max_selections, len(remaining_ids))
+            sorted(remaining_ids), min(self.max_selections, len(remaining_ids))
         )
         return selections
 
@@ -103,11 +121,19 @@ class SimpleActiveLearning:
 class ImageActiveLearning(SimpleActiveLearning):
 
     def __init__(self, job_name, label_category_name,
-                 class_map, max_selections):
+                 class_map, max_selections, image_sizes=None, near_duplicates=None, labeled_frames=None):
         self.job_name = job_name
         self.label_category_name = label_category_name
         self.class_map = class_map
         self.max_selections = max_selections
+        # Original image sizes by source-ref, recorded when the images were staged for inference.
+        self.image_sizes = image_sizes or {}
+        # Representative id by id of the near-duplicates which were not scored themselves.
+        self.near_duplicates = near_duplicates or {}
+        # Human labels of adjacent frames, which confirm detections that are not confident enough.
+        self.labeled_frames = labeled_frames
+        # Selection margin by id of the images which were not autoannotated.
+        self.margins = {}
 
     def make_metadata(self, annotations):
         """
@@ -129,10 +155,19 @@ class ImageActiveLearning(SimpleActiveLearning):
         Generate the final output prediction with the label and confidence.
         """
         source_ref = source['source-ref']
-        # get image dimensions by downloading image data
-        image_bytesio = download_bytesio(S3Ref.from_uri(source_ref))
-        image = np.array(Image.open(image_bytesio))
-        image_height, image_width, depth = image.shape
+        image_size = self.image_sizes.get(source_ref)
+        if image_size is not None:
+            image_width, image_height, depth = image_size['width'], image_size['height'], image_size['depth']
+        else:
+            # PIL is imported on first use so that importing this module stays cheap for handlers
+            # that never autoannotate.
+            from PIL import Image
+
+            # get image dimensions by downloading image data. Only the header is parsed, the pixels are never decoded.
+            image_bytesio = download_bytesio(S3Ref.from_uri(source_ref))
+            image = Image.open(image_bytesio)
+            image_width, image_height = image.size
+            depth = len(image.getbands())
 
         # annotations are 0-1 normalized, so the numbers should be multiplied by image dimensions
         for annotation in annotations:
@@ -160,52 +195,111 @@ class ImageActiveLearning(SimpleActiveLearning):
         """
         Given the aligned lines of manifest file and inference output,
         auto annotate all unlabeled data with confidence above AUTOANNOTATION_THRESHOLD.
+        """
+        autoannotations = list(self.generate_autoannotations(zip(sources, predictions)))
+        logging.info("Populated autoannotation entries for {:d} samples".format(len(autoannotations)))
+        return autoannotations
+
+    def generate_autoannotations(self, aligned_predictions):
+        """
+        Lazily auto annotate (source, prediction) pairs with confidence above AUTOANNOTATION_THRESHOLD.
         Assume the default object detection response structure, where the prediction[1] is the confidence score.
+        Predictions are post-processed in batches first, so only boxes surviving the score floor,
+        NMS and top-k are considered. Detections of frames next to human labeled frames which
+        agree with their labels are autoannotated too. The selection margin of the other images
+        is kept for select_ids_for_labeling.
         """
+        # numpy is imported on first use, like PIL, to keep importing this module cheap.
+        from ActiveLearning.postprocess import POSTPROCESS_BATCH_SIZE, postprocess_predictions
+
         logging.info("Autoannotating based on confidence threshold {:.2f}".format(AUTOANNOTATION_THRESHOLD))
 
-        autoannotations = []
-        for source, prediction in zip(sources, predictions):
-            # if any of the detection results has low confidence, there may be false positive.
-            # by default, false positive should be returned to the human annotator
-            annotations = []  # follow the SageMaker bounding box manifest format
-            make_autoannotation_yes = True
-            for pred in prediction['prediction']:
-                class_id, confidence_score, xmin, ymin, xmax, ymax = pred
-                margin = confidence_score
-                if margin < AUTOANNOTATION_THRESHOLD:
-                    # any false positive should render the prediction invalid
-                    make_autoannotation_yes = False
-                    break
-                top = ymin
-                left = xmin
-                width = xmax - xmin
-                height = ymax - ymin
-                annotation = {
-                    'class_id': class_id, 'top': top, 'left': left, 'width': width, 'height': height, 'score': margin
-                }
-                annotations.append(annotation)
+        aligned_predictions = iter(aligned_predictions)
+        while True:
+            batch = list(islice(aligned_predictions, POSTPROCESS_BATCH_SIZE))
+            if not batch:
+                break
+            detections = postprocess_predictions([prediction['prediction'] for _, prediction in batch])
+            for (source, prediction), boxes in zip(batch, detections):
+                raw_boxes = prediction['prediction']
+                autoannotation = self.autoannotate_detections(source, prediction, boxes.tolist(), len(raw_boxes))
+                if autoannotation is None and self.labeled_frames is not None:
+                    autoannotation = self.propagate_labels(source, prediction, boxes.tolist())
+                if autoannotation is not None:
+                    yield autoannotation
+                else:
+                    self.margins[source['id']] = get_selection_margin(raw_boxes, boxes.tolist())
 
-            if make_autoannotation_yes:
-                # predictions are good enough, so make autoannotations
-                autoannotations.append(self.make_autoannotation(prediction, source, annotations))
-        logging.info("Populated autoannotation entries for {:d} samples".format(len(autoannotations)))
-        return autoannotations
+    def autoannotate_detections(self, source, prediction, detections, raw_box_count=0):
+        """
+        Return the autoannotation of an image from its post-processed detections, or None if any
+        of them is not confident enough, or if the model detected boxes which all scored under
+        the post-processing floor.
+        """
+        # a frame with only weak boxes is uncertain, not empty.
+        if not detections and raw_box_count:
+            return None
+        # if any of the detection results has low confidence, there may be false positive.
+        # by default, false positive should be returned to the human annotator
+        if any(confidence_score < AUTOANNOTATION_THRESHOLD for _, confidence_score, *_ in detections):
+            # any false positive should render the prediction invalid
+            return None
+        # predictions are good enough, so make autoannotations
+        return self.make_autoannotation(prediction, source, self.make_annotations(detections))
+
+    def propagate_labels(self, source, prediction, detections):
+        """
+        Return the autoannotation of an image from detections which match the human labels of
+        an adjacent frame one to one, or None if no adjacent frame confirms them.
+        """
+        if not self.labeled_frames.confirms(source['source-ref'], detections):
+            return None
+        increment("propagation.promoted")
+        return self.make_autoannotation(prediction, source, self.make_annotations(detections))
+
+    def make_annotations(self, detections):
+        """
+        Convert detections to annotations with normalized coordinates.
+        """
+        annotations = []  # follow the SageMaker bounding box manifest format
+        for class_id, confidence_score, xmin, ymin, xmax, ymax in detections:
+            margin = confidence_score
+            top = ymin
+            left = xmin
+            width = xmax - xmin
+            height = ymax - ymin
+            annotation = {
+                'class_id': class_id, 'top': top, 'left': left, 'width': width, 'height': height, 'score': margin
+            }
+            annotations.append(annotation)
+        return annotations
 
     def select_for_labeling(self, sources, autoannotations):
         """
         Select the next set of records to be labeled by humans.
         Do this by looking at which predictions ended up without associated auto-annotations.
         """
-        initial_ids = {
-            prediction['id'] for prediction in sources
-        }
-        autoannotation_ids = {
-            autoannotation['id'] for autoannotation in autoannotations
-        }
-        remaining_ids = initial_ids - autoannotation_ids
-        selections = random.sample(
-            remaining_ids, min(self.max_selections, len(remaining_ids))
+        return self.select_ids_for_labeling(
+            (source['id'] for source in sources),
+            (autoannotation['id'] for autoannotation in autoannotations)
         )
+
+    def select_ids_for_labeling(self, candidate_ids, autoannotation_ids):
+        """
+        Select up to max_selections of the candidate ids which were not auto annotated, the images
+        with the smallest selection margin first. Candidates without a margin fill the remaining
+        slots at random. Near-duplicates are left to the representative of their cluster, so a
+        cluster is labeled once.
+        """
+        autoannotation_ids = set(autoannotation_ids)
+        remaining_ids = {candidate_id for candidate_id in candidate_ids
+                         if candidate_id not in self.near_duplicates and candidate_id not in autoannotation_ids}
+        scored_ids = sorted((candidate_id for candidate_id in remaining_ids if candidate_id in self.margins),
+                            key=lambda candidate_id: (self.margins[candidate_id], candidate_id))
+        selections = scored_ids[:self.max_selections]
+        if len(selections) < self.max_selections:
+            unscored_ids = remaining_ids.difference(self.margins)
+            selections += random.sample(sorted(unscored_ids), min(self.max_selections - len(selections),
+                                                                 len(unscored_ids)))
         logging.info("The following ids were selected for labeling: {:s}".format(str(selections)))
         return selections
\ No newline at end of file
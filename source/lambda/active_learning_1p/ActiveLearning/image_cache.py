@@ -0,0 +1,117 @@
+'''
+Content addressed cache of downscaled images.
+
+The detector resizes its input to the network input size anyway, so sending it full resolution
+frames only costs transfer and decoding. Images are resized once, to a shorter side of the
+network input size, and kept under <IntermediateFolderUri>resized-images/<size>/<ETag>_<original
+size>, so a frame is downloaded and decoded once per content and size however many iterations it
+stays unlabeled. The original sizes are read back from the names of the cached copies, every copy
+is written once and concurrent runs never overwrite a shared file. Resizing keeps the aspect ratio
+and predictions are normalized, so autoannotations are scaled to these original sizes without
+downloading the originals again.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from ActiveLearning.s3_helper import S3Ref, copy, download_bytesio, get_etag, get_etags_inside_prefix, get_uris_inside_prefix, upload_bytes
+from metrics import increment
+
+RESIZED_FOLDER = "resized-images/"
+STAGE_WORKERS = 16
+JPEG_QUALITY = 90
+
+
+def resize_image(image_bytes, image_shape):
+    """
+    Return the image resized so that its shorter side is image_shape, encoded as JPEG, and
+    the size of the original image. Smaller images are kept as they are.
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(image_bytes))
+    width, height = image.size
+    image_size = {"width": width, "height": height, "depth": len(image.getbands())}
+    scale = float(image_shape) / min(width, height)
+    if scale >= 1:
+        return image_bytes, image_size
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # JPEG frames are decoded at a reduced scale when the target is small enough.
+    image.draft("RGB", size)
+    resized = image.convert("RGB").resize(size, Image.BILINEAR)
+    output = BytesIO()
+    resized.save(output, format="JPEG", quality=JPEG_QUALITY)
+    return output.getvalue(), image_size
+
+
+def get_source_etags(source_refs):
+    """
+    Return the ETags of the sources, listing each folder they are in once instead of
+    sending a HEAD request per image. Images at the root of a bucket are left out.
+    """
+    etags = {}
+    for bucket, folder in {(ref.bucket, ref.key.rpartition("/")[0]) for ref in map(S3Ref.from_uri, source_refs)}:
+        if not folder:
+            continue
+        for key, etag in get_etags_inside_prefix(S3Ref(bucket, folder + "/")).items():
+            etags[S3Ref(bucket, key).get_uri()] = etag
+    return etags
+
+
+def get_cached_name(etag, image_size):
+    return "{}_{width}x{height}x{depth}".format(etag, **image_size)
+
+
+def read_cached_sizes(cache_folder):
+    """
+    Return the original size of every cached image by ETag, read from the names of the copies.
+    """
+    sizes = {}
+    for key in get_uris_inside_prefix(S3Ref.from_uri(cache_folder)):
+        etag, _, size = key.rpartition("/")[2].partition("_")
+        if size:
+            width, height, depth = map(int, size.split("x"))
+            sizes[etag] = {"width": width, "height": height, "depth": depth}
+    return sizes
+
+
+def get_staged_key(staged_prefix, record_id, source_ref):
+    """
+    Images are staged as <staged_prefix><record id>/<basename>, images with the same name in
+    different folders never collide and inference outputs can be traced back to their record.
+    """
+    return "{}{}/{}".format(staged_prefix, record_id, os.path.basename(S3Ref.from_uri(source_ref).key))
+
+
+def stage_resized_images(records, cache_folder, staged_prefix, image_shape):
+    """
+    Stage the resized copy of the image of every (record id, source-ref) pair, resizing only
+    the images missing from the cache, and return the original size of each image by source-ref.
+    """
+    records = list(records)
+    sizes = read_cached_sizes(cache_folder)
+    staged_keys = set(get_uris_inside_prefix(S3Ref.from_uri(staged_prefix)))
+    etags = get_source_etags(source_ref for _, source_ref in records)
+
+    def stage(record):
+        record_id, source_ref = record
+        source = S3Ref.from_uri(source_ref)
+        etag = (etags.get(source_ref) or get_etag(source)).strip('"')
+        staged = S3Ref.from_uri(get_staged_key(staged_prefix, record_id, source_ref))
+        if etag in sizes:
+            # Images staged by an earlier, interrupted run are not copied again.
+            if staged.key not in staged_keys:
+                copy(S3Ref.from_uri(cache_folder + get_cached_name(etag, sizes[etag])), staged)
+            return sizes[etag], True
+        image_bytes, image_size = resize_image(download_bytesio(source).getvalue(), image_shape)
+        upload_bytes(image_bytes, S3Ref.from_uri(cache_folder + get_cached_name(etag, image_size)))
+        upload_bytes(image_bytes, staged)
+        return image_size, False
+
+    with ThreadPoolExecutor(max_workers=STAGE_WORKERS) as executor:
+        staged = list(executor.map(stage, records))
+
+    hits = sum(1 for _, hit in staged if hit)
+    increment("image_cache.hit", hits)
+    increment("image_cache.miss", len(staged) - hits)
+    return {source_ref: image_size for (_, source_ref), (image_size, _) in zip(records, staged)}
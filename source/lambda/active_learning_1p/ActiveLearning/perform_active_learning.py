@@ -1,27 +1,53 @@
 import json
 import os
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import List
 
-from ActiveLearning.s3_helper import S3Ref, download_stringio, download_with_query, upload, create_ref_at_parent_key, get_uris_inside_prefix
+from ActiveLearning.s3_helper import S3Ref, CACHE_FRESHNESS_SECONDS, download_bytesio, download_cached, download_stringio, download_with_query, iter_query_lines, list_contents, upload, upload_stream, create_ref_at_parent_key
 from ActiveLearning.string_helper import generate_job_id_and_s3_path
 from io import StringIO
 
 from ActiveLearning.helper import SimpleActiveLearning, ImageActiveLearning
+from idempotency import get_completed_result, get_fingerprint, mark_completed, merge_result
+from metrics import instrument_handler, set_value, timer
+from pipeline import prefetch
+from profiling import profile_handler
 
 import logging
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# The manifests, configs and indexes read before autoannotating are loaded concurrently.
+LOAD_WORKERS = 6
+
+
+def load_json(s3_uri, default):
+    """
+    Load a JSON object, default when there is no uri.
+    """
+    if not s3_uri:
+        return default
+    return json.loads(download_bytesio(S3Ref.from_uri(s3_uri)).getvalue())
+
+
+def load_manifest_dicts(s3_uri):
+    """
+    Load the rows of a manifest, none when there is no uri.
+    """
+    if not s3_uri:
+        return []
+    return get_dicts_from_manifest_file(download_stringio(S3Ref.from_uri(s3_uri)))
+
 
 def get_class_map_from_s3(labels_s3_uri):
     """
-     fetch the list of labels from a label s3 bucket.
+     fetch the list of labels from a label s3 bucket. The config is re-read by every iteration,
+     it is served from the warm invocation cache.
     """
     labels_source = S3Ref.from_uri(labels_s3_uri)
-    labels_dict = json.loads(download_stringio(labels_source).read())
+    labels_dict = json.loads(download_cached(labels_source, max_age=CACHE_FRESHNESS_SECONDS))
     class_map = labels_dict["class-map"]
     return class_map
 
@@ -52,23 +78,29 @@ def get_dicts_from_manifest_file(inference_input):
     return sources
 
 
+def flatten_prediction(data):
+    """
+     Move the content of SageMakerOutput to the top level of the prediction.
+    """
+    if "SageMakerOutput" not in data:
+        return data
+    prediction = {}
+    for key, value in data.items():
+        if key != "SageMakerOutput":
+            prediction[key] = value
+        else:
+            if not isinstance(value, dict):
+                raise ValueError("Expected a dictionary inside SageMakerOutput, found {!r}".format(value))
+            prediction.update(value)
+    return prediction
+
+
 def get_predictions(inference_output):
     """
-     Load inference output as a python list
+     Lazily parse inference output, one prediction per line.
     """
-    predictions = []
     for line in inference_output:
-        data = json.loads(line)
-        prediction = {}
-        for key, value in data.items():
-            if key != "SageMakerOutput":
-                prediction[key] = value
-            else:
-                if not isinstance(value, dict):
-                    print("Error: Expected dictionary inside SageMakerOutput.")
-                prediction.update(value)
-        predictions.append(prediction)
-    return predictions
+        yield flatten_prediction(json.loads(line))
 
 
 def collect_inference_inputs(s3_input_uri):
@@ -87,70 +119,161 @@ def collect_inference_inputs(s3_input_uri):
 
 def collect_inference_outputs(inference_output_uri):
     """
-     collect information related to output of inference.
+     collect information related to output of inference. Predictions are parsed lazily.
     """
     sagemaker_output_file = "unlabeled.manifest.out"
     prediction_output_uri = inference_output_uri + sagemaker_output_file
     prediction_output_s3 = S3Ref.from_uri(prediction_output_uri)
     prediction_output = download_stringio(prediction_output_s3)
-    predictions = get_predictions(prediction_output)
-    logger.info("Collected {} inference outputs.".format(len(predictions)))
-    return predictions
+    return get_predictions(prediction_output)
+
+
+def fetch_inference_output(output_s3_ref: S3Ref):
+    """
+     Download and parse one .out file.
+    """
+    return output_s3_ref, flatten_prediction(json.loads(download_bytesio(output_s3_ref).getvalue()))
 
 
 def collect_inference_outputs_from_prefix(inference_output_uri):
     """
-    Input parameter specifies the prefix where *.out files are generated. Query for the *.out files and return
-    a 2-dimensional tuple:
-    1. List of S3Refs corresponding to each .out file
-    2. List of string corresponding to the content of each .out file
+    Input parameter specifies the prefix where *.out files are generated. Return an iterator
+    over a 2-dimensional tuple for each *.out file:
+    1. S3Ref corresponding to the .out file
+    2. Dict corresponding to the content of the .out file
+    Listing and downloads start right away in the background and run a bounded number of files
+    ahead of the consumer, until the iterator is exhausted or closed.
     """
     inference_output_s3_ref = S3Ref.from_uri(inference_output_uri)
-    inference_output_keys = get_uris_inside_prefix(inference_output_s3_ref)
-    inference_output_tuples = []
-    for inference_output_key in inference_output_keys:
-        inference_output_prefix = 's3://{}/{}'.format(inference_output_s3_ref.bucket, inference_output_key)
-        # only include .out files
-        _, extension = os.path.splitext(inference_output_prefix)
-        if extension == ".out":
-            inference_output_s3_ref = S3Ref.from_uri(inference_output_prefix)
-            inference_output_string = download_stringio(inference_output_s3_ref).read()
-            inference_output_dict = json.loads(inference_output_string)
-            inference_output_tuples.append((inference_output_s3_ref, inference_output_dict))
-    logger.info("Collected {} inference outputs.".format(len(inference_output_tuples)))
-    return zip(*inference_output_tuples)  # converts list of tuples into tuple of lists
+    # only include .out files
+    output_s3_refs = (
+        S3Ref(inference_output_s3_ref.bucket, content['Key']) for content in list_contents(inference_output_s3_ref)
+        if os.path.splitext(content['Key'])[1] == ".out"
+    )
+    return prefetch(fetch_inference_output, output_s3_refs)
 
 
-def write_auto_annotations(active_learning_strategy, sources, predictions, inference_input_s3_ref):
+def get_inference_output_record_id(inference_output_s3_ref: S3Ref):
     """
-     write auto annotations to s3
+    Images are staged as <staged prefix>/<record id>/<name> and batch transform writes the output
+    of each to <output prefix>/<record id>/<name>.out. Return the record id, as a string.
     """
-    logger.info("Generating auto annotations where confidence is high.")
-    auto_annotation_stream = StringIO()
-    auto_annotations = active_learning_strategy.autoannotate(predictions, sources)
-    for auto_annotation in auto_annotations:
-        auto_annotation_stream.write(json.dumps(auto_annotation) + "\n")
+    return os.path.basename(os.path.dirname(inference_output_s3_ref.key))
+
+
+def index_by_record_id(manifest_dicts):
+    """
+    Return the manifest rows by record id, as a string. Outputs are matched to rows by id, so two
+    rows with the same id are an error rather than one of them silently losing its prediction.
+    """
+    manifest_dicts_by_id = {}
+    for manifest_dict in manifest_dicts:
+        record_id = str(manifest_dict['id'])
+        if record_id in manifest_dicts_by_id:
+            raise ValueError("Record id {} appears more than once in the manifest".format(record_id))
+        manifest_dicts_by_id[record_id] = manifest_dict
+    return manifest_dicts_by_id
 
-    # Auto annotation.
+
+def collect_labeled_frames(intermediate_manifest_s3_uri, label_attribute_name, manifest_dicts):
+    """
+     Collect the human labels of the frames adjacent to the unlabeled ones.
+    """
+    # numpy is imported on first use, to keep importing this module cheap.
+    from ActiveLearning.propagation import load_labeled_frames
+
+    human_labeled_query = """select * from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes')""".format(
+        label_attribute_name)
+    rows = (json.loads(line) for line in
+            iter_query_lines(S3Ref.from_uri(intermediate_manifest_s3_uri), human_labeled_query))
+    return load_labeled_frames(
+        rows, (manifest_dict['source-ref'] for manifest_dict in manifest_dicts), label_attribute_name)
+
+
+def divert_validation_outputs(inference_outputs, validation_dicts, validation_predictions):
+    """
+    Append the outputs computed on validation images to validation_predictions, paired with their
+    validation row, and lazily yield the other outputs.
+    """
+    validation_dicts_by_id = index_by_record_id(validation_dicts)
+    for inference_output_s3_ref, prediction in inference_outputs:
+        validation_dict = validation_dicts_by_id.get(get_inference_output_record_id(inference_output_s3_ref))
+        if validation_dict is not None:
+            validation_predictions.append((validation_dict, prediction))
+        else:
+            yield inference_output_s3_ref, prediction
+
+
+def join_manifest_and_inference_outputs(manifest_dicts, inference_outputs, near_duplicates=None):
+    """
+    Lazily pair each inference output with the manifest row of the image it was computed on.
+    Yields (manifest dict, prediction) tuples in the order the outputs are produced, so predictions
+    never have to be held in memory all at once. Near-duplicates, given as {id: representative id},
+    are paired with the prediction of their representative.
+    """
+    manifest_dicts_by_id = index_by_record_id(manifest_dicts)
+    members_by_representative = {}
+    collected = 0
+    for member, representative in (near_duplicates or {}).items():
+        members_by_representative.setdefault(str(representative), []).append(manifest_dicts_by_id[str(member)])
+    for inference_output_s3_ref, prediction in inference_outputs:
+        collected += 1
+        record_id = get_inference_output_record_id(inference_output_s3_ref)
+        manifest_dict = manifest_dicts_by_id.get(record_id)
+        if manifest_dict is None:
+            logger.warning("No manifest row found for inference output {}.".format(inference_output_s3_ref.get_uri()))
+            continue
+        yield manifest_dict, prediction
+        for member_dict in members_by_representative.get(record_id, ()):
+            yield member_dict, prediction
+    logger.info("Collected {} inference outputs.".format(collected))
+
+
+def evaluate_model(validation_predictions, label_attribute_name):
+    """
+     Compute the mAP of the model on the validation images, None without validation outputs.
+    """
+    if not validation_predictions:
+        return None
+    # numpy is imported on first use, to keep importing this module cheap.
+    from ActiveLearning.evaluation import evaluate_validation_set
+
+    evaluation = evaluate_validation_set(validation_predictions, label_attribute_name)
+    set_value("evaluation.map", evaluation['map'])
+    logger.info("Model mAP@{} on {} validation images: {:.4f}".format(
+        evaluation['iou_threshold'], evaluation['images'], evaluation['map']))
+    return evaluation
+
+
+def write_auto_annotations(active_learning_strategy, aligned_predictions, inference_input_s3_ref):
+    """
+     write auto annotations to s3. Autoannotations are serialized as they are generated,
+     only their ids are kept and returned.
+    """
+    logger.info("Generating auto annotations where confidence is high.")
+    auto_annotation_ids = []
     auto_dest = create_ref_at_parent_key(inference_input_s3_ref, "autoannotated.manifest")
-    upload(auto_annotation_stream, auto_dest)
+    # Parts are uploaded while the next autoannotations are generated.
+    with upload_stream(auto_dest) as write:
+        for auto_annotation in active_learning_strategy.generate_autoannotations(aligned_predictions):
+            write(json.dumps(auto_annotation) + "\n")
+            auto_annotation_ids.append(auto_annotation['id'])
     logger.info("Uploaded autoannotations to {}.".format(auto_dest.get_uri()))
-    return auto_dest.get_uri(), auto_annotations
+    return auto_dest.get_uri(), auto_annotation_ids
 
 
-def write_selector_file(active_learning_strategy, sources, inference_input_s3_ref, inference_input, auto_annotations):
+def write_selector_file(active_learning_strategy, sources, inference_input_s3_ref, auto_annotation_ids):
     """
      write selector file to s3. This file is used to decide which records should be labeled by humans next.
     """
     logger.info("Selecting input for next manual annotation")
     selection_data = StringIO()
-    selections = active_learning_strategy.select_for_labeling(sources, auto_annotations)
+    selections = active_learning_strategy.select_ids_for_labeling(
+        (source['id'] for source in sources), auto_annotation_ids)
     selections_set = set(selections)
-    for line in inference_input:
-        data = json.loads(line)
-        if data["id"] in selections_set:
-            selection_data.write(json.dumps(data) + "\n")
-    inference_input.seek(0)
+    for source in sources:
+        if source["id"] in selections_set:
+            selection_data.write(json.dumps(source) + "\n")
     selection_dest = create_ref_at_parent_key(
         inference_input_s3_ref, "selection.manifest")
     upload(selection_data, selection_dest)
@@ -170,6 +293,8 @@ def align_manifest_and_inference_output_dicts(manifest_dicts: List[str], inferen
     return manifest_dicts_sorted, inference_output_s3_refs_sorted, inference_output_dicts_sorted
 
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function generates auto annotatations and performs active learning.
@@ -190,31 +315,81 @@ def lambda_handler(event, context):
     if max_selections == 0:
         max_selections = input_total
 
-    inference_input_s3_ref, inference_input, manifest_dicts = \
-        collect_inference_inputs(meta_data['UnlabeledManifestS3Uri'])
-    inference_output_s3_refs, inference_output_dicts = \
-        collect_inference_outputs_from_prefix(meta_data['transform_config']['S3OutputPath'])
-
-    # Align manifest lines and inference output lines so that we can populate predictions in the manifest
-    manifest_dicts_aligned, inference_output_s3_refs_aligned, inference_output_dicts_aligned = \
-        align_manifest_and_inference_output_dicts(manifest_dicts, inference_output_s3_refs, inference_output_dicts)
-
-    class_map = get_class_map_from_s3(labels_s3_uri)
-    logger.info("Retrieved class map: {}".format(json.dumps(class_map)))
-    # label_names = get_label_names_from_s3(labels_s3_uri)
-    # logger.info("Collected {} label names.".format(len(label_names)))
-
-    image_al = ImageActiveLearning(job_name, label_attribute_name, class_map, max_selections)
-    meta_data['autoannotations'], auto_annotations = write_auto_annotations(
-        image_al, manifest_dicts_aligned, inference_output_dicts_aligned, inference_input_s3_ref)
-    meta_data['selections_s3_uri'], selections = write_selector_file(
-        image_al, manifest_dicts_aligned, inference_input_s3_ref, inference_input,
-        auto_annotations)
-    meta_data['selected_job_name'], meta_data['selected_job_output_uri'] = generate_job_id_and_s3_path(
-        job_name_prefix, intermediate_folder_uri)
-    meta_data['counts']['autoannotated'] = len(auto_annotations)
-    meta_data['counts']['selected'] = len(selections)
-    return meta_data
+    # Transform outputs are written to a folder named after the training job, which is itself
+    # derived from the training inputs, so the unlabeled manifest identifies them.
+    unlabeled_manifest_s3_uri = meta_data['UnlabeledManifestS3Uri']
+    # Human labels of the intermediate manifest are propagated to adjacent frames.
+    intermediate_manifest_s3_uri = meta_data['IntermediateManifestS3Uri']
+    input_uris = [unlabeled_manifest_s3_uri, labels_s3_uri, intermediate_manifest_s3_uri]
+    if meta_data.get('ValidationS3Uri'):
+        input_uris.append(meta_data['ValidationS3Uri'])
+    fingerprint = get_fingerprint(input_uris, {
+        'LabelingJobNamePrefix': job_name_prefix,
+        'LabelAttributeName': label_attribute_name,
+        'S3OutputPath': meta_data['transform_config']['S3OutputPath'],
+        'max_selections': max_selections
+    })
+    selected_job_name, selected_job_output_uri = generate_job_id_and_s3_path(
+        job_name_prefix, intermediate_folder_uri, fingerprint=fingerprint)
+    completed_result = get_completed_result(unlabeled_manifest_s3_uri, "perform_active_learning", fingerprint)
+    if completed_result is not None:
+        return merge_result(meta_data, dict(completed_result, selected_job_name=selected_job_name))
+
+    # Inference outputs are downloaded in the background from here on, while the inputs below are
+    # loaded concurrently. Each output is paired with its manifest row and autoannotated as it arrives.
+    # Leaving the block stops the downloads, also when a load fails.
+    with collect_inference_outputs_from_prefix(meta_data['transform_config']['S3OutputPath']) as inference_outputs:
+        with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+            inputs_future = executor.submit(collect_inference_inputs, unlabeled_manifest_s3_uri)
+            class_map_future = executor.submit(get_class_map_from_s3, labels_s3_uri)
+            image_sizes_future = executor.submit(load_json, meta_data.get('StagedImagesS3Uri'), {})
+            near_duplicates_future = executor.submit(load_json, meta_data.get('NearDuplicatesS3Uri'), {})
+            validation_future = executor.submit(load_manifest_dicts, meta_data.get('ValidationS3Uri'))
+            labeled_frames_future = executor.submit(
+                lambda: collect_labeled_frames(intermediate_manifest_s3_uri, label_attribute_name,
+                                               inputs_future.result()[2]))
+            with timer("load_inputs"):
+                inference_input_s3_ref, inference_input, manifest_dicts = inputs_future.result()
+                class_map = class_map_future.result()
+                image_sizes = image_sizes_future.result()
+                near_duplicates = {int(member): representative
+                                   for member, representative in near_duplicates_future.result().items()}
+                validation_dicts = validation_future.result()
+                labeled_frames = labeled_frames_future.result()
+        logger.info("Retrieved class map: {}".format(json.dumps(class_map)))
+        # label_names = get_label_names_from_s3(labels_s3_uri)
+        # logger.info("Collected {} label names.".format(len(label_names)))
+        logger.info("Collected human labels of {} frames adjacent to unlabeled frames.".format(len(labeled_frames)))
+
+        validation_predictions = []
+        inference_outputs = divert_validation_outputs(inference_outputs, validation_dicts, validation_predictions)
+        aligned_predictions = join_manifest_and_inference_outputs(manifest_dicts, inference_outputs, near_duplicates)
+        image_al = ImageActiveLearning(job_name, label_attribute_name, class_map, max_selections, image_sizes,
+                                       near_duplicates, labeled_frames)
+        with timer("autoannotate"):
+            autoannotations_s3_uri, auto_annotation_ids = write_auto_annotations(
+                image_al, aligned_predictions, inference_input_s3_ref)
+    with timer("select"):
+        selections_s3_uri, selections = write_selector_file(
+            image_al, manifest_dicts, inference_input_s3_ref, auto_annotation_ids)
+    with timer("evaluate"):
+        evaluation = evaluate_model(validation_predictions, label_attribute_name)
+    result = {
+        'autoannotations': autoannotations_s3_uri,
+        'selections_s3_uri': selections_s3_uri,
+        'selected_job_name': selected_job_name,
+        'selected_job_output_uri': selected_job_output_uri,
+        'counts': {
+            'autoannotated': len(auto_annotation_ids),
+            'selected': len(selections)
+        }
+    }
+    if evaluation is not None:
+        # Kept across iterations so that stopping decisions can tell when the model plateaus.
+        result['evaluation'] = evaluation
+        result['evaluation_history'] = meta_data.get('evaluation_history', []) + [evaluation['map']]
+    mark_completed(unlabeled_manifest_s3_uri, "perform_active_learning", fingerprint, result)
+    return merge_result(meta_data, result)
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,91 @@
+'''
+Vectorized post-processing of object detection outputs.
+
+The SSD style transform output holds, for every image, a list of
+[class_id, score, xmin, ymin, xmax, ymax] boxes with 0-1 normalized coordinates. Most of them
+are near-zero-score or duplicate detections of the same object. `postprocess_predictions`
+removes them for a whole batch of images at once:
+    - boxes scoring under a floor are dropped,
+    - class-aware non maximum suppression (NMS) removes lower scoring boxes overlapping a
+      better box of the same class,
+    - at most top_k boxes are kept per image.
+The boxes of a batch are padded into one (images, boxes, 6) array so that every step, including
+the pairwise IoU computation, runs as NumPy array operations.
+'''
+import numpy as np
+
+SCORE_FLOOR = 0.2
+NMS_IOU_THRESHOLD = 0.45
+TOP_K = 100
+# Only the best MAX_CANDIDATES boxes of an image enter NMS, which bounds the (images, boxes, boxes)
+# IoU array to POSTPROCESS_BATCH_SIZE * MAX_CANDIDATES ** 2 entries.
+MAX_CANDIDATES = 200
+POSTPROCESS_BATCH_SIZE = 64
+
+CLASS_ID, SCORE, XMIN, YMIN, XMAX, YMAX = range(6)
+
+
+def pad_predictions(predictions, score_floor, max_candidates):
+    """
+    Stack the box lists of a batch of images into a (images, boxes, 6) array sorted by descending
+    score within each image, and return it with the mask of entries holding a box above score_floor.
+    """
+    counts = np.fromiter((len(prediction) for prediction in predictions), dtype=np.int64, count=len(predictions))
+    width = int(counts.max()) if len(predictions) else 0
+    boxes = np.zeros((len(predictions), width, 6))
+    valid = np.arange(width)[np.newaxis, :] < counts[:, np.newaxis]
+    # Boolean mask assignment fills entries in row major order, which is the order boxes are flattened in.
+    boxes[valid] = np.array([box for prediction in predictions for box in prediction], dtype=float).reshape(-1, 6)
+    valid &= boxes[..., SCORE] >= score_floor
+
+    scores = np.where(valid, boxes[..., SCORE], -np.inf)
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :max_candidates]
+    boxes = np.take_along_axis(boxes, order[..., np.newaxis], axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    return boxes, valid
+
+
+def batched_iou(boxes):
+    """
+    Pairwise intersection over union of the boxes of each image, (images, boxes, 6) -> (images, boxes, boxes).
+    """
+    xmin, ymin, xmax, ymax = boxes[..., XMIN], boxes[..., YMIN], boxes[..., XMAX], boxes[..., YMAX]
+    area = np.clip(xmax - xmin, 0, None) * np.clip(ymax - ymin, 0, None)
+    intersection_width = np.clip(
+        np.minimum(xmax[:, :, np.newaxis], xmax[:, np.newaxis, :]) -
+        np.maximum(xmin[:, :, np.newaxis], xmin[:, np.newaxis, :]), 0, None)
+    intersection_height = np.clip(
+        np.minimum(ymax[:, :, np.newaxis], ymax[:, np.newaxis, :]) -
+        np.maximum(ymin[:, :, np.newaxis], ymin[:, np.newaxis, :]), 0, None)
+    intersection = intersection_width * intersection_height
+    union = area[:, :, np.newaxis] + area[:, np.newaxis, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def class_aware_nms(boxes, valid, iou_threshold):
+    """
+    Greedy NMS over boxes sorted by descending score. Returns the mask of the boxes which survive.
+    """
+    same_class = boxes[..., CLASS_ID][:, :, np.newaxis] == boxes[..., CLASS_ID][:, np.newaxis, :]
+    suppresses = (batched_iou(boxes) > iou_threshold) & same_class
+    keep = valid.copy()
+    # The loop runs over box ranks, every image of the batch is handled at once. A box suppresses
+    # the lower ranked boxes it overlaps only if it was not suppressed itself.
+    for rank in range(boxes.shape[1] - 1):
+        keep[:, rank + 1:] &= ~(keep[:, rank, np.newaxis] & suppresses[:, rank, rank + 1:])
+    return keep
+
+
+def postprocess_predictions(predictions, score_floor=SCORE_FLOOR, iou_threshold=NMS_IOU_THRESHOLD,
+                            top_k=TOP_K, max_candidates=MAX_CANDIDATES):
+    """
+    Filter, suppress and truncate the detections of a batch of images.
+    predictions is a list with the [class_id, score, xmin, ymin, xmax, ymax] boxes of each image.
+    Returns a list with one (boxes, 6) array per image, boxes sorted by descending score.
+    """
+    if not predictions:
+        return []
+    boxes, valid = pad_predictions(predictions, score_floor, max_candidates)
+    keep = class_aware_nms(boxes, valid, iou_threshold)
+    keep &= np.cumsum(keep, axis=1) <= top_k
+    return [image_boxes[image_keep] for image_boxes, image_keep in zip(boxes, keep)]
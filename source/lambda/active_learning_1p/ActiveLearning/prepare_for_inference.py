@@ -1,10 +1,15 @@
 import json
-import os
 
+from functools import partial
 from io import StringIO
-from pathlib import Path
 
-from ActiveLearning.s3_helper import S3Ref, copy_with_query_and_transform, create_ref_at_parent_key, download_stringio, copy
+from ActiveLearning.image_cache import RESIZED_FOLDER, stage_resized_images
+from ActiveLearning.prepare_for_training import IMAGE_SHAPE
+from ActiveLearning.s3_helper import S3Ref, copy_with_query_and_transform, download_stringio, upload_bytes
+from idempotency import get_completed_result, get_fingerprint, mark_completed, merge_result
+from metrics import increment, instrument_handler, timer
+from near_duplicates import get_representatives, load_near_duplicate_index
+from profiling import profile_handler
 
 import logging
 
@@ -12,14 +17,16 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def augment_inference_input(inference_raw):
+def augment_inference_input(inference_raw, excluded_ids=frozenset()):
     """
      The inference manifest needs to be augmented with a value 'k' so that blazing text
-     produces all probabilities instead of just the top match.
+     produces all probabilities instead of just the top match. Records in excluded_ids are left out.
     """
     augmented_inference = StringIO()
     for line in inference_raw:
         infer_dict = json.loads(line)
+        if infer_dict.get('id') in excluded_ids:
+            continue
         # Note: This number should ideally be equal to the number of classes.
         # But using a big number, produces the same result.
         infer_dict['k'] = 1000000
@@ -28,6 +35,15 @@ def augment_inference_input(inference_raw):
     return augmented_inference
 
 
+def get_pending_ids(pending_selections_s3_uri):
+    """
+     Ids of the records out for human labeling while this iteration runs. They are not
+     autoannotated nor selected again, their human labels are merged once the job completes.
+    """
+    pending_selections = download_stringio(S3Ref.from_uri(pending_selections_s3_uri))
+    return {json.loads(line)['id'] for line in pending_selections if line.strip()}
+
+
 def create_tranform_config(training_config):
     """
      Transform config specifies input parameters for the transform job.
@@ -41,6 +57,8 @@ def create_tranform_config(training_config):
     }
 
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function generates auto annotations and performs active learning.
@@ -50,6 +68,24 @@ def lambda_handler(event, context):
     s3_input_uri = meta_data['IntermediateManifestS3Uri']
 
     transform_config = create_tranform_config(meta_data['training_config'])
+    # Set when the next iteration is prepared while the current selections are being labeled.
+    pending_selections = event.get('PendingSelections')
+    pending_selections_s3_uri = pending_selections['s3_uri'] if pending_selections else None
+    # The validation images are scored as well, to evaluate the model.
+    validation_s3_uri = meta_data.get('ValidationS3Uri')
+    input_uris = [s3_input_uri]
+    if pending_selections_s3_uri:
+        input_uris.append(pending_selections_s3_uri)
+    if validation_s3_uri:
+        input_uris.append(validation_s3_uri)
+    # The staged inputs do not depend on the model, so the job names are left out.
+    fingerprint = get_fingerprint(input_uris, {
+        'LabelAttributeName': label_attribute_name,
+        'S3OutputPath': transform_config['S3OutputPath']
+    })
+    completed_result = get_completed_result(transform_config['S3OutputPath'], "prepare_for_inference", fingerprint)
+    if completed_result is not None:
+        return merge_result(meta_data, dict(completed_result, transform_config=transform_config))
 
     source = S3Ref.from_uri(s3_input_uri)
     unlabeled_manifest_s3_ref = S3Ref.from_uri(transform_config['S3OutputPath'] + "unlabeled.manifest")
@@ -58,31 +94,61 @@ def lambda_handler(event, context):
         s3_input_uri))
     sql_unlabeled = """select * from s3object[*] s where s."{}" is missing """
     unlabeled_query = sql_unlabeled.format(label_attribute_name)
-    copy_with_query_and_transform(
-        source, unlabeled_manifest_s3_ref, unlabeled_query, augment_inference_input)
+    transform = augment_inference_input
+    if pending_selections_s3_uri:
+        pending_ids = get_pending_ids(pending_selections_s3_uri)
+        logger.info("Excluding {} records pending human labeling.".format(len(pending_ids)))
+        transform = partial(augment_inference_input, excluded_ids=pending_ids)
+    with timer("unlabeled_query"):
+        copy_with_query_and_transform(
+            source, unlabeled_manifest_s3_ref, unlabeled_query, transform)
 
     # Make S3 prefix for images to be labeled by active learning process
     unlabeled_directory_pref_s3_ref = S3Ref.from_uri(transform_config['S3OutputPath'] + "labeled_by_active_learning")
-    unlabeled_manifest_string_io = download_stringio(unlabeled_manifest_s3_ref)
-    unlabeled_manifest_string = unlabeled_manifest_string_io.read()
-    unlabeled_manifest_json_strings = unlabeled_manifest_string.strip().split("\n")
-    for unlabeled_manifest_json_string in unlabeled_manifest_json_strings:
-        unlabeled_manifest_row = json.loads(unlabeled_manifest_json_string)
-        unlabeled_image_s3_ref_string = unlabeled_manifest_row['source-ref']
-        unlabeled_image_s3_ref = S3Ref.from_uri(unlabeled_image_s3_ref_string)
-        image_basename = os.path.basename(unlabeled_image_s3_ref[-1])  # e.g. 1234.jpg, no prefix
-        new_pref_for_image = "{}/{}".format(unlabeled_directory_pref_s3_ref.get_uri(), image_basename)
-        new_pref_for_image_s3_ref = S3Ref.from_uri(new_pref_for_image)
-        copy(unlabeled_image_s3_ref, new_pref_for_image_s3_ref)
-        logger.info("Uploaded unlabeled image for inference to {}.".format(
-            new_pref_for_image_s3_ref.get_uri()))
-
-    meta_data['UnlabeledPrefixS3Uri'] = unlabeled_directory_pref_s3_ref.get_uri()
-    meta_data['UnlabeledManifestS3Uri'] = unlabeled_manifest_s3_ref.get_uri()
+    cache_folder = "{}{}{}/".format(meta_data['IntermediateFolderUri'], RESIZED_FOLDER, IMAGE_SHAPE)
+    staged_images_s3_ref = S3Ref.from_uri(transform_config['S3OutputPath'] + "staged_images.json")
+    near_duplicates_s3_ref = S3Ref.from_uri(transform_config['S3OutputPath'] + "near_duplicates.json")
+    with timer("stage_images"):
+        unlabeled_manifest_string_io = download_stringio(unlabeled_manifest_s3_ref)
+        rows = [json.loads(line) for line in unlabeled_manifest_string_io if line.strip()]
+        # Only one image of each cluster of near-duplicates is scored, the others reuse its prediction.
+        near_duplicate_index = load_near_duplicate_index(source)
+        representatives = get_representatives(near_duplicate_index, rows)
+        rows_by_id = {row['id']: row for row in rows}
+        validation_records = []
+        if validation_s3_uri:
+            validation_records = [(row['id'], row['source-ref']) for row in map(json.loads, (
+                line for line in download_stringio(S3Ref.from_uri(validation_s3_uri)) if line.strip()))]
+        # The detector gets copies resized to its input size, the original sizes are kept to
+        # scale its normalized predictions back.
+        image_sizes = stage_resized_images(
+            [(record_id, rows_by_id[record_id]['source-ref']) for record_id in sorted(representatives)]
+            + validation_records, cache_folder, unlabeled_directory_pref_s3_ref.get_uri() + "/", IMAGE_SHAPE)
+        near_duplicates = {}
+        for representative, members in representatives.items():
+            for member in members:
+                near_duplicates[member] = representative
+                image_size = near_duplicate_index.get_size(member)
+                if image_size is not None:
+                    image_sizes[rows_by_id[member]['source-ref']] = image_size
+        upload_bytes(json.dumps(image_sizes).encode(), staged_images_s3_ref)
+        upload_bytes(json.dumps(near_duplicates).encode(), near_duplicates_s3_ref)
+    increment("near_duplicates.suppressed", len(near_duplicates))
+    logger.info("Staged {} resized images for inference, {} near-duplicates reuse their predictions.".format(
+        len(representatives), len(near_duplicates)))
+    logger.info("Staged {} validation images for evaluation.".format(len(validation_records)))
+
+    result = {
+        'UnlabeledPrefixS3Uri': unlabeled_directory_pref_s3_ref.get_uri(),
+        'UnlabeledManifestS3Uri': unlabeled_manifest_s3_ref.get_uri(),
+        'StagedImagesS3Uri': staged_images_s3_ref.get_uri(),
+        'NearDuplicatesS3Uri': near_duplicates_s3_ref.get_uri(),
+        'transform_config': transform_config
+    }
     logger.info("Uploaded unlabeled manifest for inference to {}.".format(
         unlabeled_manifest_s3_ref.get_uri()))
     logger.info("Uploaded unlabeled image directory for inference to {}.".format(
         unlabeled_directory_pref_s3_ref.get_uri()))
 
-    meta_data['transform_config'] = transform_config
-    return meta_data
+    mark_completed(transform_config['S3OutputPath'], "prepare_for_inference", fingerprint, result)
+    return merge_result(meta_data, result)
@@ -1,20 +1,24 @@
 import json
-import boto3
-from functools import partial
 
-from io import StringIO
-from ActiveLearning.s3_helper import S3Ref, copy_with_query_and_transform, download_with_query, create_ref_at_parent_key
+from ActiveLearning.s3_helper import S3Ref, download_stringio, download_with_query, iter_query_lines
 from ActiveLearning.string_helper import generate_job_id_and_s3_path
+from ActiveLearning.training_shards import SHARD_FOLDER, build_shards, write_shard_manifest
+from idempotency import get_completed_result, get_fingerprint, mark_completed
+from metrics import instrument_handler, timer
+from profiling import profile_handler
 
 import logging
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Training images are packed with their shorter side resized to the image_shape hyper parameter.
+IMAGE_SHAPE = 300
 
-def remove_by_ids(s3_blacklist_uri, label_attribute_name, manifest_file):
+
+def remove_by_ids(s3_blacklist_uri, label_attribute_name, manifest_lines):
     """
-    helper method to remove selected id in the given input file.
+    helper method to remove selected id in the given input lines, lazily yielding the other rows.
     This is used to create a training set which has no elements from the given validation set.
     """
     logger.info("Remove validation set ids from training data.")
@@ -28,16 +32,14 @@ def remove_by_ids(s3_blacklist_uri, label_attribute_name, manifest_file):
         data = json.loads(line)
         validation_ids.add(data["id"])
 
-    training_only_file = StringIO()
     training_set_size = 0
-    for line in manifest_file:
+    for line in manifest_lines:
         data = json.loads(line)
         if data["id"] not in validation_ids:
             training_set_size += 1
-            training_only_file.write(json.dumps(data) + "\n")
+            yield data
     logger.info("Remove ids complete. training set size = {} Validation set size = {}".format(
         training_set_size, len(validation_ids)))
-    return training_only_file
 
 
 class TrainingJobParameters:
@@ -46,36 +48,45 @@ class TrainingJobParameters:
         self.event = event
         self.training_folder_uri = training_folder_uri
 
-    @property
-    def attribute_names(self):
+    def shard_channel(self, channel, rows):
         """
-        attribute names to be parsed from the manifest file during training.
+        Brings the RecordIO shards of the channel up to date with the rows, and returns the s3 uri
+        of the ManifestFile listing them and the number of records.
         """
         label_attribute_name = self.event['LabelAttributeName']
-        input_mode = "source-ref"
-        return [input_mode, label_attribute_name]
+        folder = self.event['meta_data']['IntermediateFolderUri'] + SHARD_FOLDER + channel + "/"
+        shards = build_shards(rows, folder, label_attribute_name, IMAGE_SHAPE)
+        dest = S3Ref.from_uri("{}{}_shards.manifest".format(self.training_folder_uri, channel))
+        records = write_shard_manifest(folder, shards, dest)
+        logger.info("Uploaded {} input of {} records in {} shards at {}.".format(
+            channel, records, len(shards), dest.get_uri()))
+        return dest.get_uri(), records
 
     @property
     def training_input(self):
         """
-        Generates the training input in an s3 location and returns the s3 uri.
+        Packs the human labeled data into the training shards and returns their s3 uri and size.
+        The validation set is left out, the model is evaluated on it.
         """
         label_attribute_name = self.event['LabelAttributeName']
-        s3_input_uri = self.event['ManifestS3Uri']
-        meta_data = self.event['meta_data']
-
-        source = S3Ref.from_uri(s3_input_uri)
-        dest = S3Ref.from_uri(self.training_folder_uri + "training_input.manifest")
-        logger.info("Creating training input at {} from human labeled data.".format(
-            dest.get_uri()))
-        remove_validation_ids = partial(remove_by_ids, meta_data['ValidationS3Uri'],
-                                        label_attribute_name)
+        source = S3Ref.from_uri(self.event['ManifestS3Uri'])
+        logger.info("Creating training input from human labeled data.")
         training_labeled_query = """select * from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes')""".format(
             label_attribute_name)
-        # copy_with_query_and_transform(source, dest, training_labeled_query, remove_validation_ids)
-        copy_with_query_and_transform(source, dest, training_labeled_query, None)
-        logger.info("Uploaded training input at {}.".format(dest.get_uri()))
-        return dest.get_uri()
+        with timer("training_input"):
+            rows = remove_by_ids(self.event['meta_data']['ValidationS3Uri'], label_attribute_name,
+                                 iter_query_lines(source, training_labeled_query))
+            return self.shard_channel("train", rows)
+
+    @property
+    def validation_input(self):
+        """
+        Packs the validation set into the validation shards and returns their s3 uri and size.
+        """
+        validation = S3Ref.from_uri(self.event['meta_data']['ValidationS3Uri'])
+        with timer("validation_input"):
+            rows = (json.loads(line) for line in download_stringio(validation) if line.strip())
+            return self.shard_channel("validation", rows)
 
     @property
     def resource_config(self):
@@ -107,6 +118,7 @@ class TrainingJobParameters:
             'ap-southeast-1': '475088953585',
             'ap-southeast-2': '544295431143',
         }
+        import boto3
         region = boto3.session.Session().region_name
         if region not in ac_map:
             return {
@@ -124,7 +136,7 @@ class TrainingJobParameters:
             "TrainingInputMode": "Pipe"
         }
 
-    def hyper_parameters(self, event):
+    def hyper_parameters(self, event, num_training_samples):
         """
       configure hyper parameters used for training.
         """
@@ -136,13 +148,13 @@ class TrainingJobParameters:
             "early_stopping_tolerance": "0.0",
             "epochs": "40",
             "freeze_layer_pattern": "false",
-            "image_shape": "300",
+            "image_shape": str(IMAGE_SHAPE),
             "label_width": "350",
             "learning_rate": "0.0001",
             "lr_scheduler_factor": "0.1",
             "mini_batch_size": "16",
             "num_classes": "4",
-            "num_training_samples": str(event["meta_data"]["counts"]["human_label"] + event["meta_data"]["counts"]["auto_label"]),
+            "num_training_samples": str(num_training_samples),
             "optimizer": "adam",
             "use_pretrained_model": "1",
         }
@@ -159,22 +171,37 @@ class TrainingJobParameters:
     #     }
 
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function sets up all the input parameters required for the training job.
     """
     training_job_name_prefix = event['LabelingJobNamePrefix']
     intermediate_folder_uri = event["meta_data"]["IntermediateFolderUri"]
+    counts = event["meta_data"].get("counts", {})
+    fingerprint = get_fingerprint([event['ManifestS3Uri'], event["meta_data"]['ValidationS3Uri']], {
+        'LabelingJobNamePrefix': training_job_name_prefix,
+        'LabelAttributeName': event['LabelAttributeName'],
+        'labeled': [counts.get("human_label"), counts.get("auto_label")]
+    })
     training_job_name, training_folder_uri = generate_job_id_and_s3_path(
-        training_job_name_prefix, intermediate_folder_uri)
+        training_job_name_prefix, intermediate_folder_uri, fingerprint=fingerprint)
+    completed_result = get_completed_result(training_folder_uri, "prepare_for_training", fingerprint)
+    if completed_result is not None:
+        return dict(completed_result, TrainingJobName=training_job_name)
     training_job_parameters = TrainingJobParameters(event, training_folder_uri)
+    train_s3_uri, num_training_samples = training_job_parameters.training_input
+    validation_s3_uri, _ = training_job_parameters.validation_input
 
-    return {
+    result = {
         "TrainingJobName": training_job_name,
-        "trainS3Uri": training_job_parameters.training_input,
+        "trainS3Uri": train_s3_uri,
+        "validationS3Uri": validation_s3_uri,
         "ResourceConfig": training_job_parameters.resource_config,
         'AlgorithmSpecification': training_job_parameters.algorithm_specification,
-        "HyperParameters": training_job_parameters.hyper_parameters(event),
-        "S3OutputPath": training_job_parameters.training_folder_uri,
-        "AttributeNames": training_job_parameters.attribute_names
+        "HyperParameters": training_job_parameters.hyper_parameters(event, num_training_samples),
+        "S3OutputPath": training_job_parameters.training_folder_uri
     }
+    mark_completed(training_folder_uri, "prepare_for_training", fingerprint, result)
+    return result
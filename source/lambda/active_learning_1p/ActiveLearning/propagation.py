@@ -0,0 +1,152 @@
+'''
+Temporal propagation of human labels to adjacent frames.
+
+Frames of a sequence share most of their objects. Frames are placed in sequences by their
+source-ref: the folder and the file name around its last number name the sequence and that
+number is the frame index, e.g. s3://bucket/drive-42/front_000123.jpg is frame 123 of
+s3://bucket/drive-42/front_.jpg.
+
+The detections of an unlabeled frame which are not confident enough to be autoannotated are
+compared with the human labels of the frames at most PROPAGATION_WINDOW frames away, nearest
+first. When the detections and the human boxes of one of them match one to one, same class and
+an IoU of MATCH_IOU at least, the detections are promoted to an autoannotation. The human
+labels confirm what the objects are, the detections where they moved to. IoUs are computed as
+one (human boxes, detections) NumPy array per frame pair.
+'''
+import os
+import re
+
+import numpy as np
+
+PROPAGATION_WINDOW = 2
+MATCH_IOU = 0.5
+FRAME_INDEX_PATTERN = re.compile(r"\d+(?!.*\d)")
+
+
+def get_frame_position(source_ref):
+    """
+    Return (sequence, frame index) of an image, None when its name has no number.
+    """
+    folder, name = os.path.split(source_ref)
+    match = FRAME_INDEX_PATTERN.search(name)
+    if match is None:
+        return None
+    return "{}/{}{}".format(folder, name[:match.start()], name[match.end():]), int(match.group())
+
+
+def iou_matrix(boxes, other_boxes):
+    """
+    Intersection over union of every pair of [xmin, ymin, xmax, ymax] boxes, (n, 4), (m, 4) -> (n, m).
+    """
+    xmin, ymin, xmax, ymax = (boxes[:, i, np.newaxis] for i in range(4))
+    other_xmin, other_ymin, other_xmax, other_ymax = (other_boxes[np.newaxis, :, i] for i in range(4))
+    intersection = np.clip(np.minimum(xmax, other_xmax) - np.maximum(xmin, other_xmin), 0, None) * \
+        np.clip(np.minimum(ymax, other_ymax) - np.maximum(ymin, other_ymin), 0, None)
+    area = (xmax - xmin) * (ymax - ymin)
+    other_area = (other_xmax - other_xmin) * (other_ymax - other_ymin)
+    union = area + other_area - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def match_boxes(boxes, classes, other_boxes, other_classes, min_iou=MATCH_IOU):
+    """
+    Return True when two non empty sets of boxes match one to one, each pair of the same class
+    and overlapping by min_iou at least. Pairs are taken greedily by decreasing IoU.
+    """
+    if len(boxes) == 0 or len(boxes) != len(other_boxes):
+        return False
+    ious = np.where(classes[:, np.newaxis] == other_classes[np.newaxis, :], iou_matrix(boxes, other_boxes), 0.0)
+    for _ in range(len(boxes)):
+        row, column = np.unravel_index(np.argmax(ious), ious.shape)
+        if ious[row, column] < min_iou:
+            return False
+        ious[row, :] = 0.0
+        ious[:, column] = 0.0
+    return True
+
+
+def get_image_size(label):
+    image_size = label.get("image_size")
+    # Ground Truth writes a list with one size, autoannotations a single size.
+    if isinstance(image_size, list):
+        image_size = image_size[0] if image_size else None
+    return image_size
+
+
+def get_normalized_boxes(label):
+    """
+    Return the [xmin, ymin, xmax, ymax] boxes of a bounding box label normalized to 0-1 and their
+    class ids, None when the label has no image size.
+    """
+    image_size = get_image_size(label)
+    if not image_size:
+        return None
+    annotations = label.get("annotations", [])
+    width, height = float(image_size["width"]), float(image_size["height"])
+    boxes = np.array([[a["left"] / width, a["top"] / height, (a["left"] + a["width"]) / width,
+                       (a["top"] + a["height"]) / height] for a in annotations]).reshape(-1, 4)
+    classes = np.array([int(a["class_id"]) for a in annotations], dtype=np.int64)
+    return boxes, classes
+
+
+class LabeledFrames:
+    """
+     Normalized human labeled boxes of frames, by sequence and frame index.
+    """
+
+    def __init__(self, window=PROPAGATION_WINDOW):
+        self.window = window
+        self.sequences = {}
+
+    def __len__(self):
+        return sum(len(frames) for frames in self.sequences.values())
+
+    def add(self, source_ref, label):
+        position = get_frame_position(source_ref)
+        normalized = get_normalized_boxes(label)
+        if position is None or normalized is None:
+            return
+        sequence, frame = position
+        self.sequences.setdefault(sequence, {})[frame] = normalized
+
+    def get_neighbors(self, source_ref):
+        """
+        Return the labeled frames within the window of an image, nearest first.
+        """
+        position = get_frame_position(source_ref)
+        if position is None:
+            return []
+        sequence, frame = position
+        frames = self.sequences.get(sequence, {})
+        offsets = sorted((offset for offset in range(-self.window, self.window + 1) if offset), key=abs)
+        return [frames[frame + offset] for offset in offsets if frame + offset in frames]
+
+    def confirms(self, source_ref, detections):
+        """
+        Return True when a labeled neighbor of the image matches its
+        [class_id, score, xmin, ymin, xmax, ymax] detections.
+        """
+        neighbors = self.get_neighbors(source_ref)
+        if not neighbors or not detections:
+            return False
+        detections = np.array(detections, dtype=float).reshape(-1, 6)
+        boxes, classes = detections[:, 2:6], detections[:, 0].astype(np.int64)
+        return any(match_boxes(boxes, classes, neighbor_boxes, neighbor_classes)
+                   for neighbor_boxes, neighbor_classes in neighbors)
+
+
+def load_labeled_frames(rows, unlabeled_source_refs, label_attribute_name, window=PROPAGATION_WINDOW):
+    """
+    Collect the human labels of the frames in the window of any unlabeled image.
+    """
+    labeled_frames = LabeledFrames(window)
+    wanted = {}
+    for source_ref in unlabeled_source_refs:
+        position = get_frame_position(source_ref)
+        if position is not None:
+            wanted.setdefault(position[0], set()).update(range(position[1] - window, position[1] + window + 1))
+    for row in rows:
+        position = get_frame_position(row["source-ref"])
+        if position is not None and position[1] in wanted.get(position[0], ()):
+            labeled_frames.add(row["source-ref"], row[label_attribute_name])
+    return labeled_frames
@@ -1,16 +1,124 @@
 '''
 Utility file to help with s3 operations.
 '''
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from urllib.parse import urlparse
-import boto3
 
 from typing import NamedTuple
 from typing import Callable
 
-from io import BytesIO, StringIO, TextIOWrapper
+from io import BufferedReader, BytesIO, RawIOBase, StringIO, TextIOWrapper
+
+from concurrency import MAX_LIMIT, governed, report_retry
+from metrics import io_timer, increment
+from pipeline import prefetch
+
+logger = logging.getLogger()
+
+# When set, objects are read from and written to this local folder instead of s3.
+# See local_storage.py.
+LOCAL_S3_ROOT_ENV = "BYOAL_LOCAL_S3_ROOT"
+
+# Small objects read on every invocation, such as the label category config, are kept across
+# warm invocations in memory and in /tmp, see download_cached.
+CACHE_DIRECTORY_ENV = "BYOAL_S3_CACHE_DIR"
+DEFAULT_CACHE_DIRECTORY = "/tmp/byoal-s3-cache"
+CACHE_MEMORY_BYTES = 16 * 1024 * 1024
+CACHE_DISK_BYTES = 256 * 1024 * 1024
+CACHE_MAX_OBJECT_BYTES = 4 * 1024 * 1024
+CACHE_FRESHNESS_SECONDS = 300
+
+# Streamed uploads hand the uploader 8 MiB chunks, the multipart part size of boto3, and hold at
+# most STREAM_QUEUE_CHUNKS of them while the uploader is busy.
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+STREAM_QUEUE_CHUNKS = 4
+
+# S3 Select queries run the way with the lowest estimated time, see plan_select: a local scan
+# of the downloaded object, one select request, or concurrent select requests over ScanRanges
+# of SCAN_RANGE_MIN_BYTES at least.
+SELECT_REQUEST_SECONDS = 0.15
+SELECT_BYTES_PER_SECOND = 100 * 1024 * 1024
+GET_REQUEST_SECONDS = 0.02
+GET_BYTES_PER_SECOND = 80 * 1024 * 1024
+LOCAL_SCAN_BYTES_PER_SECOND = 20 * 1024 * 1024
+SCAN_RANGE_MIN_BYTES = 16 * 1024 * 1024
+SCAN_RANGE_WORKERS = 8
+# Where S3 Select is not available to the account or does not support a request, queries fall
+# back to the local engine for the rest of the container's life.
+SELECT_UNAVAILABLE_CODES = {"MethodNotAllowed", "NotImplemented", "XNotImplemented"}
+
+# boto3 is slow to import and its clients are slow to build, so both are deferred
+# until the first s3 call instead of being paid for on every cold start.
+_clients = {}
+_clients_lock = threading.RLock()
+_memory_cache = OrderedDict()
+_select_unavailable = threading.Event()
+
+
+def _create_client(name: str):
+    local_root = os.environ.get(LOCAL_S3_ROOT_ENV)
+    if local_root:
+        # Local storage never throttles, both names share one client.
+        if name != 's3':
+            return get_s3_client()
+        from local_storage import LocalS3Client
+        return LocalS3Client(local_root)
+    import boto3
+    from botocore.config import Config
+    if name == 's3':
+        # Throttled and transient requests are retried by the concurrency limit, which has to
+        # see the SlowDown responses to back off.
+        return boto3.client('s3', config=Config(
+            max_pool_connections=MAX_LIMIT, retries={'mode': 'standard', 'max_attempts': 1}))
+    # Managed transfers send their parts from s3transfer threads, where a failed part can not
+    # be retried by the limit without starting the whole transfer over, or at all for streams.
+    # botocore retries each part instead, and reports the retries to the limit.
+    client = boto3.client('s3', config=Config(max_pool_connections=MAX_LIMIT, retries={'mode': 'standard'}))
+    client.meta.events.register('needs-retry.s3', report_retry)
+    return client
+
+
+def _get_client(name: str):
+    if name not in _clients:
+        # Stages running on threads may make their first call at the same time, and building
+        # boto3 clients concurrently is not thread safe.
+        with _clients_lock:
+            if name not in _clients:
+                _clients[name] = _create_client(name)
+    return _clients[name]
+
+
+def get_s3_client():
+    """
+     Return the shared client of single requests, creating it on first use. Its calls go through
+     concurrency.governed, which retries them.
+    """
+    return _get_client('s3')
+
+
+def get_transfer_client():
+    """
+     Return the shared client of managed transfers (download_fileobj, upload_fileobj and copy),
+     which retries the requests of every part itself.
+    """
+    return _get_client('transfer')
 
-s3r = boto3.resource('s3')
-s3 = boto3.client('s3')
+
+def reset_s3_client() -> None:
+    """
+     Drop the shared client and the in memory cache so the next call picks up a changed environment.
+    """
+    _clients.clear()
+    _memory_cache.clear()
+    _select_unavailable.clear()
 
 
 class S3Ref(NamedTuple):
@@ -38,14 +146,29 @@ def create_ref_at_parent_key(s3_ref: S3Ref, filename: str) -> S3Ref:
     return S3Ref(s3_ref.bucket, "/".join(key_paths))
 
 
+def _head(s3_ref: S3Ref) -> dict:
+    def head():
+        with io_timer("head"):
+            return get_s3_client().head_object(Bucket=s3_ref.bucket, Key=s3_ref.key)
+    return governed("head", head)
+
+
 def get_content_size(s3_ref: S3Ref) -> int:
     """
       Get the file size in bytes.
     """
-    response = s3.head_object(Bucket=s3_ref.bucket, Key=s3_ref.key)
+    response = _head(s3_ref)
     return int(response['ContentLength'])
 
 
+def get_etag(s3_ref: S3Ref) -> str:
+    """
+      Get the ETag of the object, which changes whenever its content does.
+    """
+    response = _head(s3_ref)
+    return response['ETag']
+
+
 def copy(source: S3Ref, dest: S3Ref) -> None:
     """
       Copy S3 file.
@@ -54,79 +177,439 @@ def copy(source: S3Ref, dest: S3Ref) -> None:
         'Bucket': source.bucket,
         'Key': source.key
     }
-    dest_bucket = s3r.Bucket(dest.bucket)
-    dest_bucket.copy(copy_source, dest.key)
+    def copy_object():
+        with io_timer("copy"):
+            get_transfer_client().copy(copy_source, dest.bucket, dest.key)
+    governed("copy", copy_object)
 
 
 def copy_on_demand(source: S3Ref, dest: S3Ref) -> None:
     """
       Copy S3 file.
     """
-    copy_source = {
-        'Bucket': source.bucket,
-        'Key': source.key
-    }
-    s3r = boto3.resource('s3')
-    dest_bucket = s3r.Bucket(dest.bucket)
-    dest_bucket.copy(copy_source, dest.key)
+    copy(source, dest)
 
 
 def download_stringio(source: S3Ref) -> StringIO:
     """
      Downloads a file to a string stream.
     """
-    bytestream = BytesIO()
-    s3.download_fileobj(source.bucket, source.key, bytestream)
-    bytestream.seek(0)
-    return TextIOWrapper(bytestream, encoding='utf-8', errors='ignore')
+    return TextIOWrapper(download_bytesio(source), encoding='utf-8', errors='ignore')
 
 
 def download_bytesio(source: S3Ref) -> BytesIO:
     """
      Downloads a file to a string stream.
     """
-    bytestream = BytesIO()
-    s3.download_fileobj(source.bucket, source.key, bytestream)
-    bytestream.seek(0)
-    return bytestream
+    def download():
+        # A retry starts over with an empty stream.
+        bytestream = BytesIO()
+        with io_timer("get") as timed:
+            get_transfer_client().download_fileobj(source.bucket, source.key, bytestream)
+            timed.nbytes = bytestream.tell()
+        bytestream.seek(0)
+        return bytestream
+    return governed("get", download)
+
+
+class CacheEntry(NamedTuple):
+    """
+     A cached object body, with the ETag it had and the time it was last known to be current.
+    """
+    etag: str
+    body: bytes
+    validated_at: float
+
+
+def _cache_key(source: S3Ref) -> str:
+    # Local storage roots reuse the same bucket names, keep their objects apart.
+    return "{}|{}".format(os.environ.get(LOCAL_S3_ROOT_ENV, ""), source.get_uri())
+
+
+def _cache_paths(cache_key: str):
+    directory = os.environ.get(CACHE_DIRECTORY_ENV, DEFAULT_CACHE_DIRECTORY)
+    name = hashlib.sha256(cache_key.encode()).hexdigest()
+    return directory, os.path.join(directory, name + ".body"), os.path.join(directory, name + ".etag")
+
+
+def _read_disk_entry(cache_key: str):
+    _, body_path, etag_path = _cache_paths(cache_key)
+    try:
+        with open(etag_path) as f:
+            etag = f.read()
+        with open(body_path, "rb") as f:
+            body = f.read()
+        validated_at = os.path.getmtime(etag_path)
+        # The access time of the body orders evictions.
+        os.utime(body_path)
+    except OSError:
+        return None
+    return CacheEntry(etag, body, validated_at)
+
+
+def _write_disk_entry(cache_key: str, entry: CacheEntry) -> None:
+    directory, body_path, etag_path = _cache_paths(cache_key)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for path, content, mode in ((body_path, entry.body, "wb"), (etag_path, entry.etag, "w")):
+            temp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(temp_path, mode) as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        os.utime(etag_path, (entry.validated_at, entry.validated_at))
+        bodies = []
+        for name in os.listdir(directory):
+            if name.endswith(".body"):
+                stat = os.stat(os.path.join(directory, name))
+                bodies.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in bodies)
+        for _, size, name in sorted(bodies):
+            if total <= CACHE_DISK_BYTES:
+                break
+            os.remove(os.path.join(directory, name))
+            os.remove(os.path.join(directory, name[:-len(".body")] + ".etag"))
+            total -= size
+    except OSError:
+        # The disk tier is an optimization, a full or read only /tmp only costs requests.
+        pass
+
+
+def _remember(cache_key: str, entry: CacheEntry) -> None:
+    _memory_cache[cache_key] = entry
+    _memory_cache.move_to_end(cache_key)
+    total = sum(len(cached.body) for cached in _memory_cache.values())
+    while total > CACHE_MEMORY_BYTES:
+        _, evicted = _memory_cache.popitem(last=False)
+        total -= len(evicted.body)
+
+
+def download_cached(source: S3Ref, max_age: float = 0) -> bytes:
+    """
+     Return the content of a small object through a cache kept across warm invocations, in
+     memory first and in /tmp second. A cached copy validated less than max_age seconds ago is
+     returned without any request, an older one is revalidated with a conditional GET
+     (If-None-Match) which transfers no body when the object did not change.
+    """
+    cache_key = _cache_key(source)
+    tier = "memory"
+    entry = _memory_cache.get(cache_key)
+    if entry is None:
+        tier = "disk"
+        entry = _read_disk_entry(cache_key)
+    now = time.time()
+    if entry is not None and now - entry.validated_at < max_age:
+        increment("s3.cache.{}_hit".format(tier))
+        _remember(cache_key, entry)
+        return entry.body
+
+    from botocore.exceptions import ClientError
+    kwargs = {'Bucket': source.bucket, 'Key': source.key}
+    if entry is not None:
+        kwargs['IfNoneMatch'] = entry.etag
+
+    def get():
+        with io_timer("get") as timed:
+            response = get_s3_client().get_object(**kwargs)
+            body = response['Body'].read()
+            timed.nbytes = len(body)
+        return response, body
+
+    try:
+        response, body = governed("get", get)
+    except ClientError as error:
+        if entry is None or error.response['Error']['Code'] not in ('304', 'NotModified'):
+            raise
+        increment("s3.cache.revalidated")
+        entry = entry._replace(validated_at=now)
+    else:
+        increment("s3.cache.miss")
+        entry = CacheEntry(response['ETag'], body, now)
+    if len(entry.body) <= CACHE_MAX_OBJECT_BYTES:
+        _remember(cache_key, entry)
+        _write_disk_entry(cache_key, entry)
+    return entry.body
 
 
 def upload(memoryfile: StringIO, dest: S3Ref) -> None:
     """
      Upload file from local storage to s3.
     """
-    s3.upload_fileobj(BytesIO(memoryfile.getvalue().encode()), dest.bucket, dest.key)
+    upload_bytes(memoryfile.getvalue().encode(), dest)
 
 
-def get_count_with_query(source: S3Ref, query: str) -> int:
+def upload_bytes(body: bytes, dest: S3Ref) -> None:
     """
-     Run a s3_select query and return the resulting count.
+     Upload raw bytes to s3.
+    """
+    def put():
+        with io_timer("put") as timed:
+            timed.nbytes = len(body)
+            get_transfer_client().upload_fileobj(BytesIO(body), dest.bucket, dest.key)
+    governed("put", put)
+
+
+class _ChunkReader(RawIOBase):
     """
-    event_stream = s3.select_object_content(
+     Readable stream over the chunks put in a queue, None ends it and an exception aborts it.
+    """
+
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self.pending = b""
+        self.eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            if self.eof:
+                return 0
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+                return 0
+            if isinstance(chunk, BaseException):
+                raise chunk
+            self.pending = chunk
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+@contextmanager
+def upload_stream(dest: S3Ref):
+    """
+     Upload text to s3 while it is being written. Yields a write function, text is sent in
+     STREAM_CHUNK_SIZE chunks that a background thread uploads as multipart parts, and the upload
+     completes when the block exits. Nothing is stored at dest if the block raises.
+    """
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    errors = []
+    written = [0]
+
+    def run_upload():
+        try:
+            with io_timer("put") as timed:
+                reader = BufferedReader(_ChunkReader(chunks), STREAM_CHUNK_SIZE)
+                get_transfer_client().upload_fileobj(reader, dest.bucket, dest.key)
+                timed.nbytes = written[0]
+        except BaseException as e:
+            errors.append(e)
+            # Keep taking chunks so the writer never blocks on a full queue.
+            while chunks.get() is not None:
+                pass
+
+    get_transfer_client()
+    uploader = threading.Thread(target=run_upload, daemon=True)
+    uploader.start()
+    buffered = []
+    buffered_size = 0
+
+    def write(text: str) -> None:
+        nonlocal buffered_size
+        data = text.encode()
+        written[0] += len(data)
+        buffered.append(data)
+        buffered_size += len(data)
+        if buffered_size >= STREAM_CHUNK_SIZE:
+            chunks.put(b"".join(buffered))
+            buffered.clear()
+            buffered_size = 0
+
+    try:
+        yield write
+    except BaseException:
+        chunks.put(RuntimeError("Upload to {} aborted".format(dest.get_uri())))
+        chunks.put(None)
+        uploader.join()
+        raise
+    if buffered:
+        chunks.put(b"".join(buffered))
+    chunks.put(None)
+    uploader.join()
+    if errors:
+        raise errors[0]
+
+
+def _select(source: S3Ref, query: str, output_format: str, scan_range: dict = None) -> dict:
+    """
+     Start a s3_select query. Only the request is retried, its events stream to the caller.
+    """
+    kwargs = {} if scan_range is None else {'ScanRange': scan_range}
+    return governed("select", lambda: get_s3_client().select_object_content(
         Bucket=source.bucket,
         Key=source.key,
         ExpressionType='SQL',
         Expression=query,
         InputSerialization={"JSON": {"Type": "LINES"}},
-        OutputSerialization={"CSV": {}}
-    )
+        OutputSerialization={output_format: {}},
+        **kwargs
+    ))
+
 
-    count = 0
+def _iter_select_events(event_stream, timed):
+    """
+     Yield the record payloads of a s3_select event stream.
+    """
     for s3_select_event in event_stream["Payload"]:
         if 'Records' in s3_select_event:
-            count = int(s3_select_event['Records']['Payload'])
-            break
+            data = s3_select_event['Records']['Payload']
+            timed.nbytes += len(data)
+            yield data
+        elif 'Stats' in s3_select_event:
+            increment("s3.select.bytes_scanned", s3_select_event['Stats']['Details']['BytesScanned'], "Bytes")
+
+
+class SelectPlan(NamedTuple):
+    """
+     How to run a query: "local", "select" or "ranged", and the inclusive ScanRanges of a ranged plan.
+    """
+    strategy: str
+    size: int
+    ranges: list
 
-    return count
+
+def plan_select(source: S3Ref, query: str) -> SelectPlan:
+    """
+     Choose how to run a query on an object by the estimated time of each way. Queries the local
+     engine can not parse are always sent to s3_select as they are, the others are always run
+     locally once s3_select turned out to be unavailable.
+    """
+    from select_engine import SelectSyntaxError, parse
+
+    size = get_content_size(source)
+    costs = {"select": SELECT_REQUEST_SECONDS + size / SELECT_BYTES_PER_SECOND}
+    try:
+        parse(query)
+    except SelectSyntaxError:
+        return SelectPlan("select", size, [])
+    if _select_unavailable.is_set():
+        return SelectPlan("local", size, [])
+    costs["local"] = GET_REQUEST_SECONDS + size / GET_BYTES_PER_SECOND + size / LOCAL_SCAN_BYTES_PER_SECOND
+    range_count = min(SCAN_RANGE_WORKERS, size // SCAN_RANGE_MIN_BYTES)
+    if range_count > 1:
+        costs["ranged"] = SELECT_REQUEST_SECONDS + size / (range_count * SELECT_BYTES_PER_SECOND)
+    strategy = min(costs, key=costs.get)
+    ranges = []
+    if strategy == "ranged":
+        bounds = [size * i // range_count for i in range(range_count + 1)]
+        ranges = [(start, end - 1) for start, end in zip(bounds, bounds[1:])]
+    return SelectPlan(strategy, size, ranges)
+
+
+def _select_range(source: S3Ref, query: str, output_format: str, scan_range) -> bytes:
+    start, end = scan_range
+    with io_timer("select") as timed:
+        event_stream = _select(source, query, output_format, {'Start': start, 'End': end})
+        return b"".join(_iter_select_events(event_stream, timed))
+
+
+def _is_select_unavailable(error: BaseException) -> bool:
+    response = getattr(error, "response", None)
+    code = response.get("Error", {}).get("Code") if isinstance(response, dict) else None
+    return code in SELECT_UNAVAILABLE_CODES or isinstance(error, NotImplementedError)
+
+
+def _local_select_payloads(source: S3Ref, query: str, output_format: str):
+    from select_engine import select_lines
+    for record in select_lines(query, download_bytesio(source), {output_format: {}}):
+        yield record.encode('utf-8')
+
+
+def _remote_select_payloads(source: S3Ref, query: str, output_format: str, plan: SelectPlan):
+    if plan.strategy == "select":
+        with io_timer("select") as timed:
+            yield from _iter_select_events(_select(source, query, output_format), timed)
+        return
+
+    from select_engine import parse
+    limit = parse(query).limit
+    returned = 0
+    with prefetch(partial(_select_range, source, query, output_format), plan.ranges,
+                  workers=SCAN_RANGE_WORKERS, queue_size=SCAN_RANGE_WORKERS) as outputs:
+        for data in outputs:
+            if limit is not None:
+                lines = data.splitlines(keepends=True)[:limit - returned]
+                returned += len(lines)
+                data = b"".join(lines)
+            yield data
+            if limit is not None and returned >= limit:
+                return
+
+
+def _select_payloads(source: S3Ref, query: str, output_format: str):
+    """
+     Run a s3_select query as planned and yield its output in chunks. The outputs of ranges are
+     concatenated in order and cut at the LIMIT of the query, counts are left for the caller to sum.
+     When the first request finds s3_select unavailable, the query runs on the local engine.
+    """
+    plan = plan_select(source, query)
+    increment("s3.select.plan.{}".format(plan.strategy))
+    if plan.strategy == "local":
+        yield from _local_select_payloads(source, query, output_format)
+        return
+
+    payloads = _remote_select_payloads(source, query, output_format, plan)
+    try:
+        first = next(payloads)
+    except StopIteration:
+        return
+    except Exception as e:
+        from select_engine import SelectSyntaxError, parse
+        if not _is_select_unavailable(e):
+            raise
+        try:
+            parse(query)
+        except SelectSyntaxError:
+            raise e
+        logger.warning("S3 Select is unavailable ({}), running queries locally from now on.".format(e))
+        _select_unavailable.set()
+        increment("s3.select.fallback")
+        yield from _local_select_payloads(source, query, output_format)
+        return
+    yield first
+    yield from payloads
+
+
+def get_count_with_query(source: S3Ref, query: str) -> int:
+    """
+     Run a s3_select query and return the resulting count.
+    """
+    # One count per range of a ranged plan.
+    return sum(int(count) for count in b"".join(_select_payloads(source, query, "CSV")).split())
+
+
+def list_contents(prefix_s3_ref: S3Ref):
+    """
+    Yield the listing entries (Key, Size, ETag) of the objects under the prefix.
+    """
+    kwargs = {'Bucket': prefix_s3_ref.bucket, 'Prefix': prefix_s3_ref.key}
+    while True:
+        # A single response holds at most 1000 keys.
+        def list_page():
+            with io_timer("list"):
+                return get_s3_client().list_objects_v2(**kwargs)
+        response = governed("list", list_page)
+        yield from response.get('Contents', [])
+        if not response.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
 
 
 def get_uris_inside_prefix(prefix_s3_ref: S3Ref):
     """
     Return a list of URIs corresponding to the contents within the prefix (not recursive)
     """
-    response = s3.list_objects_v2(Bucket=prefix_s3_ref.bucket, Prefix=prefix_s3_ref.key)
-    files = [content['Key'] for content in response['Contents']]
-    return files
+    return [content['Key'] for content in list_contents(prefix_s3_ref)]
+
+
+def get_etags_inside_prefix(prefix_s3_ref: S3Ref) -> dict:
+    """
+    Return the ETag of every object under the prefix by key, at one request per 1000 objects.
+    """
+    return {content['Key']: content['ETag'] for content in list_contents(prefix_s3_ref)}
 
 
 def query_helper(source: S3Ref, query: str, dest: S3Ref = None,
@@ -139,21 +622,8 @@ def query_helper(source: S3Ref, query: str, dest: S3Ref = None,
         temp file before uploading to the destination s3.
     """
 
-    event_stream = s3.select_object_content(
-        Bucket=source.bucket,
-        Key=source.key,
-        ExpressionType='SQL',
-        Expression=query,
-        InputSerialization={"JSON": {"Type": "LINES"}},
-        OutputSerialization={"JSON": {}}
-    )
-
-    # Iterate over events in the event stream as they come
-    output = StringIO()
-    for s3_select_event in event_stream["Payload"]:
-        if 'Records' in s3_select_event:
-            data = s3_select_event['Records']['Payload']
-            output.write(data.decode('utf-8'))
+    # Payloads may split a multi-byte character, they are decoded together.
+    output = StringIO(b"".join(_select_payloads(source, query, "JSON")).decode('utf-8'))
 
     if transform:
         output.seek(0)
@@ -164,6 +634,23 @@ def query_helper(source: S3Ref, query: str, dest: S3Ref = None,
     return output
 
 
+def iter_query_lines(source: S3Ref, query: str):
+    """
+     Run a s3_select query and yield the resulting JSON lines as they arrive, without holding
+     the whole result in memory. The select time includes the time spent by the caller on each line.
+    """
+    # Records are split across payloads at arbitrary bytes.
+    pending = b""
+    for data in _select_payloads(source, query, "JSON"):
+        lines = (pending + data).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line.decode('utf-8')
+    if pending.strip():
+        yield pending.decode('utf-8')
+
+
 def download_with_query(source: S3Ref, query: str) -> StringIO:
     """
      download only the contents in source which match the query
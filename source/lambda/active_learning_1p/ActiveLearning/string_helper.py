@@ -12,7 +12,7 @@ def generate_random_string(size=8, chars=string.ascii_letters + string.digits) -
 
 
 def generate_job_id_and_s3_path(id_prefix, s3_folder_uri,
-                                job_type="active-learning") -> Tuple[str, str]:
+                                job_type="active-learning", fingerprint=None) -> Tuple[str, str]:
     """
     generate a pair of job_id and s3_uri where the ouput of the job is to be stored.
         the id_prefix is used as a prefix for the job.
@@ -20,8 +20,11 @@ def generate_job_id_and_s3_path(id_prefix, s3_folder_uri,
         the job_type can be anything to represent the type of job.
              - "active-learning" job_type is used for training and transform jobs.
              - "labeling-job" job_type is used for manual labeling prefix.
+        the fingerprint, when given, replaces the random suffix of the output folder so that the
+        same inputs always map to the same folder. See idempotency.get_fingerprint. The job keeps
+        a random suffix: SageMaker job names are unique per account and region and can never be
+        reused, also after the job failed.
     """
-    suffix = generate_random_string()
-    job_id = "{}-{}".format(id_prefix, suffix)
-    s3_uri = '{}{}-{}/'.format(s3_folder_uri, job_type, suffix)
+    job_id = "{}-{}".format(id_prefix, generate_random_string())
+    s3_uri = '{}{}-{}/'.format(s3_folder_uri, job_type, fingerprint or generate_random_string())
     return job_id, s3_uri
@@ -0,0 +1,143 @@
+'''
+Incremental RecordIO shards of the training data.
+
+Training used to read an augmented manifest of the full resolution images, so every training
+job downloaded and decoded every labeled image again. The images are instead resized once,
+so that their shorter side is image_shape, and packed with their boxes into RecordIO shards
+kept under <IntermediateFolderUri>training-shards/<channel>/. A shards.json file there
+records the label digest of every record of every shard. Each iteration only packs the rows
+which are new or whose label changed. A shard holding a changed or removed record is
+replaced by a new shard of its remaining records, copied without decoding them again. Shards
+are never overwritten or deleted, so a training job can keep reading the shard set it was
+given. Each job reads a ManifestFile which lists the shards of the current set.
+'''
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from ActiveLearning.image_cache import resize_image
+from ActiveLearning.s3_helper import S3Ref, download_bytesio, upload_bytes
+from metrics import increment
+from recordio import encode_record, iter_records, pack_image_record, unpack_image_record
+
+SHARD_FOLDER = "training-shards/"
+STATE_FILE = "shards.json"
+SHARD_MAX_BYTES = 64 * 1024 * 1024
+SHARD_WORKERS = 16
+# Leading label values of an im2rec detection record: header width and object width.
+DETECTION_LABEL_HEADER = [2.0, 5.0]
+
+logger = logging.getLogger()
+
+
+def get_label_digest(row, label_attribute_name):
+    """
+    Digest of what a record contributes to training: its image and its boxes.
+    """
+    content = json.dumps([row["source-ref"], row.get(label_attribute_name)], sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def get_detection_labels(label, image_width, image_height):
+    """
+    Return the im2rec detection labels of a bounding box label: the header, then class and
+    normalized corners of each box.
+    """
+    labels = list(DETECTION_LABEL_HEADER)
+    for annotation in label.get("annotations", []):
+        left = float(annotation["left"]) / image_width
+        top = float(annotation["top"]) / image_height
+        labels += [float(annotation["class_id"]), left, top,
+                   left + float(annotation["width"]) / image_width,
+                   top + float(annotation["height"]) / image_height]
+    return labels
+
+
+def pack_row(row, label_attribute_name, image_shape):
+    image_bytes = download_bytesio(S3Ref.from_uri(row["source-ref"])).getvalue()
+    image_bytes, image_size = resize_image(image_bytes, image_shape)
+    labels = get_detection_labels(row[label_attribute_name], image_size["width"], image_size["height"])
+    return encode_record(pack_image_record(row["id"], labels, image_bytes))
+
+
+def read_state(folder, label_attribute_name, image_shape):
+    """
+    Return the shards of the folder, none when it holds shards of another configuration.
+    """
+    from botocore.exceptions import ClientError
+    try:
+        state = json.loads(download_bytesio(S3Ref.from_uri(folder + STATE_FILE)).getvalue())
+    except ClientError:
+        return []
+    if state.get("label_attribute_name") != label_attribute_name or state.get("image_shape") != image_shape:
+        return []
+    return state["shards"]
+
+
+def write_shard(folder, records):
+    """
+    Upload a shard of (record_id, digest, record) and return its state. The key is derived
+    from the records so that a retried build writes the same objects.
+    """
+    digests = {str(record_id): digest for record_id, digest, _ in records}
+    name = hashlib.sha1(json.dumps(digests, sort_keys=True).encode()).hexdigest()[:20]
+    key = "shard-{}.rec".format(name)
+    upload_bytes(b"".join(record for _, _, record in records), S3Ref.from_uri(folder + key))
+    return {"key": key, "records": digests}
+
+
+def build_shards(rows, folder, label_attribute_name, image_shape):
+    """
+    Bring the shard set in folder up to date with the labeled rows and return its shards.
+    """
+    wanted = {}
+    for row in rows:
+        wanted[row["id"]] = (get_label_digest(row, label_attribute_name), row)
+
+    shards, carried = [], []
+    for shard in read_state(folder, label_attribute_name, image_shape):
+        valid = {int(record_id) for record_id, digest in shard["records"].items()
+                 if record_id.isdigit() and wanted.get(int(record_id), (None,))[0] == digest}
+        if len(valid) == len(shard["records"]):
+            shards.append(shard)
+        elif valid:
+            for record in iter_records(download_bytesio(S3Ref.from_uri(folder + shard["key"])).getvalue()):
+                record_id = unpack_image_record(record)[0]
+                if record_id in valid:
+                    carried.append((record_id, wanted[record_id][0], encode_record(record)))
+        for record_id in valid:
+            wanted.pop(record_id, None)
+    logger.info("Reusing {} shards, repacking {} records, packing {} new records.".format(
+        len(shards), len(carried), len(wanted)))
+
+    pending = sorted(wanted.items())
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+        packed = executor.map(lambda item: pack_row(item[1][1], label_attribute_name, image_shape), pending)
+        new_records = ((record_id, digest, record) for (record_id, (digest, _)), record in zip(pending, packed))
+        batch, batch_bytes = [], 0
+        for entry in chain(carried, new_records):
+            if batch and batch_bytes + len(entry[2]) > SHARD_MAX_BYTES:
+                shards.append(write_shard(folder, batch))
+                batch, batch_bytes = [], 0
+            batch.append(entry)
+            batch_bytes += len(entry[2])
+        if batch:
+            shards.append(write_shard(folder, batch))
+    increment("training_shards.packed", len(pending))
+    increment("training_shards.repacked", len(carried))
+
+    state = {"label_attribute_name": label_attribute_name, "image_shape": image_shape, "shards": shards}
+    upload_bytes(json.dumps(state).encode(), S3Ref.from_uri(folder + STATE_FILE))
+    return shards
+
+
+def write_shard_manifest(folder, shards, dest):
+    """
+    Write the ManifestFile of a training channel, which lists the shards it reads, and
+    return the number of records in them.
+    """
+    manifest = [{"prefix": folder}] + [shard["key"] for shard in shards]
+    upload_bytes(json.dumps(manifest).encode(), dest)
+    return sum(len(shard["records"]) for shard in shards)
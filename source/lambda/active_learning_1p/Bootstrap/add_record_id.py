@@ -1,4 +1,7 @@
 from s3_helper import S3Ref, download_stringio, upload
+from metrics import instrument_handler, timer
+from profiling import profile_handler
+from label_state import LabelStateIndex, get_label_state, save_label_state_index
 import json
 from io import StringIO
 
@@ -8,27 +11,39 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function adds a sequential id to each record in the input manifest.
+    With LabelAttributeName, the label state index of the manifest is written as well.
     """
     s3_input_uri = event['ManifestS3Uri']
     s3_input = S3Ref.from_uri(s3_input_uri)
+    label_attribute_name = event.get('LabelAttributeName')
+    label_states = bytearray()
 
-    inp_file = download_stringio(s3_input)
+    with timer("download"):
+        inp_file = download_stringio(s3_input)
     logger.info("Downloaded file from {} to {}".format(s3_input_uri, inp_file))
 
     out_file = StringIO()
     total = 0
-    for processed_id_count, line in enumerate(inp_file):
-        data = json.loads(line)
-        data["id"] = processed_id_count
-        out_file.write(json.dumps(data) + "\n")
-        total += 1
+    with timer("add_ids"):
+        for processed_id_count, line in enumerate(inp_file):
+            data = json.loads(line)
+            data["id"] = processed_id_count
+            out_file.write(json.dumps(data) + "\n")
+            if label_attribute_name:
+                label_states.append(get_label_state(data, label_attribute_name))
+            total += 1
     logger.info("Added id field to {} records".format(total))
 
     # Uploading back to the same location where we downloaded the file from.
-    upload(out_file, s3_input)
+    with timer("upload"):
+        upload(out_file, s3_input)
     logger.info("Uploaded updated file from {} to {}".format(
         out_file, s3_input_uri))
+    if label_attribute_name:
+        save_label_state_index(s3_input, LabelStateIndex(label_attribute_name, label_states))
     return event
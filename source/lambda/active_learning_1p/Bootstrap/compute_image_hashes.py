@@ -0,0 +1,55 @@
+from s3_helper import S3Ref, download_bytesio, download_stringio
+from metrics import increment, instrument_handler, set_value, timer
+from profiling import profile_handler
+from near_duplicates import NearDuplicateIndex, difference_hash, load_near_duplicate_index, save_near_duplicate_index
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+HASH_WORKERS = 16
+
+
+def hash_source(source_ref):
+    """
+    Return the hash and size of an image, (None, None) when it can not be read or decoded.
+    """
+    try:
+        return difference_hash(download_bytesio(S3Ref.from_uri(source_ref)).getvalue())
+    except Exception as e:
+        logger.warning("Could not hash {}: {}".format(source_ref, e))
+        return None, None
+
+
+@instrument_handler
+@profile_handler
+def lambda_handler(event, context):
+    """
+    This function computes the perceptual hash of every image in the manifest and groups
+    near-duplicate images, once per manifest.
+    """
+    s3_input = S3Ref.from_uri(event['ManifestS3Uri'])
+
+    with timer("download"):
+        source_refs = [json.loads(line)['source-ref'] for line in download_stringio(s3_input) if line.strip()]
+    index = load_near_duplicate_index(s3_input)
+    if index is not None and len(index) == len(source_refs):
+        logger.info("Near-duplicate index of {} is up to date.".format(s3_input.get_uri()))
+        return event
+
+    with timer("hash"):
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            hashed = list(executor.map(hash_source, source_refs))
+    hashes = [value for value, _ in hashed]
+    increment("near_duplicates.unreadable", hashes.count(None))
+
+    with timer("cluster"):
+        index = NearDuplicateIndex.from_hashes(hashes, [image_size for _, image_size in hashed])
+    clusters = len(set(index.representatives))
+    set_value("near_duplicates.clusters", clusters, "Count")
+    logger.info("Grouped {} images into {} clusters of near-duplicates.".format(len(hashes), clusters))
+    save_near_duplicate_index(s3_input, index)
+    return event
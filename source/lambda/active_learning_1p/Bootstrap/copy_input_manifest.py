@@ -1,4 +1,6 @@
 from s3_helper import S3Ref, get_content_size, copy
+from metrics import instrument_handler, timer
+from profiling import profile_handler
 
 import logging
 
@@ -15,6 +17,8 @@ def validate_output_path(s3_output_uri):
         raise Exception("S3OutputPath should end with '/'.")
 
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function does a copy of the input manifest to the a location within the specified output path
@@ -49,7 +53,8 @@ def lambda_handler(event, context):
     dest = S3Ref.from_uri(intermediate_file_uri)
     logger.info("Copying s3 file from {} to {}".format(
         s3_input_uri, intermediate_file_uri))
-    copy(source, dest)
+    with timer("copy"):
+        copy(source, dest)
     logger.info("Copied s3 file from {} to {}".format(
         s3_input_uri, intermediate_file_uri))
 
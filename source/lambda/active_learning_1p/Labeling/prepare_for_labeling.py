@@ -1,5 +1,9 @@
 from s3_helper import S3Ref, copy_with_query
 from string_helper import generate_job_id_and_s3_path
+from idempotency import get_completed_result, get_fingerprint, mark_completed
+from label_state import UNLABELED, load_label_state_index
+from metrics import instrument_handler, timer
+from profiling import profile_handler
 
 import logging
 
@@ -24,6 +28,23 @@ def get_unlabeled_subset_count(input_total, human_label_done_count):
     return unlabeled_subset_count
 
 
+def get_unlabeled_query(source, label_attribute_name, unlabeled_subset_count):
+    """
+    Return the query of the unlabeled records to label. With a current label state index the
+    records are picked from the index and selected by id, otherwise by their missing label.
+    """
+    index = load_label_state_index(source, label_attribute_name)
+    unlabeled_ids = index.first_ids(UNLABELED, unlabeled_subset_count) if index is not None else []
+    if not unlabeled_ids:
+        return """select * from s3object[*] s where s."{}" is missing LIMIT {}""".format(
+            label_attribute_name, unlabeled_subset_count)
+    # Ids follow the manifest order, so the query stops at the row of the last id.
+    return """select * from s3object[*] s where s."id" IN ({}) LIMIT {}""".format(
+        ", ".join(str(record_id) for record_id in unlabeled_ids), len(unlabeled_ids))
+
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     Creates necessary input parameters for the first human labeling job so that after the job
@@ -38,19 +59,30 @@ def lambda_handler(event, context):
 
     unlabeled_subset_count = get_unlabeled_subset_count(input_total, human_label_done_count)
 
+    fingerprint = get_fingerprint([s3_input_uri], {
+        'LabelingJobNamePrefix': job_name_prefix,
+        'LabelAttributeName': label_attribute_name,
+        'unlabeled_subset_count': unlabeled_subset_count
+    })
+    labeling_job_name, labeling_job_output_uri = generate_job_id_and_s3_path(
+        job_name_prefix, intermediate_folder_uri, "labeling-job", fingerprint)
+    completed_result = get_completed_result(labeling_job_output_uri, "prepare_for_labeling", fingerprint)
+    if completed_result is not None:
+        return dict(completed_result, labeling_job_name=labeling_job_name)
+
     source = S3Ref.from_uri(s3_input_uri)
     dest = S3Ref.from_uri(intermediate_folder_uri + "human_input.manifest")
-    unlabeled_query = """select * from s3object[*] s where s."{}" is missing LIMIT {}""".format(
-        label_attribute_name, unlabeled_subset_count)
-    copy_with_query(source, dest, unlabeled_query)
+    with timer("query"):
+        unlabeled_query = get_unlabeled_query(source, label_attribute_name, unlabeled_subset_count)
+        copy_with_query(source, dest, unlabeled_query)
     human_input_s3_uri = dest.get_uri()
     logging.info("Copied {} unlabled objects from {} to {}".format(
         unlabeled_subset_count, s3_input_uri, human_input_s3_uri))
-    labeling_job_name, labeling_job_output_uri = generate_job_id_and_s3_path(
-        job_name_prefix, intermediate_folder_uri, "labeling-job")
 
-    return {
+    result = {
         "human_input_s3_uri": human_input_s3_uri,
         "labeling_job_name": labeling_job_name,
         "labeling_job_output_uri": labeling_job_output_uri,
     }
+    mark_completed(labeling_job_output_uri, "prepare_for_labeling", fingerprint, result)
+    return result
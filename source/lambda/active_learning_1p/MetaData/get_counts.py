@@ -1,5 +1,8 @@
 from functools import partial
 from s3_helper import S3Ref, get_count_with_query
+from metrics import instrument_handler, timer
+from label_state import load_label_state_index
+from profiling import profile_handler
 
 import logging
 
@@ -7,6 +10,21 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+def count_with_queries(source, label_attribute_name):
+    """
+     Count records with S3 Select when the manifest has no current label state index.
+    """
+    manifest_count = partial(get_count_with_query, source)
+    total_query = "select count(*) from s3object s"
+    human_labeled_query = """select count(*) from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes')""".format(
+        label_attribute_name)
+    auto_labeled_query = """select count(*) from s3object[*] s where s."{}-metadata"."human-annotated" IN ('no')""".format(
+        label_attribute_name)
+    return manifest_count(total_query), manifest_count(human_labeled_query), manifest_count(auto_labeled_query)
+
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function returns the counts of the labeling job records
@@ -21,17 +39,17 @@ def lambda_handler(event, context):
     s3_input_uri = meta_data['IntermediateManifestS3Uri']
 
     source = S3Ref.from_uri(s3_input_uri)
-    manifest_count = partial(get_count_with_query, source)
     logger.info("Getting counts from {}".format(s3_input_uri))
-    total_query = "select count(*) from s3object s"
-    human_labeled_query = """select count(*) from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes')""".format(
-        label_attribute_name)
-    auto_labeled_query = """select count(*) from s3object[*] s where s."{}-metadata"."human-annotated" IN ('no')""".format(
-        label_attribute_name)
-
-    manifest_size = manifest_count(total_query)
-    human_labeled_count = manifest_count(human_labeled_query)
-    auto_labeled_count = manifest_count(auto_labeled_query)
+    with timer("count"):
+        index = load_label_state_index(source, label_attribute_name)
+        if index is not None:
+            indexed_counts = index.get_counts()
+            manifest_size = indexed_counts["input_total"]
+            human_labeled_count = indexed_counts["human_label"]
+            auto_labeled_count = indexed_counts["auto_label"]
+        else:
+            manifest_size, human_labeled_count, auto_labeled_count = count_with_queries(
+                source, label_attribute_name)
     unlabeled_count = manifest_size - (auto_labeled_count + human_labeled_count)
     human_label_percentage = int(human_labeled_count * 100.0 / manifest_size)
     counts = {
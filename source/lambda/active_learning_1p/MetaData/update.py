@@ -1,6 +1,11 @@
 import json
 
+from metrics import instrument_handler
+from profiling import profile_handler
 
+
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function is used to update the meta_data values based on active learning logic output.
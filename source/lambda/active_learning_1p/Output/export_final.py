@@ -1,10 +1,14 @@
 from s3_helper import S3Ref, copy
+from metrics import instrument_handler, timer
+from profiling import profile_handler
 
 import logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function is used to copy the final completed manifest to the output location.
@@ -15,7 +19,8 @@ def lambda_handler(event, context):
     s3_output_uri = event['FinalOutputS3Uri'] + "final_output.manifest"
     dest = S3Ref.from_uri(s3_output_uri)
 
-    copy(source, dest)
+    with timer("copy"):
+        copy(source, dest)
     logger.info("Copied s3 file from {} to {}".format(
         s3_input_uri, s3_output_uri))
     return dest.get_uri()
@@ -1,6 +1,9 @@
 import json
 from collections import OrderedDict
-from s3_helper import S3Ref, download_stringio, upload
+from s3_helper import S3Ref, download_stringio, get_etag, upload
+from metrics import instrument_handler, timer, increment
+from label_state import LabelStateIndex, read_label_state_index, save_label_state_index
+from profiling import profile_handler
 
 import logging
 from io import StringIO
@@ -8,10 +11,25 @@ from io import StringIO
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def merge_manifests(full_input, partial_output):
+
+def is_human_annotated(data):
+    """
+    True if any label attribute of the record was annotated by a human.
     """
-    This method merges the output from partial output manifest to the full input
-    to create the complete manifest.
+    for key, value in data.items():
+        if key.endswith("-metadata") and isinstance(value, dict) and value.get("human-annotated") == "yes":
+            return True
+    return False
+
+
+def merge_manifests(full_input, *partial_outputs, updated_ids=None):
+    """
+    This method merges the output from partial output manifests to the full input
+    to create the complete manifest. Records are reconciled by id, in the order the
+    partial outputs are given, except that a human annotated record is never replaced
+    by a machine annotated one. Machine labels computed while the record was being
+    labeled by humans are dropped instead. The ids of replaced records are added to
+    updated_ids when it is given.
     """
     complete_manifest = OrderedDict()
     for line in full_input:
@@ -20,32 +38,79 @@ def merge_manifests(full_input, partial_output):
     logger.info("Loaded input manifest of size {} to memory.".format(
         len(complete_manifest)))
 
-    for line in partial_output:
-        data = json.loads(line)
-        complete_manifest[data["id"]] = data
+    superseded = 0
+    for partial_output in partial_outputs:
+        for line in partial_output:
+            data = json.loads(line)
+            current = complete_manifest.get(data["id"])
+            if current is not None and is_human_annotated(current) and not is_human_annotated(data):
+                superseded += 1
+                continue
+            complete_manifest[data["id"]] = data
+            if updated_ids is not None:
+                updated_ids.add(data["id"])
+    if superseded:
+        logger.info("Kept human labels over {} machine labels.".format(superseded))
+        increment("superseded_autoannotations", superseded)
     logger.info("Updated partial output in memory.")
     return complete_manifest
 
+@instrument_handler
+@profile_handler
 def lambda_handler(event, context):
     """
     This function is used to merge partial outputs to the manifest.
     The result is uploaded to s3.
+    When AutoAnnotationsS3Uri is set, autoannotations computed while the labeling job of
+    OutputS3Uri was running are merged in the same pass.
     """
     s3_input_uri = event['ManifestS3Uri']
     source = S3Ref.from_uri(s3_input_uri)
-    full_input = download_stringio(source)
-
-    s3_output_uri = event['OutputS3Uri']
-    output = S3Ref.from_uri(s3_output_uri)
-    partial_output = download_stringio(output)
+    s3_output_uris = [event['OutputS3Uri']]
+    if event.get('AutoAnnotationsS3Uri'):
+        # Autoannotations go first so that human labels of the same records take precedence.
+        s3_output_uris.insert(0, event['AutoAnnotationsS3Uri'])
+    with timer("download"):
+        manifest_etag = get_etag(source)
+        full_input = download_stringio(source)
+        partial_outputs = [download_stringio(S3Ref.from_uri(s3_output_uri)) for s3_output_uri in s3_output_uris]
 
     logger.info("Downloaded input and output manifests {}, {}".format(
-        s3_input_uri, s3_output_uri))
+        s3_input_uri, ", ".join(s3_output_uris)))
 
-    complete_manifest = merge_manifests(full_input, partial_output)
+    updated_ids = set()
+    with timer("merge"):
+        complete_manifest = merge_manifests(full_input, *partial_outputs, updated_ids=updated_ids)
     #write complete manifest back to s3 bucket
     merged = StringIO()
-    for line in complete_manifest.values():
-        merged.write(json.dumps(line) + "\n")
-    upload(merged, source)
+    with timer("serialize"):
+        for line in complete_manifest.values():
+            merged.write(json.dumps(line) + "\n")
+    with timer("upload"):
+        upload(merged, source)
     logger.info("Uploaded merged file to {}".format(source.get_uri()))
+
+    with timer("index"):
+        update_label_state_index(source, manifest_etag, complete_manifest, updated_ids)
+
+
+def update_label_state_index(source, manifest_etag, complete_manifest, updated_ids):
+    """
+    Bring the label state index of the manifest up to date with the merge. Only the updated
+    records are reindexed when the index described the manifest before the merge.
+    Manifests which were never indexed are left alone.
+    """
+    index = read_label_state_index(source)
+    if index is None:
+        return
+    try:
+        if index.manifest_etag == manifest_etag:
+            index.update(complete_manifest[record_id] for record_id in updated_ids)
+        else:
+            index = LabelStateIndex.from_rows(complete_manifest.values(), index.label_attribute_name)
+    except ValueError as e:
+        # Leaves the stale index, which readers detect through the manifest ETag.
+        logger.warning("Could not index label states of {}: {}".format(source.get_uri(), e))
+        return
+    save_label_state_index(source, index)
+    logger.info("Indexed label states of {} updated records".format(len(updated_ids)))
@@ -0,0 +1,47 @@
+'''
+Compare two benchmark result files written by benchmarks.run.
+
+    python -m benchmarks.compare baseline.json candidate.json
+'''
+import argparse
+import json
+
+METRICS = ("wall_seconds", "rows_per_second", "peak_rss_mb", "tracemalloc_peak_mb")
+
+
+def load_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    return {(result["case"], result["scale"]): result for result in results["results"]}
+
+
+def compare(baseline, candidate):
+    """
+    Yield (case, scale, metric, baseline value, candidate value, ratio) for every shared measurement.
+    """
+    for key in sorted(set(baseline) & set(candidate)):
+        for metric in METRICS:
+            before = baseline[key].get(metric)
+            after = candidate[key].get(metric)
+            if before is None or after is None:
+                continue
+            ratio = after / before if before else None
+            yield key[0], key[1], metric, before, after, ratio
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args(argv)
+
+    row_format = "{:<45} {:>9} {:<20} {:>12} {:>12} {:>8}"
+    print(row_format.format("case", "scale", "metric", "baseline", "candidate", "ratio"))
+    for case_name, scale, metric, before, after, ratio in compare(load_results(args.baseline),
+                                                                  load_results(args.candidate)):
+        print(row_format.format(case_name, scale, metric, "{:.3f}".format(before), "{:.3f}".format(after),
+                                "-" if ratio is None else "{:.2f}x".format(ratio)))
+
+
+if __name__ == "__main__":
+    main()
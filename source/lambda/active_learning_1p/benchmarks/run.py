@@ -0,0 +1,312 @@
+'''
+Benchmark the lambda handlers against synthetic datasets stored in the local storage stand-in.
+
+Every (case, scale) pair runs in a fresh interpreter so that peak RSS is not polluted by
+other cases. Dataset generation and case setup are never part of a measurement.
+
+    python -m benchmarks.run --scales 10000 100000 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime
+
+from benchmarks import synthetic
+
+LAMBDA_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_ROOT = os.path.join(LAMBDA_ROOT, "dependency", "python")
+RESULTS_SCHEMA_VERSION = 1
+DEFAULT_SCALES = [10000, 100000]
+DEFAULT_WORKDIR = os.path.join("/tmp", "byoal-benchmarks")
+
+CASES = {}
+
+
+def case(name):
+    """
+    Register a benchmark case. The decorated function receives the storage root, does any
+    setup it needs and returns a (run, rows) pair where run() is the measured callable.
+    """
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def copy_to_work_key(root, key):
+    from s3_helper import S3Ref, copy
+    source = S3Ref(synthetic.BUCKET, key)
+    dest = S3Ref(synthetic.BUCKET, "work/" + key)
+    copy(source, dest)
+    return dest.get_uri()
+
+
+def read_dataset_description(root):
+    with open(os.path.join(root, "dataset.json")) as f:
+        return json.load(f)
+
+
+def collect_aligned_inputs():
+    from ActiveLearning.perform_active_learning import (
+        collect_inference_inputs, collect_inference_outputs_from_prefix, align_manifest_and_inference_output_dicts)
+    inference_input_s3_ref, inference_input, manifest_dicts = collect_inference_inputs(
+        synthetic.s3_uri(synthetic.UNLABELED_MANIFEST_KEY))
+    inference_output_s3_refs, inference_output_dicts = zip(*collect_inference_outputs_from_prefix(
+        synthetic.s3_uri(synthetic.TRANSFORM_OUTPUT_PREFIX)))
+    return (inference_input_s3_ref, inference_input, manifest_dicts,
+            align_manifest_and_inference_output_dicts(manifest_dicts, inference_output_s3_refs, inference_output_dicts))
+
+
+def make_image_active_learning():
+    from ActiveLearning.helper import ImageActiveLearning
+    return ImageActiveLearning("labeling-job/bench", synthetic.LABEL_ATTRIBUTE_NAME, synthetic.CLASS_MAP, 1000)
+
+
+@case("add_record_id")
+def setup_add_record_id(root):
+    from Bootstrap.add_record_id import lambda_handler
+    event = {'ManifestS3Uri': copy_to_work_key(root, synthetic.INPUT_MANIFEST_KEY)}
+    return lambda: lambda_handler(event, {}), read_dataset_description(root)["rows"]
+
+
+@case("merge_manifests")
+def setup_merge_manifests(root):
+    from Output.export_partial import lambda_handler
+    event = {
+        'ManifestS3Uri': copy_to_work_key(root, synthetic.INTERMEDIATE_MANIFEST_KEY),
+        'OutputS3Uri': synthetic.s3_uri(synthetic.PARTIAL_OUTPUT_KEY)
+    }
+    return lambda: lambda_handler(event, {}), read_dataset_description(root)["rows"]
+
+
+@case("align_manifest_and_inference_output_dicts")
+def setup_align(root):
+    from ActiveLearning.perform_active_learning import (
+        collect_inference_inputs, collect_inference_outputs_from_prefix, align_manifest_and_inference_output_dicts)
+    _, _, manifest_dicts = collect_inference_inputs(synthetic.s3_uri(synthetic.UNLABELED_MANIFEST_KEY))
+    inference_output_s3_refs, inference_output_dicts = zip(*collect_inference_outputs_from_prefix(
+        synthetic.s3_uri(synthetic.TRANSFORM_OUTPUT_PREFIX)))
+
+    def run():
+        align_manifest_and_inference_output_dicts(manifest_dicts, inference_output_s3_refs, inference_output_dicts)
+    return run, len(manifest_dicts)
+
+
+@case("autoannotate")
+def setup_autoannotate(root):
+    _, _, _, (sources, _, predictions) = collect_aligned_inputs()
+    image_al = make_image_active_learning()
+    return lambda: image_al.autoannotate(predictions, sources), len(sources)
+
+
+@case("postprocess_predictions")
+def setup_postprocess_predictions(root):
+    from ActiveLearning.postprocess import POSTPROCESS_BATCH_SIZE, postprocess_predictions
+    _, _, _, (sources, _, predictions) = collect_aligned_inputs()
+    boxes = [prediction['prediction'] for prediction in predictions]
+
+    def run():
+        for start in range(0, len(boxes), POSTPROCESS_BATCH_SIZE):
+            postprocess_predictions(boxes[start:start + POSTPROCESS_BATCH_SIZE])
+    return run, len(sources)
+
+
+@case("stream_autoannotations")
+def setup_stream_autoannotations(root):
+    """
+    Download, parse, join and autoannotate every transform output in one pass, as the handler does.
+    """
+    from ActiveLearning.perform_active_learning import (
+        collect_inference_inputs, collect_inference_outputs_from_prefix, join_manifest_and_inference_outputs,
+        write_auto_annotations)
+    inference_input_s3_ref, _, manifest_dicts = collect_inference_inputs(
+        synthetic.s3_uri(synthetic.UNLABELED_MANIFEST_KEY))
+    image_al = make_image_active_learning()
+
+    def run():
+        inference_outputs = collect_inference_outputs_from_prefix(synthetic.s3_uri(synthetic.TRANSFORM_OUTPUT_PREFIX))
+        write_auto_annotations(image_al, join_manifest_and_inference_outputs(manifest_dicts, inference_outputs),
+                               inference_input_s3_ref)
+    return run, len(manifest_dicts)
+
+
+@case("write_selector_file")
+def setup_write_selector_file(root):
+    from ActiveLearning.helper import AUTOANNOTATION_THRESHOLD
+    from ActiveLearning.perform_active_learning import write_selector_file
+    inference_input_s3_ref, _, manifest_dicts, (sources, _, predictions) = collect_aligned_inputs()
+    # Stand in for the autoannotations so that only the selection is measured.
+    auto_annotation_ids = [source['id'] for source, prediction in zip(sources, predictions)
+                           if all(box[1] >= AUTOANNOTATION_THRESHOLD for box in prediction['prediction'])]
+    image_al = make_image_active_learning()
+
+    def run():
+        write_selector_file(image_al, manifest_dicts, inference_input_s3_ref, auto_annotation_ids)
+    return run, len(manifest_dicts)
+
+
+@case("select_engine")
+def setup_select_engine(root):
+    """
+    Run the human labeled query of PrepareForTraining on the local engine, as the fallback does.
+    """
+    from s3_helper import S3Ref, download_bytesio
+    from select_engine import select_lines
+    body = download_bytesio(S3Ref(synthetic.BUCKET, synthetic.INTERMEDIATE_MANIFEST_KEY)).getvalue()
+    query = """select * from s3object[*] s where s."{}-metadata"."human-annotated" IN ('yes')""".format(
+        synthetic.LABEL_ATTRIBUTE_NAME)
+
+    def run():
+        for _ in select_lines(query, body.splitlines(keepends=True), {'JSON': {}}):
+            pass
+    return run, read_dataset_description(root)["rows"]
+
+
+def reset_peak_rss():
+    """
+    Reset the kernel's peak RSS counter for this process so setup memory is not reported.
+    Returns False where that is not supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_rss_mb():
+    """
+    Return the (current, peak) resident set size in MB.
+    """
+    try:
+        values = {}
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value, _ = line.split()
+                    values[name] = int(value) / 1024.0
+        return values["VmRSS:"], values["VmHWM:"]
+    except (OSError, KeyError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        return peak, peak
+
+
+def run_case_in_process(case_name, root, trace_allocations):
+    """
+    Set up and measure a single case in the current process and return its measurements.
+    """
+    os.environ["BYOAL_LOCAL_S3_ROOT"] = root
+    run, rows = CASES[case_name](root)
+    if trace_allocations:
+        tracemalloc.start()
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "tracemalloc_peak_mb": peak / 1024.0 / 1024.0,
+            "tracemalloc_retained_mb": current / 1024.0 / 1024.0
+        }
+
+    rss_before_mb, _ = read_rss_mb()
+    peak_reset = reset_peak_rss()
+    start = time.perf_counter()
+    run()
+    wall_seconds = time.perf_counter() - start
+    _, peak_rss_mb = read_rss_mb()
+    return {
+        "rows": rows,
+        "wall_seconds": wall_seconds,
+        "rows_per_second": rows / wall_seconds if wall_seconds > 0 else None,
+        "rss_before_mb": rss_before_mb,
+        "peak_rss_mb": peak_rss_mb,
+        "peak_rss_includes_setup": not peak_reset
+    }
+
+
+def run_case_in_subprocess(case_name, root, trace_allocations):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([LAMBDA_ROOT, LAYER_ROOT])
+    command = [sys.executable, "-m", "benchmarks.run", "--child", case_name, root]
+    if trace_allocations:
+        command.append("--trace-allocations")
+    result = subprocess.run(command, cwd=LAMBDA_ROOT, env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def prepare_dataset(workdir, scale, seed):
+    root = os.path.join(workdir, "rows-{}-seed-{}".format(scale, seed))
+    description_path = os.path.join(root, "dataset.json")
+    if not os.path.exists(description_path):
+        print("Generating synthetic dataset with {} rows in {}".format(scale, root), file=sys.stderr)
+        synthetic.generate_dataset(root, scale, seed=seed)
+    return root
+
+
+def run_benchmarks(case_names, scales, workdir, seed, trace_allocations):
+    results = []
+    for scale in scales:
+        root = prepare_dataset(workdir, scale, seed)
+        for case_name in case_names:
+            print("Running {} at {} rows".format(case_name, scale), file=sys.stderr)
+            result = {"case": case_name, "scale": scale}
+            result.update(run_case_in_subprocess(case_name, root, False))
+            if trace_allocations:
+                result.update(run_case_in_subprocess(case_name, root, True))
+            results.append(result)
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=LAMBDA_ROOT, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=sorted(CASES))
+    parser.add_argument("--scales", nargs="+", type=int, default=DEFAULT_SCALES,
+                        help="Manifest sizes to benchmark, e.g. 10000 100000 1000000 2000000.")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="Where synthetic datasets are cached.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-trace-allocations", dest="trace_allocations", action="store_false",
+                        help="Skip the tracemalloc pass, which roughly doubles the run time.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--child", nargs=2, metavar=("CASE", "ROOT"), help=argparse.SUPPRESS)
+    parser.add_argument("--trace-allocations", dest="child_trace_allocations", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        case_name, root = args.child
+        print(json.dumps(run_case_in_process(case_name, root, args.child_trace_allocations)))
+        return
+
+    results = {
+        "schema_version": RESULTS_SCHEMA_VERSION,
+        "created": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "results": run_benchmarks(args.cases, args.scales, args.workdir, args.seed, args.trace_allocations)
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Wrote {} results to {}".format(len(results["results"]), args.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
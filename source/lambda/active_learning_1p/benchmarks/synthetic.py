@@ -0,0 +1,193 @@
+'''
+Synthetic AV dataset generator for the benchmarks.
+
+Produces manifests shaped like the bounding box manifests this solution labels, SSD style
+batch transform outputs (one `.out` file per image) and small synthetic JPEG frames. Everything
+is written in the local storage layout (<root>/<bucket>/<key>) so the handlers can read it
+through s3_helper with BYOAL_LOCAL_S3_ROOT pointing at <root>.
+'''
+import json
+import os
+import random
+
+from io import BytesIO
+
+BUCKET = "bench"
+LABEL_ATTRIBUTE_NAME = "label"
+CLASS_MAP = {"0": "pedestrian", "1": "vehicle", "2": "cyclist", "3": "traffic_sign"}
+IMAGE_WIDTH = 64
+IMAGE_HEIGHT = 40
+IMAGE_POOL_SIZE = 64
+
+INPUT_MANIFEST_KEY = "manifests/input.manifest"
+INTERMEDIATE_MANIFEST_KEY = "manifests/intermediate.manifest"
+PARTIAL_OUTPUT_KEY = "manifests/partial_output.manifest"
+UNLABELED_MANIFEST_KEY = "transform/unlabeled.manifest"
+TRANSFORM_OUTPUT_PREFIX = "transform/output/"
+IMAGE_PREFIX = "images/"
+
+
+def image_key(record_id):
+    return "{}{:09d}.jpg".format(IMAGE_PREFIX, record_id)
+
+
+def make_annotations(rng, n_objects, image_width, image_height):
+    """
+    Make `n_objects` random boxes in the Ground Truth bounding box format.
+    """
+    annotations = []
+    for _ in range(n_objects):
+        width = rng.randint(4, image_width // 2)
+        height = rng.randint(4, image_height // 2)
+        annotations.append({
+            "class_id": rng.randrange(len(CLASS_MAP)),
+            "top": rng.randint(0, image_height - height),
+            "left": rng.randint(0, image_width - width),
+            "width": width,
+            "height": height
+        })
+    return annotations
+
+
+def make_label_metadata(rng, annotations, human_annotated):
+    return {
+        "objects": [{"confidence": round(rng.uniform(0.5, 1.0), 2)} for _ in annotations],
+        "class-map": CLASS_MAP,
+        "type": "groundtruth/object-detection",
+        "human-annotated": human_annotated,
+        "creation-date": "2020-06-01T00:00:00.000000",
+        "job-name": "labeling-job/bench"
+    }
+
+
+def make_manifest_row(rng, record_id, label_state, with_id=True):
+    """
+    Make a manifest row for the given record. label_state is one of "human", "auto" or None.
+    """
+    row = {"source-ref": "s3://{}/{}".format(BUCKET, image_key(record_id))}
+    if with_id:
+        row["id"] = record_id
+    if label_state is not None:
+        annotations = make_annotations(rng, rng.randint(1, 6), IMAGE_WIDTH, IMAGE_HEIGHT)
+        row[LABEL_ATTRIBUTE_NAME] = {
+            "annotations": annotations,
+            "image_size": [{"width": IMAGE_WIDTH, "height": IMAGE_HEIGHT, "depth": 3}]
+        }
+        row["{}-metadata".format(LABEL_ATTRIBUTE_NAME)] = make_label_metadata(
+            rng, annotations, "yes" if label_state == "human" else "no")
+    return row
+
+
+def get_label_state(rng, human_fraction, auto_fraction):
+    draw = rng.random()
+    if draw < human_fraction:
+        return "human"
+    if draw < human_fraction + auto_fraction:
+        return "auto"
+    return None
+
+
+def make_prediction(rng, n_boxes, confident):
+    """
+    Make an SSD style prediction: [class_id, score, xmin, ymin, xmax, ymax] with 0-1 coordinates.
+    Confident images only contain boxes scoring above the autoannotation threshold.
+    """
+    boxes = []
+    for _ in range(n_boxes):
+        xmin, ymin = rng.uniform(0.0, 0.8), rng.uniform(0.0, 0.8)
+        xmax, ymax = rng.uniform(xmin + 0.01, 1.0), rng.uniform(ymin + 0.01, 1.0)
+        score = rng.uniform(0.55, 1.0) if confident else rng.uniform(0.0, 1.0)
+        boxes.append([float(rng.randrange(len(CLASS_MAP))), round(score, 4),
+                      round(xmin, 4), round(ymin, 4), round(xmax, 4), round(ymax, 4)])
+    return {"prediction": boxes}
+
+
+def make_image_bytes(seed):
+    """
+    Encode a small noisy JPEG frame.
+    """
+    from PIL import Image
+    pixel_rng = random.Random(seed)
+    pixels = bytes(pixel_rng.getrandbits(8) for _ in range(IMAGE_WIDTH * IMAGE_HEIGHT * 3))
+    image = Image.frombytes("RGB", (IMAGE_WIDTH, IMAGE_HEIGHT), pixels)
+    output = BytesIO()
+    image.save(output, format="JPEG")
+    return output.getvalue()
+
+
+def object_path(root, key):
+    path = os.path.join(root, BUCKET, *key.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def write_jsonl(root, key, rows):
+    with open(object_path(root, key), "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+def write_images(root, record_ids):
+    """
+    Write one image per record. Records share a small pool of encoded frames through hard links
+    so that millions of images do not cost millions of encodes or that much disk.
+    """
+    pool_paths = []
+    for i in range(IMAGE_POOL_SIZE):
+        pool_path = object_path(root, "image-pool/{:03d}.jpg".format(i))
+        with open(pool_path, "wb") as f:
+            f.write(make_image_bytes(i))
+        pool_paths.append(pool_path)
+    for record_id in record_ids:
+        path = object_path(root, image_key(record_id))
+        pool_path = pool_paths[record_id % IMAGE_POOL_SIZE]
+        try:
+            os.link(pool_path, path)
+        except OSError:
+            with open(pool_path, "rb") as source, open(path, "wb") as dest:
+                dest.write(source.read())
+
+
+def generate_dataset(root, n_rows, seed=0, human_fraction=0.2, auto_fraction=0.1,
+                     partial_fraction=0.05, confident_fraction=0.3, boxes_per_image=20):
+    """
+    Generate a complete synthetic dataset of `n_rows` records under `root` and return a
+    description of what was written.
+    """
+    rng = random.Random(seed)
+    label_states = [get_label_state(rng, human_fraction, auto_fraction) for _ in range(n_rows)]
+
+    write_jsonl(root, INPUT_MANIFEST_KEY,
+                (make_manifest_row(rng, i, state, with_id=False) for i, state in enumerate(label_states)))
+    write_jsonl(root, INTERMEDIATE_MANIFEST_KEY,
+                (make_manifest_row(rng, i, state) for i, state in enumerate(label_states)))
+
+    unlabeled_ids = [i for i, state in enumerate(label_states) if state is None]
+    partial_ids = rng.sample(unlabeled_ids, int(len(unlabeled_ids) * partial_fraction))
+    write_jsonl(root, PARTIAL_OUTPUT_KEY, (make_manifest_row(rng, i, "human") for i in sorted(partial_ids)))
+    write_jsonl(root, UNLABELED_MANIFEST_KEY, (make_manifest_row(rng, i, None) for i in unlabeled_ids))
+
+    confident_ids = set()
+    for record_id in unlabeled_ids:
+        confident = rng.random() < confident_fraction
+        if confident:
+            confident_ids.add(record_id)
+        output_key = "{}{}/{}.out".format(TRANSFORM_OUTPUT_PREFIX, record_id, os.path.basename(image_key(record_id)))
+        with open(object_path(root, output_key), "w") as f:
+            json.dump(make_prediction(rng, rng.randint(1, boxes_per_image), confident), f)
+    write_images(root, unlabeled_ids)
+
+    description = {
+        "rows": n_rows,
+        "seed": seed,
+        "unlabeled": len(unlabeled_ids),
+        "confident": len(confident_ids),
+        "partial": len(partial_ids)
+    }
+    with open(os.path.join(root, "dataset.json"), "w") as f:
+        json.dump(description, f)
+    return description
+
+
+def s3_uri(key):
+    return "s3://{}/{}".format(BUCKET, key)
@@ -0,0 +1,165 @@
+'''
+Adaptive concurrency of s3 requests.
+
+Stages fan s3 requests out over thread pools, and a hot prefix answers too many of them with
+503 SlowDown. Every request made through s3_helper takes a slot of one shared AdaptiveLimit
+first. The limit grows by one each time a full window of requests completes while it was the
+bottleneck, and halves when a request is throttled or when the recent latency grows well above
+the usual one. Requests then settle near what the prefix accepts instead of failing the lambda.
+A throttled or transient failure is retried with full jitter backoff, outside of its slot.
+Managed transfers, whose parts are sent by s3transfer threads, are retried part by part by
+botocore instead, and their throttled attempts are reported to the limit by report_retry. The
+limit is kept across warm invocations and published as the s3.concurrency.limit metric.
+'''
+import random
+import threading
+import time
+
+from metrics import increment, set_value
+
+INITIAL_LIMIT = 8
+MIN_LIMIT = 1
+MAX_LIMIT = 64
+MAX_ATTEMPTS = 6
+BASE_BACKOFF_SECONDS = 0.05
+MAX_BACKOFF_SECONDS = 5.0
+# The limit halves when the recent latency exceeds the usual one LATENCY_SPIKE_FACTOR times.
+LATENCY_SPIKE_FACTOR = 4.0
+RECENT_LATENCY_WEIGHT = 0.2
+USUAL_LATENCY_WEIGHT = 0.02
+LATENCY_WARMUP_REQUESTS = 20
+
+THROTTLING_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                    "TooManyRequestsException", "503"}
+TRANSIENT_CODES = {"InternalError", "ServiceUnavailable", "RequestTimeout", "500"}
+# botocore connection errors, matched by name so that botocore is not imported.
+TRANSIENT_EXCEPTIONS = {"EndpointConnectionError", "ConnectionClosedError", "ReadTimeoutError",
+                        "ConnectTimeoutError"}
+
+
+def get_error_code(error: BaseException):
+    response = getattr(error, "response", None)
+    if not isinstance(response, dict):
+        return None
+    return response.get("Error", {}).get("Code")
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    return get_error_code(error) in THROTTLING_CODES
+
+
+def is_transient_error(error: BaseException) -> bool:
+    return get_error_code(error) in TRANSIENT_CODES or type(error).__name__ in TRANSIENT_EXCEPTIONS
+
+
+class AdaptiveLimit:
+    """
+     Additive increase, multiplicative decrease limit on the requests in flight.
+    """
+
+    def __init__(self, initial=INITIAL_LIMIT, minimum=MIN_LIMIT, maximum=MAX_LIMIT):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.successes = 0
+        # Completions to wait for before the next decrease: the requests in flight when the
+        # limit last halved were sent under the old limit, and the new one deserves a window.
+        self.recovering = 0
+        self.latency = {}
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.recovering = max(0, self.recovering - 1)
+            self.condition.notify()
+
+    def _decrease(self, reason: str) -> None:
+        if self.recovering:
+            return
+        self.limit = max(self.minimum, self.limit // 2)
+        self.successes = 0
+        self.recovering = max(self.in_flight, self.limit)
+        increment("s3.concurrency.decreased.{}".format(reason))
+        set_value("s3.concurrency.limit", self.limit, "Count")
+
+    def on_success(self, operation: str, seconds: float) -> None:
+        """
+         Record a request completed in seconds. Called while its slot is still taken.
+        """
+        with self.condition:
+            count, recent, usual = self.latency.get(operation, (0, seconds, seconds))
+            recent += RECENT_LATENCY_WEIGHT * (seconds - recent)
+            usual += USUAL_LATENCY_WEIGHT * (seconds - usual)
+            self.latency[operation] = (count + 1, recent, usual)
+            if count >= LATENCY_WARMUP_REQUESTS and recent > LATENCY_SPIKE_FACTOR * usual and not self.recovering:
+                self._decrease("latency")
+                # The next decrease needs new evidence of a spike.
+                self.latency[operation] = (count + 1, usual, usual)
+            elif self.in_flight >= self.limit:
+                # Only grow a limit that is actually holding requests back.
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+                    self.condition.notify()
+            set_value("s3.concurrency.limit", self.limit, "Count")
+
+    def on_throttle(self) -> None:
+        with self.condition:
+            increment("s3.throttled")
+            self._decrease("throttled")
+
+    def call(self, operation: str, function):
+        """
+        Call function in a slot and return its result, retrying throttled and transient failures.
+        """
+        for attempt in range(MAX_ATTEMPTS):
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                result = function()
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                if throttled:
+                    self.on_throttle()
+                if attempt == MAX_ATTEMPTS - 1 or not (throttled or is_transient_error(e)):
+                    raise
+            else:
+                self.on_success(operation, time.perf_counter() - start)
+                return result
+            finally:
+                self.release()
+            increment("s3.retries")
+            time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt)))
+
+
+_limit = AdaptiveLimit()
+
+
+def get_limit() -> AdaptiveLimit:
+    return _limit
+
+
+def governed(operation: str, function):
+    """
+    Run one s3 request under the shared limit.
+    """
+    return _limit.call(operation, function)
+
+
+def report_retry(response=None, **kwargs):
+    """
+    botocore needs-retry handler of clients which retry on their own. Their throttled attempts
+    lower the shared limit like those of governed requests. Returns None, which leaves the retry
+    decision to botocore.
+    """
+    if response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_CODES:
+        _limit.on_throttle()
@@ -0,0 +1,103 @@
+'''
+Idempotent, resumable handler outputs.
+
+Step Functions retries a failed or timed out state and an execution can be re-driven from the
+state that failed. To make that cheap, handlers:
+    - derive their output locations from a fingerprint of their inputs, a hash of the ETags of
+      the s3 objects they read and of the parameters they use, instead of a random suffix,
+    - write a success marker holding the fingerprint and the handler result once all outputs
+      are complete.
+When the marker of a stage is found with a matching fingerprint, the recorded result is
+returned and no work is redone. Job names are not content addressed: they are unique per
+account and can not be reused, so a reused result gets the name generated by the new call. Markers are written last, so a run interrupted half way is
+simply redone.
+'''
+import hashlib
+import json
+import logging
+
+from io import StringIO
+
+from metrics import increment
+from s3_helper import S3Ref, create_ref_at_parent_key, download_stringio, get_etag, upload
+
+FINGERPRINT_LENGTH = 16
+SUCCESS_MARKER_FORMAT = "_SUCCESS.{}.json"
+
+logger = logging.getLogger()
+
+
+def get_input_etag(s3_uri: str):
+    """
+     Return the ETag of an input object, None if it can not be read.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+    try:
+        return get_etag(S3Ref.from_uri(s3_uri))
+    except (BotoCoreError, ClientError) as e:
+        # The handler reading the input fails on its own, so no marker is ever recorded for it.
+        logger.warning("Could not read the ETag of {}: {}".format(s3_uri, e))
+        return None
+
+
+def get_fingerprint(input_uris, parameters) -> str:
+    """
+     Hash the content of the input objects and the parameters which determine a handler's outputs.
+    """
+    description = {
+        'inputs': [[uri, get_input_etag(uri)] for uri in input_uris],
+        'parameters': parameters
+    }
+    digest = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+    return digest[:FINGERPRINT_LENGTH]
+
+
+def get_marker_ref(location_uri: str, stage: str) -> S3Ref:
+    """
+     The marker of a stage sits next to location_uri, which is either a folder ending with / or an object.
+    """
+    return create_ref_at_parent_key(S3Ref.from_uri(location_uri), SUCCESS_MARKER_FORMAT.format(stage))
+
+
+def get_completed_result(location_uri: str, stage: str, fingerprint: str):
+    """
+     Return the result recorded when the stage last completed with the same fingerprint, None otherwise.
+    """
+    from botocore.exceptions import ClientError
+    marker_ref = get_marker_ref(location_uri, stage)
+    try:
+        marker = json.load(download_stringio(marker_ref))
+    except ClientError:
+        return None
+    if marker.get('fingerprint') != fingerprint:
+        logger.info("Ignoring marker {} recorded for other inputs.".format(marker_ref.get_uri()))
+        return None
+    logger.info("{} already completed for these inputs, reusing the outputs recorded in {}.".format(
+        stage, marker_ref.get_uri()))
+    increment("idempotency.reused")
+    return marker['result']
+
+
+def mark_completed(location_uri: str, stage: str, fingerprint: str, result: dict) -> None:
+    """
+     Record that all outputs of the stage are complete.
+    """
+    marker_ref = get_marker_ref(location_uri, stage)
+    marker = StringIO(json.dumps({'fingerprint': fingerprint, 'result': result}))
+    try:
+        upload(marker, marker_ref)
+    except Exception:
+        # Without a marker a retry redoes the work, which is what happened before markers existed.
+        logger.exception("Failed to write the success marker {}".format(marker_ref.get_uri()))
+
+
+def merge_result(meta_data: dict, result: dict) -> dict:
+    """
+     Apply a handler result to meta_data, nested dictionaries such as counts are merged.
+    """
+    for key, value in result.items():
+        if isinstance(value, dict) and isinstance(meta_data.get(key), dict):
+            meta_data[key].update(value)
+        else:
+            meta_data[key] = value
+    return meta_data
@@ -0,0 +1,156 @@
+'''
+Compact label state index of the intermediate manifest.
+
+One byte per record, at the position of the dense record id assigned by AddRecordId, tells
+whether the record is unlabeled, labeled by a human, auto labeled, or labeled without
+provenance metadata. The index is stored next to the manifest as <manifest key>.labelstate,
+with a header naming the label attribute and the ETag of the manifest it describes, so a
+stale index is detected and never trusted. Counting states is a
+bytearray.count and finding unlabeled ids a bytearray.find, both running in C over an object
+a few hundred times smaller than the manifest, instead of S3 Select scans of the manifest.
+'''
+import json
+
+from metrics import increment
+from s3_helper import S3Ref, download_bytesio, get_etag, upload_bytes
+
+UNLABELED = 0
+HUMAN = 1
+AUTO = 2
+# Has a label but no human-annotated flag, counted as unlabeled like get_counts always did.
+UNKNOWN = 3
+
+INDEX_SUFFIX = ".labelstate"
+INDEX_VERSION = 1
+
+
+def get_label_state(row: dict, label_attribute_name: str) -> int:
+    if label_attribute_name not in row:
+        return UNLABELED
+    metadata = row.get("{}-metadata".format(label_attribute_name))
+    human_annotated = metadata.get("human-annotated") if isinstance(metadata, dict) else None
+    if human_annotated == "yes":
+        return HUMAN
+    if human_annotated == "no":
+        return AUTO
+    return UNKNOWN
+
+
+class LabelStateIndex:
+    """
+     Label state of every record, indexed by record id.
+    """
+
+    def __init__(self, label_attribute_name: str, states: bytearray, manifest_etag: str = None):
+        self.label_attribute_name = label_attribute_name
+        self.states = states
+        self.manifest_etag = manifest_etag
+
+    @classmethod
+    def from_rows(cls, rows, label_attribute_name: str):
+        """
+         Index a whole manifest. Raises ValueError when the record ids are not
+         0 to n - 1, which the index can not represent.
+        """
+        states = bytearray()
+        n_rows = 0
+        for row in rows:
+            record_id = row.get("id")
+            if not isinstance(record_id, int) or record_id < 0:
+                raise ValueError("Record id {!r} can not be indexed".format(record_id))
+            if record_id >= len(states):
+                states.extend(bytes(record_id + 1 - len(states)))
+            states[record_id] = get_label_state(row, label_attribute_name)
+            n_rows += 1
+        if n_rows != len(states):
+            raise ValueError("Record ids are not dense, {} rows for {} ids".format(n_rows, len(states)))
+        return cls(label_attribute_name, states)
+
+    def update(self, rows) -> None:
+        """
+         Apply the labels of updated rows, e.g. the records of a partial output.
+        """
+        for row in rows:
+            record_id = row.get("id")
+            if not isinstance(record_id, int) or not 0 <= record_id < len(self.states):
+                raise ValueError("Record id {!r} is not in the index".format(record_id))
+            self.states[record_id] = get_label_state(row, self.label_attribute_name)
+
+    def count(self, state: int) -> int:
+        return self.states.count(state)
+
+    def first_ids(self, state: int, limit: int) -> list:
+        """
+         Return up to limit ids in the given state, in id order.
+        """
+        ids = []
+        position = self.states.find(state)
+        while position != -1 and len(ids) < limit:
+            ids.append(position)
+            position = self.states.find(state, position + 1)
+        return ids
+
+    def get_counts(self) -> dict:
+        human_label = self.count(HUMAN)
+        auto_label = self.count(AUTO)
+        return {
+            "input_total": len(self.states),
+            "human_label": human_label,
+            "auto_label": auto_label,
+            "unlabeled": len(self.states) - human_label - auto_label
+        }
+
+    def serialize(self) -> bytes:
+        header = json.dumps({
+            "version": INDEX_VERSION,
+            "label_attribute_name": self.label_attribute_name,
+            "manifest_etag": self.manifest_etag,
+            "size": len(self.states)
+        })
+        return header.encode() + b"\n" + bytes(self.states)
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        header_line, _, states = data.partition(b"\n")
+        header = json.loads(header_line)
+        if header.get("version") != INDEX_VERSION or header.get("size") != len(states):
+            raise ValueError("Unsupported or truncated label state index")
+        return cls(header["label_attribute_name"], bytearray(states), header["manifest_etag"])
+
+
+def get_index_ref(manifest_ref: S3Ref) -> S3Ref:
+    return S3Ref(manifest_ref.bucket, manifest_ref.key + INDEX_SUFFIX)
+
+
+def read_label_state_index(manifest_ref: S3Ref):
+    """
+     Return the stored index of the manifest, current or not, None when there is none.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+    try:
+        return LabelStateIndex.deserialize(download_bytesio(get_index_ref(manifest_ref)).getvalue())
+    except (BotoCoreError, ClientError, ValueError):
+        return None
+
+
+def load_label_state_index(manifest_ref: S3Ref, label_attribute_name: str):
+    """
+     Return the index of the manifest, None when there is none or it does not describe the
+     current content of the manifest and label attribute.
+    """
+    index = read_label_state_index(manifest_ref)
+    if index is None:
+        increment("label_state.missing")
+        return None
+    if index.label_attribute_name != label_attribute_name or index.manifest_etag != get_etag(manifest_ref):
+        increment("label_state.stale")
+        return None
+    return index
+
+
+def save_label_state_index(manifest_ref: S3Ref, index: LabelStateIndex) -> None:
+    """
+     Store the index of the manifest as it is now. Call after the manifest was uploaded.
+    """
+    index.manifest_etag = get_etag(manifest_ref)
+    upload_bytes(index.serialize(), get_index_ref(manifest_ref))
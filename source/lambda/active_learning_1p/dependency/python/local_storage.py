@@ -0,0 +1,199 @@
+'''
+Local filesystem stand-in for the s3 client used by s3_helper.
+
+Objects are stored as plain files under <root>/<bucket>/<key>. Only the subset of the boto3
+s3 client used by the lambdas is implemented, which is enough to run the handlers, benchmarks
+and simulations without AWS. Set the BYOAL_LOCAL_S3_ROOT environment variable to make
+s3_helper use this client instead of boto3.
+'''
+import hashlib
+import os
+import shutil
+import threading
+
+from io import BytesIO
+
+LIST_MAX_KEYS = 1000
+COPY_BUFFER_SIZE = 1024 * 1024
+SELECT_EVENT_SIZE = 64 * 1024
+
+
+def _client_error(code, message, operation_name):
+    """
+     Build the same exception boto3 raises so callers handle local and remote errors alike.
+    """
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+class LocalS3Client:
+    """
+     Filesystem backed implementation of the boto3 s3 client methods used in this project.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def _existing_path(self, bucket: str, key: str, operation_name: str) -> str:
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            raise _client_error('404', 'Not Found s3://{}/{}'.format(bucket, key), operation_name)
+        return path
+
+    def _etag(self, path: str) -> str:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
+                md5.update(chunk)
+        return '"{}"'.format(md5.hexdigest())
+
+    def _write(self, bucket: str, key: str, fileobj) -> None:
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that readers never observe a partially written object.
+        # Threads writing the same key each get their own temporary file.
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_path, "wb") as f:
+                shutil.copyfileobj(fileobj, f, COPY_BUFFER_SIZE)
+        except BaseException:
+            # Like an aborted multipart upload, a failed write leaves nothing behind.
+            os.remove(temp_path)
+            raise
+        os.replace(temp_path, path)
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        path = self._existing_path(Bucket, Key, 'HeadObject')
+        return {
+            'ContentLength': os.path.getsize(path),
+            'ETag': self._etag(path)
+        }
+
+    def get_object(self, Bucket: str, Key: str, IfNoneMatch: str = None, **kwargs) -> dict:
+        path = self._existing_path(Bucket, Key, 'GetObject')
+        with open(path, "rb") as f:
+            body = f.read()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise _client_error('304', 'Not Modified', 'GetObject')
+        return {
+            'Body': BytesIO(body),
+            'ContentLength': len(body),
+            'ETag': etag
+        }
+
+    def put_object(self, Bucket: str, Key: str, Body=b"", **kwargs) -> dict:
+        if isinstance(Body, str):
+            Body = Body.encode()
+        if isinstance(Body, bytes):
+            Body = BytesIO(Body)
+        self._write(Bucket, Key, Body)
+        return {'ETag': self._etag(self._path(Bucket, Key))}
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj, **kwargs) -> None:
+        path = self._existing_path(Bucket, Key, 'HeadObject')
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, Fileobj, COPY_BUFFER_SIZE)
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, **kwargs) -> None:
+        self._write(Bucket, Key, Fileobj)
+
+    def copy(self, CopySource: dict, Bucket: str, Key: str, **kwargs) -> None:
+        source_path = self._existing_path(CopySource['Bucket'], CopySource['Key'], 'HeadObject')
+        with open(source_path, "rb") as f:
+            self._write(Bucket, Key, f)
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", MaxKeys: int = LIST_MAX_KEYS,
+                        ContinuationToken: str = None, StartAfter: str = None, **kwargs) -> dict:
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, filenames in os.walk(bucket_root):
+            relative_directory = os.path.relpath(directory, bucket_root)
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                if relative_directory == ".":
+                    key = filename
+                else:
+                    key = "/".join(relative_directory.split(os.sep) + [filename])
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+
+        # Mirror the s3 pagination contract so that callers which forget to paginate fail the same way.
+        start_after = ContinuationToken or StartAfter
+        if start_after is not None:
+            keys = [key for key in keys if key > start_after]
+        page = keys[:MaxKeys]
+        response = {
+            'KeyCount': len(page),
+            'IsTruncated': len(keys) > MaxKeys
+        }
+        if page:
+            response['Contents'] = [{
+                'Key': key,
+                'Size': os.path.getsize(self._path(Bucket, key)),
+                'ETag': self._etag(self._path(Bucket, key))
+            } for key in page]
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def select_object_content(self, Bucket: str, Key: str, Expression: str, InputSerialization: dict,
+                              OutputSerialization: dict, ExpressionType: str = 'SQL', ScanRange: dict = None,
+                              **kwargs) -> dict:
+        if ExpressionType != 'SQL' or InputSerialization.get('JSON', {}).get('Type') != 'LINES':
+            raise NotImplementedError("Only SQL over JSON lines is supported by the local storage stand-in.")
+        path = self._existing_path(Bucket, Key, 'SelectObjectContent')
+        return {'Payload': self._select_events(path, Expression, OutputSerialization, ScanRange)}
+
+    @staticmethod
+    def _scan_lines(f, scan_range: dict):
+        """
+         Yield the lines of the records starting within the inclusive byte range, as S3 Select does.
+        """
+        start = scan_range.get('Start', 0)
+        end = scan_range.get('End')
+        if start > 0:
+            f.seek(start - 1)
+            # A record starting before the range belongs to an earlier range.
+            if f.read(1) != b"\n":
+                f.readline()
+        position = f.tell()
+        for line in iter(f.readline, b""):
+            if end is not None and position > end:
+                return
+            position += len(line)
+            yield line
+
+    def _select_events(self, path: str, expression: str, output_serialization: dict, scan_range: dict = None):
+        """
+         Yield the same event stream as S3 Select. Records events end on record boundaries.
+        """
+        from select_engine import select_lines
+        returned = 0
+        chunk = []
+        chunk_size = 0
+        scanned = 0
+        with open(path, "rb") as f:
+            lines = f if scan_range is None else self._scan_lines(f, scan_range)
+            for record in select_lines(expression, lines, output_serialization):
+                data = record.encode('utf-8')
+                chunk.append(data)
+                chunk_size += len(data)
+                if chunk_size >= SELECT_EVENT_SIZE:
+                    yield {'Records': {'Payload': b"".join(chunk)}}
+                    returned += chunk_size
+                    chunk, chunk_size = [], 0
+            if scan_range is not None:
+                scanned = f.tell() - scan_range.get('Start', 0)
+        if chunk:
+            yield {'Records': {'Payload': b"".join(chunk)}}
+            returned += chunk_size
+        if scan_range is None:
+            scanned = os.path.getsize(path)
+        yield {'Stats': {'Details': {'BytesScanned': scanned, 'BytesProcessed': scanned, 'BytesReturned': returned}}}
+        yield {'End': {}}
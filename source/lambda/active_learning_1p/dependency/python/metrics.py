@@ -0,0 +1,170 @@
+'''
+Per invocation metrics for the lambdas.
+
+s3_helper records latency, bytes and call counts for every s3 operation and handlers time
+their phases with `timer`. `instrument_handler` resets the metrics when an invocation starts
+and prints everything as a single CloudWatch embedded metric format (EMF) record when it ends.
+Lambda forwards stdout to CloudWatch Logs, where the record is turned into metrics; locally
+the same JSON line can be read straight from the logs. Handlers record from worker threads, so
+every update of the shared metrics is made under a lock.
+'''
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+NAMESPACE = "ByoalActiveLearning"
+
+
+class InvocationMetrics:
+    """
+     Accumulates the metrics of a single lambda invocation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.io = {}
+            self.phases = {}
+            self.values = {}
+
+    def record_io(self, operation: str, seconds: float, nbytes: int = 0) -> None:
+        with self.lock:
+            stats = self.io.setdefault(operation, {'count': 0, 'bytes': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['bytes'] += nbytes
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def record_phase(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def set_value(self, name: str, value: float, unit: str = "None") -> None:
+        with self.lock:
+            self.values[name] = (value, unit)
+
+    def increment(self, name: str, value: float = 1, unit: str = "Count") -> None:
+        with self.lock:
+            previous, _ = self.values.get(name, (0, unit))
+            self.values[name] = (previous + value, unit)
+
+    def to_emf(self, handler_name: str, request_id: str = None) -> dict:
+        """
+         Build the embedded metric format record for this invocation.
+        """
+        with self.lock:
+            io = {operation: dict(stats) for operation, stats in self.io.items()}
+            phases = dict(self.phases)
+            values = dict(self.values)
+        record = {'Handler': handler_name}
+        definitions = []
+
+        def add(name, value, unit):
+            record[name] = value
+            definitions.append({'Name': name, 'Unit': unit})
+
+        for operation, stats in sorted(io.items()):
+            add('s3.{}.count'.format(operation), stats['count'], 'Count')
+            add('s3.{}.bytes'.format(operation), stats['bytes'], 'Bytes')
+            add('s3.{}.latency'.format(operation), round(stats['seconds'] * 1000, 3), 'Milliseconds')
+            add('s3.{}.max_latency'.format(operation), round(stats['max_seconds'] * 1000, 3), 'Milliseconds')
+        for phase, seconds in sorted(phases.items()):
+            add('phase.{}'.format(phase), round(seconds * 1000, 3), 'Milliseconds')
+        for name, (value, unit) in sorted(values.items()):
+            add(name, value, unit)
+
+        if request_id is not None:
+            record['RequestId'] = request_id
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Handler']],
+                'Metrics': definitions
+            }]
+        }
+        return record
+
+
+_metrics = InvocationMetrics()
+
+
+def get_metrics() -> InvocationMetrics:
+    return _metrics
+
+
+def record_io(operation: str, seconds: float, nbytes: int = 0) -> None:
+    _metrics.record_io(operation, seconds, nbytes)
+
+
+def set_value(name: str, value: float, unit: str = "None") -> None:
+    _metrics.set_value(name, value, unit)
+
+
+def increment(name: str, value: float = 1, unit: str = "Count") -> None:
+    _metrics.increment(name, value, unit)
+
+
+class io_timer:
+    """
+     Context manager timing one s3 operation. Set `nbytes` on the returned object to record
+     the bytes transferred.
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_io(self.operation, time.perf_counter() - self.start, self.nbytes)
+        return False
+
+
+@contextmanager
+def timer(phase: str):
+    """
+     Time a phase of the handler. Phases with the same name add up.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.record_phase(phase, time.perf_counter() - start)
+
+
+def emit(handler_name: str, request_id: str = None) -> dict:
+    """
+     Print the metrics of this invocation as a single EMF log line and return the record.
+    """
+    record = _metrics.to_emf(handler_name, request_id)
+    print(json.dumps(record), flush=True)
+    return record
+
+
+def instrument_handler(handler):
+    """
+     Decorator for lambda handlers. Metrics are reset at the start of each invocation, the whole
+     invocation is timed as the "total" phase and one metrics record is emitted at the end,
+     including when the handler raises.
+    """
+    handler_name = handler.__module__.split(".")[-1]
+
+    @wraps(handler)
+    def wrapper(event, context):
+        _metrics.reset()
+        try:
+            with timer("total"):
+                return handler(event, context)
+        finally:
+            emit(handler_name, getattr(context, 'aws_request_id', None))
+    return wrapper
@@ -0,0 +1,203 @@
+'''
+Perceptual hash index of the images of the intermediate manifest.
+
+Sequential AV frames are often near-identical, e.g. while the vehicle waits at a light, and
+scoring or labeling every one of them costs inference and labeling budget for no new
+information. Every image gets a 64 bit difference hash once, during bootstrap, computed from
+a 9x8 grayscale thumbnail so that recompression and small changes in exposure keep the hash
+within a few bits. Images whose hash is within NEAR_DUPLICATE_DISTANCE bits of the
+representative of a cluster join that cluster.
+
+Clusters are found with multi-index hashing: hashes are split into HASH_CHUNKS chunks, and
+two hashes within d bits agree within d // HASH_CHUNKS bits on at least one chunk, so only
+representatives found by probing the chunk tables are compared instead of all of them.
+
+The index is stored next to the manifest as <manifest key>.phash, a header line followed by
+the hash, cluster representative and original image size of every record, by record id.
+Record ids and source-refs never change once AddRecordId ran, so the index stays valid while
+the labels in the manifest change.
+'''
+import json
+import struct
+from io import BytesIO
+from itertools import combinations
+
+from s3_helper import S3Ref, download_bytesio, upload_bytes
+
+INDEX_SUFFIX = ".phash"
+INDEX_VERSION = 1
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+HASH_BITS = 64
+HASH_CHUNKS = 4
+CHUNK_BITS = HASH_BITS // HASH_CHUNKS
+# Bits out of 64 in which near-duplicates may differ.
+NEAR_DUPLICATE_DISTANCE = 4
+# hash, representative id, width, height, depth. A width of 0 marks an image that could not be hashed.
+RECORD_FORMAT = "<QIHHB"
+
+
+def difference_hash(image_bytes):
+    """
+    Return the 64 bit difference hash of an image and its size.
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(image_bytes))
+    width, height = image.size
+    image_size = {"width": width, "height": height, "depth": len(image.getbands())}
+    # JPEG frames are decoded at the smallest scale the thumbnail can be made from.
+    image.draft("L", (HASH_WIDTH, HASH_HEIGHT))
+    pixels = image.convert("L").resize((HASH_WIDTH, HASH_HEIGHT), Image.BOX).tobytes()
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for column in range(HASH_WIDTH - 1):
+            position = row * HASH_WIDTH + column
+            value = (value << 1) | (pixels[position] < pixels[position + 1])
+    return value, image_size
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def get_chunks(value):
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (chunk * CHUNK_BITS)) & mask for chunk in range(HASH_CHUNKS)]
+
+
+def get_probes(chunk_value, radius):
+    """
+    Return every chunk value within radius bits of chunk_value.
+    """
+    probes = [chunk_value]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            probe = chunk_value
+            for bit in bits:
+                probe ^= 1 << bit
+            probes.append(probe)
+    return probes
+
+
+def cluster_hashes(hashes, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """
+    Return the representative id of every hash. Hashes are visited in id order, each joins the
+    closest earlier representative within max_distance bits, the lowest id on ties, or becomes
+    a representative itself. Joining representatives only keeps clusters from chaining along
+    a slowly changing sequence. None hashes are representatives of their own.
+    """
+    radius = max_distance // HASH_CHUNKS
+    tables = [{} for _ in range(HASH_CHUNKS)]
+    representatives = []
+    for record_id, value in enumerate(hashes):
+        if value is None:
+            representatives.append(record_id)
+            continue
+        chunks = get_chunks(value)
+        best = None
+        for table, chunk_value in zip(tables, chunks):
+            for probe in get_probes(chunk_value, radius):
+                for candidate in table.get(probe, ()):
+                    distance = hamming_distance(value, hashes[candidate])
+                    if distance <= max_distance and (best is None or (distance, candidate) < best):
+                        best = (distance, candidate)
+        if best is not None:
+            representatives.append(best[1])
+            continue
+        representatives.append(record_id)
+        for table, chunk_value in zip(tables, chunks):
+            table.setdefault(chunk_value, []).append(record_id)
+    return representatives
+
+
+class NearDuplicateIndex:
+    """
+     Perceptual hash, cluster representative and original size of every record, indexed by record id.
+    """
+
+    def __init__(self, hashes, representatives, sizes, max_distance=NEAR_DUPLICATE_DISTANCE):
+        self.hashes = hashes
+        self.representatives = representatives
+        self.sizes = sizes
+        self.max_distance = max_distance
+
+    @classmethod
+    def from_hashes(cls, hashes, sizes, max_distance=NEAR_DUPLICATE_DISTANCE):
+        return cls(hashes, cluster_hashes(hashes, max_distance), sizes, max_distance)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def get_cluster(self, record_id):
+        """
+         Return the representative id of the cluster of a record, the record id itself for
+         records the index does not know.
+        """
+        if isinstance(record_id, int) and 0 <= record_id < len(self.representatives):
+            return self.representatives[record_id]
+        return record_id
+
+    def get_size(self, record_id):
+        if isinstance(record_id, int) and 0 <= record_id < len(self.sizes):
+            return self.sizes[record_id]
+        return None
+
+    def serialize(self) -> bytes:
+        header = json.dumps({
+            "version": INDEX_VERSION,
+            "max_distance": self.max_distance,
+            "size": len(self.hashes)
+        })
+        records = bytearray()
+        for value, representative, size in zip(self.hashes, self.representatives, self.sizes):
+            size = size or {"width": 0, "height": 0, "depth": 0}
+            records += struct.pack(RECORD_FORMAT, value or 0, representative,
+                                   size["width"], size["height"], size["depth"])
+        return header.encode() + b"\n" + bytes(records)
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        header_line, _, records = data.partition(b"\n")
+        header = json.loads(header_line)
+        if header.get("version") != INDEX_VERSION or \
+                header.get("size") * struct.calcsize(RECORD_FORMAT) != len(records):
+            raise ValueError("Unsupported or truncated near-duplicate index")
+        hashes, representatives, sizes = [], [], []
+        for value, representative, width, height, depth in struct.iter_unpack(RECORD_FORMAT, records):
+            known = width > 0
+            hashes.append(value if known else None)
+            representatives.append(representative)
+            sizes.append({"width": width, "height": height, "depth": depth} if known else None)
+        return cls(hashes, representatives, sizes, header["max_distance"])
+
+
+def get_index_ref(manifest_ref: S3Ref) -> S3Ref:
+    return S3Ref(manifest_ref.bucket, manifest_ref.key + INDEX_SUFFIX)
+
+
+def load_near_duplicate_index(manifest_ref: S3Ref):
+    """
+     Return the index of the manifest, None when there is none.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+    try:
+        return NearDuplicateIndex.deserialize(download_bytesio(get_index_ref(manifest_ref)).getvalue())
+    except (BotoCoreError, ClientError, ValueError):
+        return None
+
+
+def save_near_duplicate_index(manifest_ref: S3Ref, index: NearDuplicateIndex) -> None:
+    upload_bytes(index.serialize(), get_index_ref(manifest_ref))
+
+
+def get_representatives(index, rows):
+    """
+    Group rows by cluster and return {representative row id: [member row ids]}, the lowest id
+    of each group standing for it. Without an index every row is its own representative.
+    """
+    groups = {}
+    for row in sorted(rows, key=lambda row: row["id"]):
+        cluster = index.get_cluster(row["id"]) if index is not None else row["id"]
+        groups.setdefault(cluster, []).append(row["id"])
+    return {ids[0]: ids[1:] for ids in groups.values()}
@@ -0,0 +1,92 @@
+'''
+Bounded, overlapped stages for I/O bound handlers.
+
+`prefetch` starts calling a function over items on a thread pool as soon as it is created, from
+a background thread which also drives the items iterator, e.g. a paginated S3 listing. Results
+are yielded in the order of the items and at most queue_size of them are in flight or waiting
+for the consumer, so a slow consumer bounds memory instead of letting downloads pile up. The
+listing, the calls and the consumer overlap, which brings the wall clock time of a handler
+close to its slowest stage instead of the sum of them.
+'''
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+PREFETCH_WORKERS = 16
+PREFETCH_QUEUE_SIZE = 64
+
+_DONE = object()
+
+
+class Prefetched:
+    """
+     Iterator over the results of a prefetch. Closing it, directly or by leaving a with block,
+     stops the producer and the workers, whether it was iterated or not.
+    """
+
+    def __init__(self, function, items, workers=PREFETCH_WORKERS, queue_size=PREFETCH_QUEUE_SIZE):
+        self.futures = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.closed = False
+        self.producer = threading.Thread(target=self._produce, args=(function, items), daemon=True)
+        self.producer.start()
+
+    def _produce(self, function, items):
+        try:
+            for item in items:
+                if self.stopped.is_set():
+                    break
+                self.futures.put(self.executor.submit(function, item))
+        except BaseException as e:
+            failed = Future()
+            failed.set_exception(e)
+            self.futures.put(failed)
+        finally:
+            self.futures.put(_DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        future = self.futures.get()
+        if future is _DONE:
+            self.close()
+            raise StopIteration
+        try:
+            return future.result()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        # Unblock the producer and drop what it submitted.
+        self.stopped.set()
+        while self.producer.is_alive() or not self.futures.empty():
+            try:
+                future = self.futures.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            if future is not _DONE:
+                future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def prefetch(function, items, workers=PREFETCH_WORKERS, queue_size=PREFETCH_QUEUE_SIZE) -> Prefetched:
+    """
+    Start calling function on every item in the background and return an iterator over the
+    results in item order. An exception of a call, or of the items iterator, is raised when
+    the consumer reaches it.
+    """
+    return Prefetched(function, items, workers, queue_size)
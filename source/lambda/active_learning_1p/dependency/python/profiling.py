@@ -0,0 +1,130 @@
+'''
+Opt-in profiling of lambda invocations.
+
+`profile_handler` wraps a lambda handler with cProfile and tracemalloc when profiling is
+requested, either for every invocation through the BYOAL_PROFILE environment variable or for a
+single invocation with a "Profile" key in the event. The value selects what is captured:
+"cpu", "memory", or anything truthy for both. Artifacts are written to BYOAL_PROFILE_OUTPUT_URI,
+which can be an s3 prefix or a local folder:
+    - <handler>-<timestamp>-<request id>.pstats : cProfile stats, load them with pstats or snakeviz.
+    - <handler>-<timestamp>-<request id>.txt    : top functions by cumulative time, tracemalloc
+                                                  peak and top allocation sites.
+When profiling is not requested the handler is called directly.
+'''
+import logging
+import os
+import time
+
+from functools import wraps
+
+PROFILE_ENV = "BYOAL_PROFILE"
+PROFILE_OUTPUT_ENV = "BYOAL_PROFILE_OUTPUT_URI"
+PROFILE_EVENT_KEY = "Profile"
+DEFAULT_PROFILE_OUTPUT = "/tmp/byoal-profiles/"
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 10
+
+logger = logging.getLogger()
+
+
+def get_profile_mode(event) -> set:
+    """
+     Return which profilers are requested for this invocation, empty if none.
+    """
+    value = event.get(PROFILE_EVENT_KEY) if isinstance(event, dict) else None
+    if value in (None, False, ""):
+        value = os.environ.get(PROFILE_ENV, "")
+    value = str(value).strip().lower()
+    if value in ("", "0", "false", "no", "off"):
+        return set()
+    if value in ("cpu", "memory"):
+        return {value}
+    return {"cpu", "memory"}
+
+
+def format_report(handler_name, stats_stream, peak_bytes, snapshot) -> str:
+    lines = ["Profile of {}".format(handler_name)]
+    if peak_bytes is not None:
+        lines.append("")
+        lines.append("tracemalloc peak: {:.3f} MB".format(peak_bytes / 1024.0 / 1024.0))
+        lines.append("Top {} allocation sites still allocated at the end of the invocation:".format(TOP_ALLOCATIONS))
+        for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+            lines.append("  {}".format(statistic))
+    if stats_stream is not None:
+        lines.append("")
+        lines.append(stats_stream)
+    return "\n".join(lines) + "\n"
+
+
+def write_artifact(output_uri: str, filename: str, body: bytes) -> str:
+    """
+     Write a profiling artifact to an s3 prefix or local folder and return where it went.
+    """
+    if output_uri.startswith("s3://"):
+        from s3_helper import S3Ref, upload_bytes
+        dest = S3Ref.from_uri(output_uri.rstrip("/") + "/" + filename)
+        upload_bytes(body, dest)
+        return dest.get_uri()
+    os.makedirs(output_uri, exist_ok=True)
+    path = os.path.join(output_uri, filename)
+    with open(path, "wb") as f:
+        f.write(body)
+    return path
+
+
+def run_profiled(handler, handler_name, mode, event, context):
+    import cProfile
+    import io
+    import marshal
+    import pstats
+    import tracemalloc
+
+    profiler = cProfile.Profile() if "cpu" in mode else None
+    if "memory" in mode:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return handler(event, context)
+    finally:
+        peak_bytes, snapshot = None, None
+        if profiler is not None:
+            profiler.disable()
+        if "memory" in mode:
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        try:
+            artifact_name = "{}-{}-{}".format(handler_name, time.strftime("%Y%m%dT%H%M%S"),
+                                              getattr(context, 'aws_request_id', os.getpid()))
+            output_uri = os.environ.get(PROFILE_OUTPUT_ENV, DEFAULT_PROFILE_OUTPUT)
+            stats_text = None
+            if profiler is not None:
+                profiler.create_stats()
+                write_artifact(output_uri, artifact_name + ".pstats", marshal.dumps(profiler.stats))
+                stats_stream = io.StringIO()
+                pstats.Stats(profiler, stream=stats_stream).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+                stats_text = stats_stream.getvalue()
+            report = format_report(handler_name, stats_text, peak_bytes, snapshot)
+            location = write_artifact(output_uri, artifact_name + ".txt", report.encode())
+            logger.info("Wrote profile of {} to {}".format(handler_name, location))
+        except Exception:
+            # Profiling must never fail the invocation it observes.
+            logger.exception("Failed to write profile of {}".format(handler_name))
+
+
+def profile_handler(handler):
+    """
+     Decorator for lambda handlers which profiles invocations on request.
+    """
+    handler_name = handler.__module__.split(".")[-1]
+
+    @wraps(handler)
+    def wrapper(event, context):
+        mode = get_profile_mode(event)
+        if not mode:
+            return handler(event, context)
+        return run_profiled(handler, handler_name, mode, event, context)
+    return wrapper
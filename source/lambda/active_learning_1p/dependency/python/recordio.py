@@ -0,0 +1,54 @@
+'''
+Reader and writer of the RecordIO format read by the SageMaker built-in image algorithms.
+
+A record is a 4 byte magic number, a 4 byte length whose top 3 bits flag records continued
+across several chunks, and the data padded to 4 bytes. Image records start with an IRHeader
+(flag, label, id, id2); a positive flag is the number of float32 labels which follow the
+header, then comes the encoded image. This is the layout written by MXNet's im2rec.
+'''
+import struct
+
+RECORDIO_MAGIC = 0xced7230a
+RECORD_HEADER = struct.Struct("<II")
+IR_HEADER = struct.Struct("<IfQQ")
+# Lengths use the low 29 bits, the others flag continued records.
+MAX_RECORD_BYTES = (1 << 29) - 1
+
+
+def pack_image_record(record_id: int, labels: list, image_bytes: bytes) -> bytes:
+    header = IR_HEADER.pack(len(labels), 0.0, record_id, 0)
+    return header + struct.pack("<{}f".format(len(labels)), *labels) + image_bytes
+
+
+def unpack_image_record(data: bytes):
+    """
+     Return the id, labels and encoded image of an image record.
+    """
+    flag, label, record_id, _ = IR_HEADER.unpack_from(data)
+    offset = IR_HEADER.size
+    if flag > 0:
+        labels = list(struct.unpack_from("<{}f".format(flag), data, offset))
+        offset += 4 * flag
+    else:
+        labels = [label]
+    return record_id, labels, data[offset:]
+
+
+def encode_record(data: bytes) -> bytes:
+    if len(data) > MAX_RECORD_BYTES:
+        raise ValueError("Record of {} bytes is too large".format(len(data)))
+    return RECORD_HEADER.pack(RECORDIO_MAGIC, len(data)) + data + bytes(-len(data) % 4)
+
+
+def iter_records(data: bytes):
+    """
+     Yield the data of the records in a RecordIO file. Continued records are not supported.
+    """
+    offset = 0
+    while offset < len(data):
+        magic, length = RECORD_HEADER.unpack_from(data, offset)
+        if magic != RECORDIO_MAGIC or length >> 29:
+            raise ValueError("Unsupported RecordIO record at byte {}".format(offset))
+        offset += RECORD_HEADER.size
+        yield data[offset:offset + length]
+        offset += length + (-length % 4)
@@ -0,0 +1,80 @@
+'''
+Single pass stratified reservoir sampling.
+
+StratifiedReservoir keeps a uniform sample of each stratum of a stream, with the sample sizes
+balanced across strata: every stratum gets the same share of the requested size, and strata
+with fewer items than their share give the rest to the others. The shares are recomputed as
+strata grow. A share only grows while its stratum is held entirely and otherwise only shrinks,
+by dropping random items, so each reservoir stays a uniform sample and at most size items are
+held at any time.
+'''
+import random
+
+
+def get_allocation(seen: dict, size: int) -> dict:
+    """
+     Split size between strata with the given item counts, evenly except that no stratum gets
+     more than its count. Strata are capped from the smallest count up, and the slots left when
+     the others' split is uneven go one each to those strata in order of first appearance, the
+     order of seen.
+    """
+    allocation = {}
+    remaining = size
+    pending = sorted(seen, key=lambda stratum: seen[stratum])
+    while pending:
+        share = remaining // len(pending)
+        if seen[pending[0]] > share:
+            break
+        stratum = pending.pop(0)
+        allocation[stratum] = seen[stratum]
+        remaining -= seen[stratum]
+    if pending:
+        extra = remaining - share * len(pending)
+        uncapped = [stratum for stratum in seen if stratum not in allocation]
+        for position, stratum in enumerate(uncapped):
+            allocation[stratum] = share + (1 if position < extra else 0)
+    return allocation
+
+
+class StratifiedReservoir:
+    """
+     Class balanced sample of at most size items out of a stream of (stratum, item) pairs.
+    """
+
+    def __init__(self, size: int, rng: random.Random = None):
+        self.size = size
+        self.rng = rng or random.Random()
+        self.seen = {}
+        self.reservoirs = {}
+
+    def add(self, stratum, item) -> None:
+        seen = self.seen.get(stratum, 0) + 1
+        self.seen[stratum] = seen
+        reservoir = self.reservoirs.setdefault(stratum, [])
+        allocation = get_allocation(self.seen, self.size)
+        for other, other_reservoir in self.reservoirs.items():
+            while len(other_reservoir) > allocation[other]:
+                self.drop(other_reservoir)
+
+        if len(reservoir) == seen - 1 and len(reservoir) < allocation[stratum]:
+            reservoir.append(item)
+            return
+        # A reservoir which dropped items can not grow back without biasing its sample.
+        capacity = min(allocation[stratum], len(reservoir))
+        position = self.rng.randrange(seen)
+        if position < capacity:
+            reservoir[position] = item
+
+    def drop(self, reservoir: list) -> None:
+        position = self.rng.randrange(len(reservoir))
+        reservoir[position] = reservoir[-1]
+        reservoir.pop()
+
+    def items(self) -> list:
+        return [item for reservoir in self.reservoirs.values() for item in reservoir]
+
+    def get_counts(self) -> dict:
+        """
+         Return the number of sampled items of each stratum.
+        """
+        return {stratum: len(reservoir) for stratum, reservoir in self.reservoirs.items()}
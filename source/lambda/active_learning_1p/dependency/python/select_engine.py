@@ -0,0 +1,537 @@
+'''
+Local evaluator for the S3 Select SQL used by the lambdas.
+
+Supports the subset of the S3 Select grammar this project issues against JSON lines manifests:
+    SELECT * | COUNT(*) | s."a"."b", ... FROM s3object[*] [AS] s
+        [WHERE <condition>] [LIMIT n]
+where conditions combine paths and literals with IS [NOT] MISSING, IS [NOT] NULL,
+[NOT] IN (...), =, !=, <>, <, <=, >, >=, AND, OR, NOT and parentheses. As in S3 Select,
+unquoted identifiers are case insensitive, double quoted ones are not, and a comparison
+involving a missing or null value is neither true nor false, so the row is not selected.
+
+WHERE clauses are compiled once per query into nested Python closures, so a row costs one
+call per condition node instead of a walk of the expression tree. Before a line is parsed at
+all, it is checked for the JSON encoding of the string literals the condition needs: a row
+without "yes" anywhere can not match `"human-annotated" IN ('yes')`, and most rows of a large
+manifest are rejected that way without json.loads. The engine serves the local storage
+backend and, in s3_helper, small objects and accounts where S3 Select is unavailable.
+'''
+import csv
+import json
+import re
+
+from functools import lru_cache
+from io import StringIO
+
+MISSING = object()
+
+# String literals that every JSON encoder writes the same way, usable as byte-level pre-filters.
+PLAIN_STRING_PATTERN = re.compile(r"[A-Za-z0-9 _.:-]*")
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+      | (?P<quoted>"(?:[^"]|"")*")
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<operator><=|>=|<>|!=|=|<|>|\(|\)|\[|\]|\*|,|\.)
+    )""", re.VERBOSE)
+
+COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+class SelectSyntaxError(ValueError):
+    pass
+
+
+class Token:
+    __slots__ = ('kind', 'value')
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    def is_keyword(self, *keywords) -> bool:
+        return self.kind == 'word' and self.value.upper() in keywords
+
+    def __repr__(self):
+        return "Token({}, {!r})".format(self.kind, self.value)
+
+
+def tokenize(expression: str) -> list:
+    tokens = []
+    position = 0
+    expression = expression.rstrip().rstrip(";")
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if match is None or match.end() == position:
+            if expression[position:].strip() == "":
+                break
+            raise SelectSyntaxError("Unexpected character at {}: {!r}".format(position, expression[position:]))
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'string':
+            tokens.append(Token('string', text[1:-1].replace("''", "'")))
+        elif kind == 'quoted':
+            tokens.append(Token('quoted', text[1:-1].replace('""', '"')))
+        elif kind == 'number':
+            tokens.append(Token('number', float(text) if '.' in text else int(text)))
+        else:
+            tokens.append(Token(kind, text))
+        position = match.end()
+    return tokens
+
+
+class Query:
+    """
+     A parsed SELECT statement.
+    """
+
+    def __init__(self, projection, alias, where, limit):
+        # projection is "*", "count" or a list of paths, a path being a list of (name, quoted) pairs.
+        self.projection = projection
+        self.alias = alias
+        self.where = where
+        self.limit = limit
+
+
+class Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise SelectSyntaxError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def accept_keyword(self, *keywords) -> bool:
+        token = self.peek()
+        if token is not None and token.is_keyword(*keywords):
+            self.position += 1
+            return True
+        return False
+
+    def accept_operator(self, operator) -> bool:
+        token = self.peek()
+        if token is not None and token.kind == 'operator' and token.value == operator:
+            self.position += 1
+            return True
+        return False
+
+    def expect_keyword(self, keyword):
+        if not self.accept_keyword(keyword):
+            raise SelectSyntaxError("Expected {} but found {}".format(keyword, self.peek()))
+
+    def expect_operator(self, operator):
+        if not self.accept_operator(operator):
+            raise SelectSyntaxError("Expected '{}' but found {}".format(operator, self.peek()))
+
+    def parse_query(self) -> Query:
+        self.expect_keyword('SELECT')
+        projection = self.parse_projection()
+        self.expect_keyword('FROM')
+        self.expect_keyword('S3OBJECT')
+        if self.accept_operator('['):
+            self.expect_operator('*')
+            self.expect_operator(']')
+        alias = None
+        self.accept_keyword('AS')
+        token = self.peek()
+        if token is not None and token.kind in ('word', 'quoted') and not token.is_keyword('WHERE', 'LIMIT'):
+            alias = (self.next().value, token.kind == 'quoted')
+        where = None
+        if self.accept_keyword('WHERE'):
+            where = self.parse_or()
+        limit = None
+        if self.accept_keyword('LIMIT'):
+            token = self.next()
+            if token.kind != 'number' or not isinstance(token.value, int):
+                raise SelectSyntaxError("LIMIT expects an integer")
+            limit = token.value
+        if self.peek() is not None:
+            raise SelectSyntaxError("Unexpected {}".format(self.peek()))
+        return Query(projection, alias, where, limit)
+
+    def parse_projection(self):
+        if self.accept_operator('*'):
+            return '*'
+        if self.accept_keyword('COUNT'):
+            self.expect_operator('(')
+            self.expect_operator('*')
+            self.expect_operator(')')
+            return 'count'
+        paths = [self.parse_path()]
+        while self.accept_operator(','):
+            paths.append(self.parse_path())
+        return paths
+
+    def parse_path(self):
+        token = self.next()
+        if token.kind not in ('word', 'quoted'):
+            raise SelectSyntaxError("Expected a name but found {}".format(token))
+        path = [(token.value, token.kind == 'quoted')]
+        while self.accept_operator('.'):
+            token = self.next()
+            if token.kind not in ('word', 'quoted'):
+                raise SelectSyntaxError("Expected a name but found {}".format(token))
+            path.append((token.value, token.kind == 'quoted'))
+        return path
+
+    def parse_or(self):
+        expression = self.parse_and()
+        while self.accept_keyword('OR'):
+            expression = ('or', expression, self.parse_and())
+        return expression
+
+    def parse_and(self):
+        expression = self.parse_not()
+        while self.accept_keyword('AND'):
+            expression = ('and', expression, self.parse_not())
+        return expression
+
+    def parse_not(self):
+        if self.accept_keyword('NOT'):
+            return ('not', self.parse_not())
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        if self.accept_operator('('):
+            expression = self.parse_or()
+            self.expect_operator(')')
+            return expression
+        operand = self.parse_operand()
+        if self.accept_keyword('IS'):
+            negate = self.accept_keyword('NOT')
+            if self.accept_keyword('MISSING'):
+                return ('is_missing', operand, negate)
+            self.expect_keyword('NULL')
+            return ('is_null', operand, negate)
+        negate = self.accept_keyword('NOT')
+        if self.accept_keyword('IN'):
+            self.expect_operator('(')
+            values = [self.parse_operand()]
+            while self.accept_operator(','):
+                values.append(self.parse_operand())
+            self.expect_operator(')')
+            return ('in', operand, values, negate)
+        if negate:
+            raise SelectSyntaxError("Expected IN after NOT")
+        token = self.next()
+        if token.kind != 'operator' or token.value not in COMPARISONS:
+            raise SelectSyntaxError("Expected a comparison but found {}".format(token))
+        return ('compare', token.value, operand, self.parse_operand())
+
+    def parse_operand(self):
+        token = self.peek()
+        if token is None:
+            raise SelectSyntaxError("Unexpected end of expression")
+        if token.kind in ('string', 'number'):
+            self.position += 1
+            return ('literal', token.value)
+        if token.is_keyword('TRUE', 'FALSE'):
+            self.position += 1
+            return ('literal', token.value.upper() == 'TRUE')
+        if token.is_keyword('NULL'):
+            self.position += 1
+            return ('literal', None)
+        return ('path', self.parse_path())
+
+
+@lru_cache(maxsize=64)
+def parse(expression: str) -> Query:
+    """
+     Parse an S3 Select SQL expression. Raises SelectSyntaxError on anything outside the supported subset.
+    """
+    return Parser(tokenize(expression)).parse_query()
+
+
+def lookup(value, name, quoted):
+    if not isinstance(value, dict):
+        return MISSING
+    if name in value:
+        return value[name]
+    if not quoted:
+        lowered = name.lower()
+        for key in value:
+            if key.lower() == lowered:
+                return value[key]
+    return MISSING
+
+
+def strip_alias(path, alias):
+    """
+     Return the names of a path after the table alias it starts with, if any.
+    """
+    if alias is not None and len(path) > 1:
+        first_name, first_quoted = path[0]
+        alias_name, alias_quoted = alias
+        if first_name == alias_name or (not (first_quoted or alias_quoted) and first_name.lower() == alias_name.lower()):
+            return path[1:]
+    return path
+
+
+def resolve(record, path, alias):
+    names = strip_alias(path, alias)
+    value = record
+    for name, quoted in names:
+        value = lookup(value, name, quoted)
+        if value is MISSING:
+            break
+    return value
+
+
+def evaluate_operand(operand, record, alias):
+    if operand[0] == 'literal':
+        return operand[1]
+    return resolve(record, operand[1], alias)
+
+
+def evaluate(expression, record, alias):
+    """
+     Evaluate a condition to True, False or None when it is unknown.
+    """
+    kind = expression[0]
+    if kind == 'and':
+        left, right = evaluate(expression[1], record, alias), evaluate(expression[2], record, alias)
+        if left is False or right is False:
+            return False
+        return None if left is None or right is None else True
+    if kind == 'or':
+        left, right = evaluate(expression[1], record, alias), evaluate(expression[2], record, alias)
+        if left is True or right is True:
+            return True
+        return None if left is None or right is None else False
+    if kind == 'not':
+        value = evaluate(expression[1], record, alias)
+        return None if value is None else not value
+    if kind == 'is_missing':
+        result = evaluate_operand(expression[1], record, alias) is MISSING
+        return result != expression[2]
+    if kind == 'is_null':
+        value = evaluate_operand(expression[1], record, alias)
+        return (value is None or value is MISSING) != expression[2]
+    if kind == 'in':
+        value = evaluate_operand(expression[1], record, alias)
+        if value is None or value is MISSING:
+            return None
+        candidates = [evaluate_operand(candidate, record, alias) for candidate in expression[2]]
+        return (value in candidates) != expression[3]
+    if kind == 'compare':
+        left = evaluate_operand(expression[2], record, alias)
+        right = evaluate_operand(expression[3], record, alias)
+        if left is None or left is MISSING or right is None or right is MISSING:
+            return None
+        try:
+            return COMPARISONS[expression[1]](left, right)
+        except TypeError:
+            return None
+    raise SelectSyntaxError("Unknown expression {}".format(kind))
+
+
+def compile_operand(operand, alias):
+    """
+     Return a function of a record computing the operand.
+    """
+    if operand[0] == 'literal':
+        value = operand[1]
+        return lambda record: value
+    names = tuple(strip_alias(operand[1], alias))
+
+    def get(record):
+        value = record
+        for name, quoted in names:
+            value = lookup(value, name, quoted)
+            if value is MISSING:
+                break
+        return value
+    return get
+
+
+def compile_condition(expression, alias):
+    """
+     Compile a condition into a function of a record returning True, False or None when it is
+     unknown, with the semantics of evaluate.
+    """
+    kind = expression[0]
+    if kind in ('and', 'or'):
+        left, right = compile_condition(expression[1], alias), compile_condition(expression[2], alias)
+        if kind == 'and':
+            def condition(record):
+                left_value = left(record)
+                if left_value is False:
+                    return False
+                right_value = right(record)
+                if right_value is False:
+                    return False
+                return None if left_value is None or right_value is None else True
+        else:
+            def condition(record):
+                left_value = left(record)
+                if left_value is True:
+                    return True
+                right_value = right(record)
+                if right_value is True:
+                    return True
+                return None if left_value is None or right_value is None else False
+        return condition
+    if kind == 'not':
+        inner = compile_condition(expression[1], alias)
+
+        def condition(record):
+            value = inner(record)
+            return None if value is None else not value
+        return condition
+    if kind == 'is_missing':
+        operand, negate = compile_operand(expression[1], alias), expression[2]
+        return lambda record: (operand(record) is MISSING) != negate
+    if kind == 'is_null':
+        operand, negate = compile_operand(expression[1], alias), expression[2]
+
+        def condition(record):
+            value = operand(record)
+            return (value is None or value is MISSING) != negate
+        return condition
+    if kind == 'in':
+        operand, negate = compile_operand(expression[1], alias), expression[3]
+        candidates = [compile_operand(candidate, alias) for candidate in expression[2]]
+
+        def condition(record):
+            value = operand(record)
+            if value is None or value is MISSING:
+                return None
+            return (value in [candidate(record) for candidate in candidates]) != negate
+        return condition
+    if kind == 'compare':
+        compare = COMPARISONS[expression[1]]
+        left, right = compile_operand(expression[2], alias), compile_operand(expression[3], alias)
+
+        def condition(record):
+            left_value, right_value = left(record), right(record)
+            if left_value is None or left_value is MISSING or right_value is None or right_value is MISSING:
+                return None
+            try:
+                return compare(left_value, right_value)
+            except TypeError:
+                return None
+        return condition
+    raise SelectSyntaxError("Unknown expression {}".format(kind))
+
+
+def get_required_literals(expression):
+    """
+     Return the JSON encoded string literals of which a line must contain one for the condition
+     to be true, None when there is no such set.
+    """
+    kind = expression[0]
+    if kind == 'and':
+        # Either side must be true, the smaller requirement filters best.
+        sides = [get_required_literals(side) for side in expression[1:]]
+        sides = [side for side in sides if side is not None]
+        return min(sides, key=len) if sides else None
+    if kind == 'or':
+        left, right = get_required_literals(expression[1]), get_required_literals(expression[2])
+        return None if left is None or right is None else left | right
+    if kind == 'in' and not expression[3]:
+        literals = expression[2]
+    elif kind == 'compare' and expression[1] == '=':
+        literals = [operand for operand in expression[2:] if operand[0] == 'literal']
+        if len(literals) != 1 or expression[2][0] == expression[3][0]:
+            return None
+    else:
+        return None
+    if not all(operand[0] == 'literal' and isinstance(operand[1], str) and
+               PLAIN_STRING_PATTERN.fullmatch(operand[1]) for operand in literals):
+        return None
+    return frozenset('"{}"'.format(operand[1]).encode('utf-8') for operand in literals)
+
+
+def project(query: Query, record):
+    if query.projection == '*':
+        return record
+    projected = {}
+    for path in query.projection:
+        value = resolve(record, path, query.alias)
+        # Missing values are left out of the output record, as S3 Select does for JSON output.
+        if value is not MISSING:
+            projected[path[-1][0]] = value
+    return projected
+
+
+def run_query(query: Query, records):
+    """
+     Yield the output records of the query over an iterable of input records.
+    """
+    condition = None if query.where is None else compile_condition(query.where, query.alias)
+    if query.projection == 'count':
+        count = 0
+        for record in records:
+            if condition is None or condition(record) is True:
+                count += 1
+        yield {'_1': count}
+        return
+    returned = 0
+    if query.limit == 0:
+        return
+    for record in records:
+        if condition is None or condition(record) is True:
+            yield project(query, record)
+            returned += 1
+            if query.limit is not None and returned >= query.limit:
+                return
+
+
+def parse_json_lines(lines, required_literals=None):
+    """
+     Parse JSON lines, skipping the ones which contain none of the required literals.
+    """
+    if required_literals is not None:
+        required_text = [literal.decode('utf-8') for literal in required_literals]
+    for line in lines:
+        if required_literals is not None:
+            required = required_literals if isinstance(line, bytes) else required_text
+            if not any(literal in line for literal in required):
+                continue
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield json.loads(line)
+
+
+def format_record(record, output_serialization: dict) -> str:
+    """
+     Serialize an output record the way S3 Select does for the given OutputSerialization.
+    """
+    if 'CSV' in output_serialization:
+        delimiter = output_serialization['CSV'].get('RecordDelimiter', '\n')
+        row = StringIO()
+        csv.writer(row, delimiter=output_serialization['CSV'].get('FieldDelimiter', ','),
+                   lineterminator=delimiter).writerow(
+            json.dumps(value) if isinstance(value, (dict, list)) else value for value in record.values())
+        return row.getvalue()
+    delimiter = output_serialization.get('JSON', {}).get('RecordDelimiter', '\n')
+    return json.dumps(record, separators=(',', ':')) + delimiter
+
+
+def select_lines(expression: str, lines, output_serialization: dict):
+    """
+     Run an S3 Select expression over JSON lines and yield the serialized output records.
+    """
+    query = parse(expression)
+    required_literals = None if query.where is None else get_required_literals(query.where)
+    for record in run_query(query, parse_json_lines(lines, required_literals)):
+        yield format_record(record, output_serialization)
@@ -0,0 +1,242 @@
+'''
+Stand-ins for the services the active learning loop drives.
+
+Every fake reads its inputs from and writes its outputs to the local storage stand-in in the
+same layout as the real service, and reports a modeled duration, so the handlers downstream
+run unchanged:
+    - FakeTrainer:   createTrainingJob.sync. Writes a model artifact remembering how many
+                     labeled rows it was trained on, read from the RecordIO shards of its
+                     train channel.
+    - ModelRegistry: createModel. Maps model names to artifacts.
+    - NoisyDetector: createTransformJob.sync. Writes one SSD style `.out` file per staged image,
+                     derived from the ground truth boxes with noise which shrinks as the model
+                     is trained on more rows.
+    - OracleLabeler: createLabelingJob.sync. Labels every row with its ground truth boxes, as a
+                     perfect Ground Truth workforce would.
+Resource callables take (parameters, execution) like the Task states which invoke them.
+'''
+import json
+import math
+import os
+import random
+
+from io import StringIO
+
+from recordio import iter_records
+from s3_helper import S3Ref, download_bytesio, download_stringio, get_uris_inside_prefix, upload
+
+from simulator.state_machine import SimulatedResult, StatesError, simulated_duration
+
+TRAINING_JOB_ARN = "arn:aws:states:::sagemaker:createTrainingJob.sync"
+CREATE_MODEL_ARN = "arn:aws:states:::sagemaker:createModel"
+TRANSFORM_JOB_ARN = "arn:aws:states:::sagemaker:createTransformJob.sync"
+LABELING_JOB_ARN = "arn:aws:states:::sagemaker:createLabelingJob.sync"
+START_EXECUTION_ARN = "arn:aws:states:::states:startExecution.sync"
+
+
+class GroundTruth:
+    """
+     The true boxes of every image, keyed by source-ref, in the Ground Truth bounding box format.
+    """
+
+    def __init__(self, path):
+        with open(path) as f:
+            description = json.load(f)
+        self.class_map = description['class_map']
+        self.images = description['images']
+
+    def image_name_index(self):
+        return {os.path.basename(source_ref): source_ref for source_ref in self.images}
+
+
+def read_manifest_rows(s3_uri):
+    return [json.loads(line) for line in download_stringio(S3Ref.from_uri(s3_uri)) if line.strip()]
+
+
+def count_channel_records(s3_data_source):
+    if s3_data_source['S3DataType'] != 'ManifestFile':
+        return len(read_manifest_rows(s3_data_source['S3Uri']))
+    prefix, *keys = json.loads(download_bytesio(S3Ref.from_uri(s3_data_source['S3Uri'])).getvalue())
+    return sum(sum(1 for _ in iter_records(download_bytesio(S3Ref.from_uri(prefix['prefix'] + key)).getvalue()))
+               for key in keys)
+
+
+def check_unique_name(names, name, service):
+    # SageMaker refuses to create two jobs or models with the same name.
+    if name in names:
+        raise StatesError("SageMaker.ResourceInUse", "{} {} already exists".format(service, name))
+    names.add(name)
+
+
+class FakeTrainer:
+
+    def __init__(self, startup_seconds=360.0, seconds_per_row=0.5):
+        self.startup_seconds = startup_seconds
+        self.seconds_per_row = seconds_per_row
+        self.job_names = set()
+        self.jobs = []
+
+    def __call__(self, parameters, execution):
+        job_name = parameters['TrainingJobName']
+        check_unique_name(self.job_names, job_name, "Training job")
+        channels = {channel['ChannelName']: channel['DataSource']['S3DataSource']
+                    for channel in parameters['InputDataConfig']}
+        training_rows = count_channel_records(channels['train'])
+        artifact = S3Ref.from_uri("{}{}/output/model.json".format(
+            parameters['OutputDataConfig']['S3OutputPath'], job_name))
+        upload(StringIO(json.dumps({'training_rows': training_rows})), artifact)
+        self.jobs.append({'TrainingJobName': job_name, 'training_rows': training_rows})
+        return SimulatedResult({
+            'TrainingJobName': job_name,
+            'TrainingJobStatus': 'Completed',
+            'ModelArtifacts': {'S3ModelArtifacts': artifact.get_uri()}
+        }, self.startup_seconds + self.seconds_per_row * training_rows)
+
+
+class ModelRegistry:
+
+    def __init__(self):
+        self.models = {}
+
+    def __call__(self, parameters, execution):
+        name = parameters['ModelName']
+        if name in self.models:
+            raise StatesError("SageMaker.ValidationException", "Model {} already exists".format(name))
+        self.models[name] = parameters['PrimaryContainer']['ModelDataUrl']
+        return {'ModelArn': "arn:aws:sagemaker:local:000000000000:model/{}".format(name.lower())}
+
+
+class NoisyDetector:
+    """
+     Predicts the ground truth boxes with noise. The quality of a model trained on n rows is
+     n / (n + learning_rows): box jitter and the score spread shrink, and true box scores rise,
+     as it approaches 1.
+    """
+
+    def __init__(self, ground_truth, model_registry, seed=0, learning_rows=50, jitter=0.15, recall=0.95,
+                 false_positives=1.0, startup_seconds=300.0, seconds_per_image=0.05):
+        self.ground_truth = ground_truth
+        self.model_registry = model_registry
+        self.seed = seed
+        self.learning_rows = learning_rows
+        self.jitter = jitter
+        self.recall = recall
+        self.false_positives = false_positives
+        self.startup_seconds = startup_seconds
+        self.seconds_per_image = seconds_per_image
+        self.job_names = set()
+        self.images_by_name = ground_truth.image_name_index()
+
+    def quality(self, training_rows):
+        return training_rows / float(training_rows + self.learning_rows)
+
+    def predict(self, rng, annotations, image_size, quality):
+        width, height = image_size['width'], image_size['height']
+        boxes = []
+        for annotation in annotations:
+            if rng.random() > self.recall:
+                continue
+            jitter = self.jitter * (1.0 - quality)
+            xmin = annotation['left'] / width + rng.gauss(0, jitter) * annotation['width'] / width
+            ymin = annotation['top'] / height + rng.gauss(0, jitter) * annotation['height'] / height
+            xmax = (annotation['left'] + annotation['width']) / width + rng.gauss(0, jitter) * annotation['width'] / width
+            ymax = (annotation['top'] + annotation['height']) / height + rng.gauss(0, jitter) * annotation['height'] / height
+            score = min(1.0, max(0.0, rng.gauss(0.3 + 0.65 * quality, 0.1 + 0.15 * (1.0 - quality))))
+            boxes.append([float(annotation['class_id']), round(score, 4),
+                          round(min(max(xmin, 0.0), 1.0), 4), round(min(max(ymin, 0.0), 1.0), 4),
+                          round(min(max(xmax, 0.0), 1.0), 4), round(min(max(ymax, 0.0), 1.0), 4)])
+        # Poisson distributed false positives, with scores which drop as the model improves.
+        n_false_positives = 0
+        threshold = math.exp(-self.false_positives)
+        product = rng.random()
+        while product > threshold:
+            n_false_positives += 1
+            product *= rng.random()
+        for _ in range(n_false_positives):
+            xmin, ymin = rng.uniform(0.0, 0.8), rng.uniform(0.0, 0.8)
+            score = rng.uniform(0.0, 0.6 * (1.0 - quality) + 0.05)
+            boxes.append([float(rng.randrange(len(self.ground_truth.class_map))), round(score, 4),
+                          round(xmin, 4), round(ymin, 4),
+                          round(rng.uniform(xmin + 0.01, 1.0), 4), round(rng.uniform(ymin + 0.01, 1.0), 4)])
+        return boxes
+
+    def __call__(self, parameters, execution):
+        job_name = parameters['TransformJobName']
+        check_unique_name(self.job_names, job_name, "Transform job")
+        model = json.load(download_stringio(S3Ref.from_uri(self.model_registry.models[parameters['ModelName']])))
+        quality = self.quality(model['training_rows'])
+        input_ref = S3Ref.from_uri(parameters['TransformInput']['DataSource']['S3DataSource']['S3Uri'])
+        output_uri = parameters['TransformOutput']['S3OutputPath']
+        keys = get_uris_inside_prefix(input_ref)
+        for key in keys:
+            name = os.path.basename(key)
+            truth = self.ground_truth.images[self.images_by_name[name]]
+            rng = random.Random("{}:{}:{}".format(self.seed, job_name, name))
+            prediction = {'prediction': self.predict(rng, truth['annotations'], truth['image_size'], quality)}
+            relative_key = key[len(input_ref.key):].lstrip("/")
+            upload(StringIO(json.dumps(prediction)), S3Ref.from_uri(output_uri + relative_key + ".out"))
+        return SimulatedResult({'TransformJobName': job_name, 'TransformJobStatus': 'Completed'},
+                               self.startup_seconds + self.seconds_per_image * len(keys))
+
+
+class OracleLabeler:
+
+    def __init__(self, ground_truth, seconds_per_image=30.0, cost_per_image=0.08, job_startup_seconds=600.0):
+        self.ground_truth = ground_truth
+        self.seconds_per_image = seconds_per_image
+        self.cost_per_image = cost_per_image
+        self.job_startup_seconds = job_startup_seconds
+        self.job_names = set()
+        self.jobs = []
+
+    def __call__(self, parameters, execution):
+        job_name = parameters['LabelingJobName']
+        check_unique_name(self.job_names, job_name, "Labeling job")
+        label_attribute_name = parameters['LabelAttributeName']
+        rows = read_manifest_rows(parameters['InputConfig']['DataSource']['S3DataSource']['ManifestS3Uri'])
+        output = StringIO()
+        for row in rows:
+            truth = self.ground_truth.images[row['source-ref']]
+            row[label_attribute_name] = {
+                'annotations': truth['annotations'],
+                'image_size': [truth['image_size']]
+            }
+            row['{}-metadata'.format(label_attribute_name)] = {
+                'objects': [{'confidence': 1.0} for _ in truth['annotations']],
+                'class-map': self.ground_truth.class_map,
+                'type': 'groundtruth/object-detection',
+                'human-annotated': 'yes',
+                'creation-date': '2020-06-01T00:00:00.000000',
+                'job-name': 'labeling-job/{}'.format(job_name)
+            }
+            output.write(json.dumps(row) + "\n")
+        output_ref = S3Ref.from_uri("{}{}/manifests/output/output.manifest".format(
+            parameters['OutputConfig']['S3OutputPath'], job_name))
+        upload(output, output_ref)
+        self.jobs.append({'LabelingJobName': job_name, 'images': len(rows),
+                          'objects': sum(len(self.ground_truth.images[row['source-ref']]['annotations']) for row in rows)})
+        return SimulatedResult({
+            'LabelingJobName': job_name,
+            'LabelingJobStatus': 'Completed',
+            'LabelCounters': {'TotalLabeled': len(rows), 'HumanLabeled': len(rows)},
+            'LabelingJobOutput': {'OutputDatasetS3Uri': output_ref.get_uri()}
+        }, self.job_startup_seconds + self.seconds_per_image * len(rows))
+
+    @property
+    def labeled_images(self):
+        return sum(job['images'] for job in self.jobs)
+
+    @property
+    def cost(self):
+        return self.labeled_images * self.cost_per_image
+
+
+def start_execution(parameters, execution):
+    """
+     states:startExecution.sync: run the nested state machine and report the time its states took.
+    """
+    first_entry = len(execution.trace)
+    output = execution.run(parameters['StateMachineArn'], parameters['Input'])
+    simulated_seconds = simulated_duration(
+        entry for entry in execution.trace[first_entry:] if entry['depth'] == execution.depth + 1)
+    return SimulatedResult({'Status': 'SUCCEEDED', 'Output': json.dumps(output)}, simulated_seconds)
@@ -0,0 +1,300 @@
+'''
+Run the ActiveLearningLoop state machine offline.
+
+The state machines are read from the SAM template and interpreted locally. Lambda states call
+the real handlers against the local storage stand-in, while training, transform and labeling
+are served by the fakes in simulator/fakes.py over a synthetic dataset whose ground truth is
+known. The report lists, per state, how often it ran, the measured wall clock time and the
+modeled duration of the faked services, plus iteration counts, labeling cost and the accuracy
+of the autoannotations, so loop policies can be compared without AWS.
+
+    python -m simulator.run --rows 500 --output simulation.json
+'''
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from collections import OrderedDict
+from types import SimpleNamespace
+
+LAMBDA_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_ROOT = os.path.join(LAMBDA_ROOT, "dependency", "python")
+# Lambda puts layer content on the path, do the same for the handlers imported below.
+for path in (LAMBDA_ROOT, LAYER_ROOT):
+    if path not in sys.path:
+        sys.path.append(path)
+
+from benchmarks import synthetic  # noqa: E402
+from simulator import fakes  # noqa: E402
+from simulator.state_machine import Execution, SimulatedResult, Template, load_template, simulated_duration  # noqa: E402
+
+DEFAULT_TEMPLATE = os.path.join(LAMBDA_ROOT, "template.yaml")
+LOOP_STATE_MACHINE = "ActiveLearningLoop"
+INPUT_MANIFEST_KEY = "simulation/input.manifest"
+LABEL_CONFIG_KEY = "simulation/labels.json"
+OUTPUT_PREFIX = "simulation/output/"
+GROUND_TRUTH_FILE = "ground_truth.json"
+LABELING_JOB_NAME_PREFIX = "simulation"
+MATCH_IOU = 0.5
+
+
+def generate_simulation_dataset(root, n_rows, seed=0, max_objects=4, duplicate_fraction=0.0):
+    """
+    Write an unlabeled input manifest, its images, the label category config and the ground
+    truth the fakes label and predict from. Every record has a frame of its own, except that a
+    duplicate_fraction of them repeat the frame and ground truth of the record before, like
+    sequential frames of a vehicle standing still.
+    """
+    import random
+    rng = random.Random(seed)
+    images = OrderedDict()
+    frame_seeds = []
+    annotations = None
+    for record_id in range(n_rows):
+        if annotations is not None and rng.random() < duplicate_fraction:
+            frame_seeds.append(frame_seeds[-1])
+        else:
+            frame_seeds.append(record_id)
+            annotations = synthetic.make_annotations(
+                rng, rng.randint(1, max_objects), synthetic.IMAGE_WIDTH, synthetic.IMAGE_HEIGHT)
+        images[synthetic.s3_uri(synthetic.image_key(record_id))] = {
+            'annotations': [dict(annotation) for annotation in annotations],
+            'image_size': {'width': synthetic.IMAGE_WIDTH, 'height': synthetic.IMAGE_HEIGHT, 'depth': 3}
+        }
+    synthetic.write_jsonl(root, INPUT_MANIFEST_KEY, ({'source-ref': source_ref} for source_ref in images))
+    with open(synthetic.object_path(root, LABEL_CONFIG_KEY), "w") as f:
+        json.dump({
+            'document-version': '2018-11-28',
+            'labels': [{'label': name} for name in synthetic.CLASS_MAP.values()],
+            'class-map': synthetic.CLASS_MAP
+        }, f)
+    for record_id, frame_seed in enumerate(frame_seeds):
+        with open(synthetic.object_path(root, synthetic.image_key(record_id)), "wb") as f:
+            f.write(synthetic.make_image_bytes(frame_seed))
+    with open(os.path.join(root, GROUND_TRUTH_FILE), "w") as f:
+        json.dump({'class_map': synthetic.CLASS_MAP, 'images': images}, f)
+
+
+def loop_input(pipelined=False):
+    return {
+        'InputConfig': {
+            'DataSource': {'S3DataSource': {'ManifestS3Uri': synthetic.s3_uri(INPUT_MANIFEST_KEY)}},
+            'DataAttributes': {'ContentClassifiers': []}
+        },
+        'OutputConfig': {'S3OutputPath': synthetic.s3_uri(OUTPUT_PREFIX)},
+        'LabelAttributeName': synthetic.LABEL_ATTRIBUTE_NAME,
+        'LabelingJobNamePrefix': LABELING_JOB_NAME_PREFIX,
+        'LabelCategoryConfigS3Uri': synthetic.s3_uri(LABEL_CONFIG_KEY),
+        'RoleArn': 'arn:aws:iam::000000000000:role/simulation',
+        'HumanTaskConfig': {},
+        'PipelineIterations': pipelined
+    }
+
+
+def lambda_resource(handler_path):
+    """
+    Wrap a handler such as ActiveLearning/perform_active_learning.lambda_handler as a Task resource.
+    """
+    module_path, function_name = handler_path.rsplit(".", 1)
+    handler = getattr(importlib.import_module(module_path.replace("/", ".")), function_name)
+
+    def invoke(parameters, execution):
+        from metrics import get_metrics
+        context = SimpleNamespace(aws_request_id="simulation-{}".format(len(execution.trace)),
+                                  function_name=module_path)
+        # The metrics record every handler prints at the end of an invocation is kept out of the report.
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = handler(parameters, context)
+        io_stats = get_metrics().io
+        return SimulatedResult(result, details={
+            's3_requests': sum(stats['count'] for stats in io_stats.values()),
+            's3_bytes': sum(stats['bytes'] for stats in io_stats.values())
+        })
+    return invoke
+
+
+def build_resources(template, ground_truth, args):
+    model_registry = fakes.ModelRegistry()
+    services = SimpleNamespace(
+        trainer=fakes.FakeTrainer(args.training_startup_seconds, args.training_seconds_per_row),
+        model_registry=model_registry,
+        detector=fakes.NoisyDetector(ground_truth, model_registry, seed=args.seed, learning_rows=args.learning_rows,
+                                     jitter=args.jitter, recall=args.recall, false_positives=args.false_positives),
+        labeler=fakes.OracleLabeler(ground_truth, args.labeling_seconds_per_image, args.labeling_cost_per_image)
+    )
+    resources = {arn: lambda_resource(handler) for arn, handler in template.function_handlers().items()}
+    resources.update({
+        fakes.TRAINING_JOB_ARN: services.trainer,
+        fakes.CREATE_MODEL_ARN: services.model_registry,
+        fakes.TRANSFORM_JOB_ARN: services.detector,
+        fakes.LABELING_JOB_ARN: services.labeler,
+        fakes.START_EXECUTION_ARN: fakes.start_execution,
+    })
+    return resources, services
+
+
+def box_iou(a, b):
+    width = min(a['left'] + a['width'], b['left'] + b['width']) - max(a['left'], b['left'])
+    height = min(a['top'] + a['height'], b['top'] + b['height']) - max(a['top'], b['top'])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / float(a['width'] * a['height'] + b['width'] * b['height'] - intersection)
+
+
+def score_autoannotations(rows, ground_truth, label_attribute_name):
+    """
+    Match autoannotated boxes to the ground truth boxes of the same class at IoU >= MATCH_IOU.
+    """
+    images, exact_images, predicted, truths, matched = 0, 0, 0, 0, 0
+    for row in rows:
+        metadata = row.get("{}-metadata".format(label_attribute_name), {})
+        if metadata.get('human-annotated') != 'no':
+            continue
+        boxes = row[label_attribute_name]['annotations']
+        remaining = list(ground_truth.images[row['source-ref']]['annotations'])
+        image_matches = 0
+        for box in sorted(boxes, key=lambda box: -box.get('score', 0)):
+            candidates = [(box_iou(box, truth), i) for i, truth in enumerate(remaining)
+                          if int(truth['class_id']) == int(box['class_id'])]
+            best_iou, best = max(candidates, default=(0.0, None))
+            if best is not None and best_iou >= MATCH_IOU:
+                remaining.pop(best)
+                image_matches += 1
+        images += 1
+        predicted += len(boxes)
+        truths += len(ground_truth.images[row['source-ref']]['annotations'])
+        matched += image_matches
+        exact_images += int(image_matches == len(boxes) and not remaining)
+    return {
+        'images': images,
+        'exact_image_fraction': exact_images / float(images) if images else None,
+        'box_precision': matched / float(predicted) if predicted else None,
+        'box_recall': matched / float(truths) if truths else None
+    }
+
+
+def summarize(execution, services, ground_truth, final_manifest_rows, n_rows):
+    states = OrderedDict()
+    for entry in execution.trace:
+        name = "{}.{}".format(entry['state_machine'], entry['state'])
+        stats = states.setdefault(name, {'count': 0, 'wall_seconds': 0.0, 'simulated_seconds': 0.0,
+                                         's3_requests': 0})
+        stats['count'] += 1
+        stats['wall_seconds'] += entry['wall_seconds']
+        stats['simulated_seconds'] += simulated_duration([entry])
+        stats['s3_requests'] += entry.get('s3_requests', 0)
+    top_level = [entry for entry in execution.trace if entry['depth'] == 1]
+    label_counts = {'human': 0, 'auto': 0, 'unlabeled': 0}
+    for row in final_manifest_rows:
+        annotated = row.get("{}-metadata".format(synthetic.LABEL_ATTRIBUTE_NAME), {}).get('human-annotated')
+        label_counts['human' if annotated == 'yes' else 'auto' if annotated == 'no' else 'unlabeled'] += 1
+    return OrderedDict([
+        ('rows', n_rows),
+        ('wall_seconds', sum(entry['wall_seconds'] for entry in top_level)),
+        ('simulated_seconds', simulated_duration(top_level)),
+        ('iterations', OrderedDict([
+            ('transitions', len(execution.trace)),
+            ('active_learning', len(services.trainer.jobs)),
+            ('labeling_jobs', len(services.labeler.jobs)),
+        ])),
+        ('labeling', OrderedDict([
+            ('images', services.labeler.labeled_images),
+            ('objects', sum(job['objects'] for job in services.labeler.jobs)),
+            ('cost', round(services.labeler.cost, 4)),
+        ])),
+        ('final_labels', label_counts),
+        ('autoannotation', score_autoannotations(final_manifest_rows, ground_truth, synthetic.LABEL_ATTRIBUTE_NAME)),
+        ('training_jobs', services.trainer.jobs),
+        ('states', states),
+    ])
+
+
+def simulate(args):
+    root = args.root or tempfile.mkdtemp(prefix="byoal-simulation-")
+    os.environ["BYOAL_LOCAL_S3_ROOT"] = root
+    import s3_helper
+    from ActiveLearning import s3_helper as active_learning_s3_helper
+    s3_helper.reset_s3_client()
+    active_learning_s3_helper.reset_s3_client()
+
+    generate_simulation_dataset(root, args.rows, seed=args.seed, max_objects=args.max_objects,
+                                duplicate_fraction=args.duplicate_fraction)
+    ground_truth = fakes.GroundTruth(os.path.join(root, GROUND_TRUTH_FILE))
+    template = Template(load_template(args.template))
+    state_machines = template.state_machines()
+    resources, services = build_resources(template, ground_truth, args)
+    # Handlers set the root logger to INFO when imported, which happened in build_resources.
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    loop_arn = next(arn for arn, machine in state_machines.items() if machine.name.startswith(LOOP_STATE_MACHINE))
+    execution = Execution(state_machines, resources)
+    output = execution.run(loop_arn, loop_input(args.pipelined))
+    final_manifest_rows = fakes.read_manifest_rows(output['FinalManifestS3Uri'])
+    report = summarize(execution, services, ground_truth, final_manifest_rows, args.rows)
+    report['pipelined'] = args.pipelined
+    report['root'] = root
+    report['output'] = output
+    return report
+
+
+def print_summary(report):
+    print("{} rows: {} active learning iterations, {} labeling jobs, {} images labeled by humans (cost {})".format(
+        report['rows'], report['iterations']['active_learning'], report['iterations']['labeling_jobs'],
+        report['labeling']['images'], report['labeling']['cost']), file=sys.stderr)
+    print("final labels {}, autoannotation {}".format(report['final_labels'], report['autoannotation']),
+          file=sys.stderr)
+    print("simulated {:.0f}s, measured {:.2f}s".format(report['simulated_seconds'], report['wall_seconds']),
+          file=sys.stderr)
+    print("{:<70} {:>6} {:>10} {:>12} {:>8}".format("state", "count", "wall s", "simulated s", "s3 req"),
+          file=sys.stderr)
+    for name, stats in report['states'].items():
+        print("{:<70} {:>6} {:>10.3f} {:>12.1f} {:>8}".format(
+            name, stats['count'], stats['wall_seconds'], stats['simulated_seconds'], stats['s3_requests']),
+            file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200, help="Number of images in the synthetic dataset.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-objects", type=int, default=4, help="Maximum ground truth boxes per image.")
+    parser.add_argument("--duplicate-fraction", type=float, default=0.25,
+                        help="Fraction of images repeating the frame before them.")
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE)
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Train the next iteration while the current selections are being labeled.")
+    parser.add_argument("--root", help="Local storage folder, a new temporary folder by default.")
+    parser.add_argument("--learning-rows", type=int, default=50,
+                        help="Training rows at which the detector reaches half of its final quality.")
+    parser.add_argument("--jitter", type=float, default=0.15, help="Box jitter of an untrained detector.")
+    parser.add_argument("--recall", type=float, default=0.95, help="Fraction of true boxes the detector finds.")
+    parser.add_argument("--false-positives", type=float, default=1.0, help="Mean false positives per image.")
+    parser.add_argument("--labeling-cost-per-image", type=float, default=0.08)
+    parser.add_argument("--labeling-seconds-per-image", type=float, default=30.0)
+    parser.add_argument("--training-startup-seconds", type=float, default=360.0)
+    parser.add_argument("--training-seconds-per-row", type=float, default=0.5)
+    parser.add_argument("--output", help="Write the full report as JSON to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Show the handler logs.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    report = simulate(args)
+    print_summary(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Wrote report to {}".format(args.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
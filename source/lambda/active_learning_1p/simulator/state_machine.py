@@ -0,0 +1,385 @@
+'''
+Interpreter for the Step Functions state machines declared in the SAM templates.
+
+Only the parts of the Amazon States Language used by this solution are implemented: Task,
+Choice, Parallel, Pass, Succeed and Fail states, InputPath / Parameters / ResultPath / OutputPath with
+plain reference paths ($.a.b[0]) and the comparison operators of Choice rules. Task resources
+are resolved through a dictionary of callables, so lambda functions can run the real handlers
+while SageMaker and nested executions are served by fakes.
+'''
+import copy
+import json
+import re
+import time
+
+from collections import OrderedDict
+
+DEFAULT_PSEUDO_PARAMETERS = {
+    'AWS::Region': 'local',
+    'AWS::AccountId': '000000000000',
+    'AWS::StackName': 'simulation',
+    'AWS::Partition': 'aws',
+}
+MAX_TRANSITIONS = 100000
+
+SUBSTITUTION_PATTERN = re.compile(r"\$\{([^}]+)\}")
+PATH_COMPONENT_PATTERN = re.compile(r"\.([^.\[]+)|\[(\d+)\]")
+
+
+class StatesError(Exception):
+    """
+     A state machine execution failure, named after the Step Functions error it stands for.
+    """
+
+    def __init__(self, error, cause):
+        super().__init__("{}: {}".format(error, cause))
+        self.error = error
+        self.cause = cause
+
+
+def load_template(template_path):
+    """
+     Load a CloudFormation/SAM template, turning short form intrinsics such as !Sub into their long form.
+    """
+    import yaml
+
+    class TemplateLoader(yaml.SafeLoader):
+        pass
+
+    def construct_intrinsic(loader, tag_suffix, node):
+        name = "Ref" if tag_suffix == "Ref" else "Fn::{}".format(tag_suffix)
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+            if tag_suffix == "GetAtt":
+                value = value.split(".", 1)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        return {name: value}
+
+    TemplateLoader.add_multi_constructor("!", construct_intrinsic)
+    with open(template_path) as f:
+        return yaml.load(f, Loader=TemplateLoader)
+
+
+class Template:
+    """
+     The lambda functions and state machines of a template, with every ${...} substituted.
+    """
+
+    def __init__(self, template, pseudo_parameters=None):
+        self.template = template
+        self.pseudo_parameters = dict(DEFAULT_PSEUDO_PARAMETERS, **(pseudo_parameters or {}))
+        self.resources = template.get('Resources', {})
+        self.parameters = {
+            name: str(parameter.get('Default', ''))
+            for name, parameter in template.get('Parameters', {}).items()
+        }
+
+    def function_arn(self, logical_id):
+        return "arn:aws:lambda:{}:{}:function:{}".format(
+            self.pseudo_parameters['AWS::Region'], self.pseudo_parameters['AWS::AccountId'], logical_id)
+
+    def state_machine_arn(self, name):
+        return "arn:aws:states:{}:{}:stateMachine:{}".format(
+            self.pseudo_parameters['AWS::Region'], self.pseudo_parameters['AWS::AccountId'], name)
+
+    def resolve_reference(self, reference):
+        if reference in self.pseudo_parameters:
+            return self.pseudo_parameters[reference]
+        if reference in self.parameters:
+            return self.parameters[reference]
+        logical_id, _, attribute = reference.partition(".")
+        resource = self.resources.get(logical_id)
+        if resource is not None and attribute == "Arn":
+            if resource['Type'] == 'AWS::StepFunctions::StateMachine':
+                return self.state_machine_arn(self.resolve(resource['Properties']['StateMachineName']))
+            return self.function_arn(logical_id)
+        if resource is not None and attribute == "":
+            return logical_id
+        raise KeyError("Can not resolve ${{{}}} in the template".format(reference))
+
+    def substitute(self, text, variables=None):
+        variables = variables or {}
+
+        def replace(match):
+            reference = match.group(1)
+            if reference in variables:
+                return str(self.resolve(variables[reference]))
+            return str(self.resolve_reference(reference))
+        return SUBSTITUTION_PATTERN.sub(replace, text)
+
+    def resolve(self, value):
+        """
+         Resolve the intrinsic functions used for names and definitions.
+        """
+        if isinstance(value, dict) and len(value) == 1:
+            (name, argument), = value.items()
+            if name == 'Fn::Sub':
+                if isinstance(argument, list):
+                    return self.substitute(argument[0], argument[1])
+                return self.substitute(argument)
+            if name == 'Ref':
+                return self.resolve_reference(argument)
+            if name == 'Fn::GetAtt':
+                return self.resolve_reference(".".join(argument))
+        return value
+
+    def function_handlers(self):
+        """
+         Map the ARN of every lambda function to its handler, e.g. Bootstrap/add_record_id.lambda_handler.
+        """
+        handlers = {}
+        for logical_id, resource in self.resources.items():
+            if resource['Type'] in ('AWS::Serverless::Function', 'AWS::Lambda::Function'):
+                handlers[self.function_arn(logical_id)] = resource['Properties']['Handler']
+        return handlers
+
+    def state_machines(self):
+        """
+         Map the ARN of every state machine to its parsed definition.
+        """
+        machines = {}
+        for resource in self.resources.values():
+            if resource['Type'] == 'AWS::StepFunctions::StateMachine':
+                properties = resource['Properties']
+                name = self.resolve(properties['StateMachineName'])
+                definition = json.loads(self.resolve(properties['DefinitionString']))
+                machines[self.state_machine_arn(name)] = StateMachine(name, definition)
+        return machines
+
+
+def read_path(data, path):
+    """
+     Read a reference path such as $.meta_data.counts.unlabeled.
+    """
+    if path == "$":
+        return data
+    if not path.startswith("$"):
+        raise StatesError("States.Runtime", "Invalid path {}".format(path))
+    value = data
+    for match in PATH_COMPONENT_PATTERN.finditer(path, 1):
+        name, index = match.groups()
+        try:
+            value = value[int(index)] if index is not None else value[name]
+        except (KeyError, IndexError, TypeError):
+            raise StatesError("States.Runtime", "The path {} could not be found in the input".format(path))
+    return value
+
+
+def write_path(data, path, value):
+    """
+     Apply a ResultPath: place value at path inside data and return the new state output.
+    """
+    if path is None:
+        return data
+    if path == "$":
+        return value
+    names = [match.group(1) for match in PATH_COMPONENT_PATTERN.finditer(path, 1)]
+    if not isinstance(data, dict):
+        raise StatesError("States.ResultPathMatchFailure", "Can not apply {} to {!r}".format(path, data))
+    target = data
+    for name in names[:-1]:
+        if not isinstance(target.get(name), dict):
+            target[name] = {}
+        target = target[name]
+    target[names[-1]] = value
+    return data
+
+
+def apply_parameters(parameters, data):
+    """
+     Build a Parameters (or Pass Result) template, evaluating the keys ending with .$ as paths.
+    """
+    if isinstance(parameters, dict):
+        result = OrderedDict()
+        for key, value in parameters.items():
+            if key.endswith(".$"):
+                result[key[:-2]] = copy.deepcopy(read_path(data, value))
+            else:
+                result[key] = apply_parameters(value, data)
+        return result
+    if isinstance(parameters, list):
+        return [apply_parameters(value, data) for value in parameters]
+    return parameters
+
+
+CHOICE_COMPARISONS = {
+    'StringEquals': lambda a, b: isinstance(a, str) and a == b,
+    'NumericEquals': lambda a, b: isinstance(a, (int, float)) and a == b,
+    'NumericLessThan': lambda a, b: isinstance(a, (int, float)) and a < b,
+    'NumericGreaterThan': lambda a, b: isinstance(a, (int, float)) and a > b,
+    'NumericLessThanEquals': lambda a, b: isinstance(a, (int, float)) and a <= b,
+    'NumericGreaterThanEquals': lambda a, b: isinstance(a, (int, float)) and a >= b,
+    'BooleanEquals': lambda a, b: isinstance(a, bool) and a == b,
+    'IsNull': lambda a, b: (a is None) == b,
+}
+
+
+def evaluate_rule(rule, data):
+    if 'And' in rule:
+        return all(evaluate_rule(nested, data) for nested in rule['And'])
+    if 'Or' in rule:
+        return any(evaluate_rule(nested, data) for nested in rule['Or'])
+    if 'Not' in rule:
+        return not evaluate_rule(rule['Not'], data)
+    if 'IsPresent' in rule:
+        try:
+            read_path(data, rule['Variable'])
+            return rule['IsPresent']
+        except StatesError:
+            return not rule['IsPresent']
+    value = read_path(data, rule['Variable'])
+    for operator, compare in CHOICE_COMPARISONS.items():
+        if operator in rule:
+            return compare(value, rule[operator])
+        if operator + "Path" in rule:
+            return compare(value, read_path(data, rule[operator + "Path"]))
+    raise StatesError("States.Runtime", "Unsupported choice rule {}".format(rule))
+
+
+def simulated_duration(entries):
+    """
+     Total duration of consecutive trace entries, modeled where the resource reported one.
+    """
+    return sum(entry['simulated_seconds'] if entry['simulated_seconds'] is not None else entry['wall_seconds']
+               for entry in entries)
+
+
+class StateMachine:
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+
+
+class Execution:
+    """
+     Runs state machines, calling `resources[arn](parameters, execution)` for Task states.
+     Every visited state is recorded in `trace` with its wall clock time, plus the simulated
+     duration the resource reports for work it only pretends to do.
+    """
+
+    def __init__(self, state_machines, resources, max_transitions=MAX_TRANSITIONS):
+        self.state_machines = state_machines
+        self.resources = resources
+        self.max_transitions = max_transitions
+        self.trace = []
+        self.depth = 0
+
+    def resolve_resource(self, resource):
+        if resource in self.resources:
+            return self.resources[resource]
+        raise StatesError("States.Runtime", "No simulated resource for {}".format(resource))
+
+    def run(self, state_machine_arn, execution_input):
+        """
+         Run an execution to completion and return its output. Nested executions started by
+         resources are recorded in the same trace with a larger depth.
+        """
+        self.depth += 1
+        try:
+            return self.run_states(self.state_machines[state_machine_arn], execution_input)
+        finally:
+            self.depth -= 1
+
+    def run_branches(self, machine, state, branch_input):
+        """
+         Run the branches of a Parallel state one after the other. As they would run
+         concurrently, the state takes as long as its longest branch.
+        """
+        outputs = []
+        durations = []
+        self.depth += 1
+        try:
+            for branch in state['Branches']:
+                first_entry = len(self.trace)
+                outputs.append(self.run_states(StateMachine(machine.name, branch), branch_input))
+                durations.append(simulated_duration(
+                    entry for entry in self.trace[first_entry:] if entry['depth'] == self.depth))
+        finally:
+            self.depth -= 1
+        return outputs, max(durations, default=0.0)
+
+    def run_states(self, machine, execution_input):
+        definition = machine.definition
+        data = copy.deepcopy(execution_input)
+        state_name = definition['StartAt']
+        while True:
+            if len(self.trace) >= self.max_transitions:
+                raise StatesError("States.Runtime", "More than {} transitions, the loop does not terminate".format(
+                    self.max_transitions))
+            state = definition['States'][state_name]
+            start = time.perf_counter()
+            simulated_seconds = None
+            details = {}
+            state_type = state['Type']
+            if state_type == 'Choice':
+                next_state = state.get('Default')
+                for rule in state['Choices']:
+                    if evaluate_rule(rule, data):
+                        next_state = rule['Next']
+                        break
+                if next_state is None:
+                    raise StatesError("States.NoChoiceMatched", "No choice matched in {}".format(state_name))
+            else:
+                effective_input = read_path(data, state.get('InputPath', "$"))
+                if state_type == 'Task':
+                    parameters = apply_parameters(state['Parameters'], effective_input) \
+                        if 'Parameters' in state else effective_input
+                    # Like Step Functions, only JSON crosses the boundary between states and tasks.
+                    parameters = json.loads(json.dumps(parameters))
+                    result = self.resolve_resource(state['Resource'])(parameters, self)
+                    if isinstance(result, SimulatedResult):
+                        simulated_seconds = result.simulated_seconds
+                        details = result.details
+                        result = result.value
+                    result = json.loads(json.dumps(result))
+                elif state_type == 'Parallel':
+                    branch_input = apply_parameters(state['Parameters'], effective_input) \
+                        if 'Parameters' in state else effective_input
+                    result, simulated_seconds = self.run_branches(machine, state, branch_input)
+                elif state_type == 'Pass':
+                    if 'Parameters' in state:
+                        result = apply_parameters(state['Parameters'], effective_input)
+                    else:
+                        result = state.get('Result', effective_input)
+                elif state_type == 'Succeed':
+                    result = effective_input
+                elif state_type == 'Fail':
+                    raise StatesError(state.get('Error', 'States.Fail'), state.get('Cause', state_name))
+                else:
+                    raise StatesError("States.Runtime", "Unsupported state type {}".format(state_type))
+                if state_type == 'Succeed':
+                    data = result
+                else:
+                    data = write_path(data, state.get('ResultPath', "$"), copy.deepcopy(result))
+                data = read_path(data, state.get('OutputPath', "$"))
+                next_state = None if state.get('End') or state_type == 'Succeed' else state['Next']
+            wall_seconds = time.perf_counter() - start
+            entry = {
+                'state_machine': machine.name,
+                'depth': self.depth,
+                'state': state_name,
+                'type': state_type,
+                'wall_seconds': wall_seconds,
+                'simulated_seconds': simulated_seconds
+            }
+            entry.update(details)
+            self.trace.append(entry)
+            if next_state is None:
+                return data
+            state_name = next_state
+
+
+class SimulatedResult:
+    """
+     Returned by resources to report how long the real service would have taken, None when the
+     measured wall clock time is representative, and extra details to record in the trace.
+    """
+
+    def __init__(self, value, simulated_seconds=None, details=None):
+        self.value = value
+        self.simulated_seconds = simulated_seconds
+        self.details = details or {}
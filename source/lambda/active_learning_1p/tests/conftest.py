@@ -0,0 +1,21 @@
+import pytest
+
+import metrics
+import s3_helper
+from ActiveLearning import s3_helper as handler_s3_helper
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    """
+     Serve s3 from a directory under tmp_path and yield that directory.
+    """
+    # The handlers import their own copy of s3_helper, both clients are reset.
+    monkeypatch.setenv(s3_helper.LOCAL_S3_ROOT_ENV, str(tmp_path / "s3"))
+    monkeypatch.setenv(s3_helper.CACHE_DIRECTORY_ENV, str(tmp_path / "cache"))
+    s3_helper.reset_s3_client()
+    handler_s3_helper.reset_s3_client()
+    metrics.get_metrics().reset()
+    yield tmp_path / "s3"
+    s3_helper.reset_s3_client()
+    handler_s3_helper.reset_s3_client()
@@ -0,0 +1,177 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import concurrency
+import metrics
+import s3_helper
+from concurrency import AdaptiveLimit
+from s3_helper import S3Ref, download_bytesio, upload_bytes
+
+
+class SlowDown(Exception):
+    response = {"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."}}
+
+
+class AccessDenied(Exception):
+    response = {"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(concurrency.time, "sleep", lambda seconds: None)
+    metrics.get_metrics().reset()
+
+
+def test_limit_grows_additively_and_halves_once_per_window():
+    limit = AdaptiveLimit(initial=4, maximum=6)
+    limit.in_flight = 4
+    for _ in range(4):
+        limit.on_success("get", 0.01)
+    assert limit.limit == 5
+
+    limit.on_throttle()
+    assert limit.limit == 2
+    # Requests sent under the old limit do not halve it again.
+    limit.on_throttle()
+    assert limit.limit == 2
+    for _ in range(4):
+        limit.release()
+    limit.on_throttle()
+    assert limit.limit == 1
+    assert metrics.get_metrics().values["s3.throttled"][0] == 3
+
+
+def test_limit_does_not_grow_when_it_holds_nothing_back():
+    limit = AdaptiveLimit(initial=4)
+    limit.in_flight = 1
+    for _ in range(100):
+        limit.on_success("get", 0.01)
+    assert limit.limit == 4
+
+
+def test_limit_halves_on_latency_spikes():
+    limit = AdaptiveLimit(initial=16)
+    for _ in range(50):
+        limit.on_success("get", 0.01)
+    assert limit.limit == 16
+    for _ in range(10):
+        limit.on_success("get", 1.0)
+    assert limit.limit == 8
+    assert metrics.get_metrics().values["s3.concurrency.decreased.latency"][0] == 1
+
+
+def test_call_retries_throttled_and_transient_errors():
+    limit = AdaptiveLimit()
+    failures = [SlowDown(), SlowDown()]
+
+    def flaky():
+        if failures:
+            raise failures.pop()
+        return "body"
+
+    assert limit.call("get", flaky) == "body"
+    assert metrics.get_metrics().values["s3.retries"][0] == 2
+    assert limit.in_flight == 0
+
+    calls = []
+
+    def denied():
+        calls.append(1)
+        raise AccessDenied()
+
+    with pytest.raises(AccessDenied):
+        limit.call("get", denied)
+    assert len(calls) == 1
+
+    def always_throttled():
+        calls.append(1)
+        raise SlowDown()
+
+    with pytest.raises(SlowDown):
+        limit.call("get", always_throttled)
+    assert len(calls) == 1 + concurrency.MAX_ATTEMPTS
+
+
+def test_concurrency_settles_below_the_prefix_capacity():
+    # A prefix which throttles whatever is sent beyond 6 concurrent requests.
+    capacity = 6
+    limit = AdaptiveLimit(initial=2, maximum=64)
+    lock = threading.Lock()
+    state = {"in_flight": 0, "peak": 0}
+
+    def request(i):
+        with lock:
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+            throttled = state["in_flight"] > capacity
+        try:
+            if throttled:
+                raise SlowDown()
+            time.sleep(0.001)
+            return i
+        finally:
+            with lock:
+                state["in_flight"] -= 1
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = list(executor.map(lambda i: limit.call("put", lambda: request(i)), range(2000)))
+
+    assert results == list(range(2000))
+    assert limit.limit <= 2 * capacity
+    assert state["peak"] <= limit.maximum
+    assert metrics.get_metrics().values["s3.concurrency.limit"][0] == limit.limit
+
+
+def test_s3_helper_retries_slow_down(local_storage):
+    source = S3Ref("bucket", "frames/1.jpg")
+    upload_bytes(b"image", source)
+    client = s3_helper.get_s3_client()
+    download_fileobj = client.download_fileobj
+    failures = [SlowDown()]
+
+    def throttled_download_fileobj(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return download_fileobj(*args, **kwargs)
+
+    client.download_fileobj = throttled_download_fileobj
+    assert download_bytesio(source).getvalue() == b"image"
+    assert metrics.get_metrics().values["s3.throttled"][0] == 1
+    assert metrics.get_metrics().io["get"]["count"] == 2
+
+
+class FakeRawResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_transfer_client_retries_parts_and_reports_throttling(monkeypatch):
+    from botocore.awsrequest import AWSResponse
+    monkeypatch.delenv(s3_helper.LOCAL_S3_ROOT_ENV, raising=False)
+    s3_helper.reset_s3_client()
+    metrics.get_metrics().reset()
+    limit = AdaptiveLimit(initial=8)
+    monkeypatch.setattr(concurrency, "_limit", limit)
+    client = s3_helper.get_transfer_client()
+    assert client is not s3_helper.get_s3_client()
+    responses = [
+        AWSResponse("https://bucket.s3.amazonaws.com/key", 503, {},
+                    FakeRawResponse(b"<Error><Code>SlowDown</Code><Message>Reduce your request rate.</Message></Error>")),
+        AWSResponse("https://bucket.s3.amazonaws.com/key", 200, {"ETag": '"etag"'}, FakeRawResponse(b"")),
+    ]
+    client.meta.events.register("before-send.s3", lambda **kwargs: responses.pop(0))
+    try:
+        upload_bytes(b"annotations", S3Ref("bucket", "autoannotated.manifest"))
+    finally:
+        s3_helper.reset_s3_client()
+
+    assert responses == []
+    assert limit.limit == 4
+    assert metrics.get_metrics().values["s3.throttled"][0] == 1
+    assert metrics.get_metrics().io["put"]["count"] == 1
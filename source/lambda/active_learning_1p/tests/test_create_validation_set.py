@@ -1,18 +1,27 @@
+import json
 from moto import mock_s3
 
 from ActiveLearning.create_validation_set import lambda_handler
 
 @mock_s3
 def test_prepare_for_labeling(monkeypatch):
-    def mock_copy(*args, **kwargs):
+    def mock_query(*args, **kwargs):
         source = args[0]
-        dest = args[1]
-        query = args[2]
-        print("Copy mocked out source {} dest {} query {}".format(source, dest, query))
-        return
+        query = args[1]
+        print("Query mocked out source {} query {}".format(source, query))
+        # 2700 pedestrians, 300 cars.
+        for record_id in range(3000):
+            class_id = 1 if record_id % 10 == 0 else 0
+            yield json.dumps({"id": record_id, "category": {"annotations": [{"class_id": class_id}]},
+                              "category-metadata": {"human-annotated": "yes"}})
+
+    uploaded = {}
+    def mock_upload(*args, **kwargs):
+        uploaded[args[1].get_uri()] = [json.loads(line) for line in args[0].getvalue().splitlines()]
 
     from ActiveLearning import create_validation_set
-    monkeypatch.setattr(create_validation_set, "copy_with_query", mock_copy)
+    monkeypatch.setattr(create_validation_set, "iter_query_lines", mock_query)
+    monkeypatch.setattr(create_validation_set, "upload", mock_upload)
 
     event = {
         'LabelAttributeName': 'category',
@@ -29,3 +38,7 @@ def test_prepare_for_labeling(monkeypatch):
     assert output['counts']['validation'] == 1000
     assert output['ValidationS3Uri'] == 's3://input/validation_input.manifest'
 
+    validation_rows = uploaded['s3://input/validation_input.manifest']
+    classes = [row["category"]["annotations"][0]["class_id"] for row in validation_rows]
+    assert len(set(row["id"] for row in validation_rows)) == 1000
+    assert (classes.count(0), classes.count(1)) == (700, 300)
@@ -0,0 +1,100 @@
+import random
+
+import numpy as np
+import pytest
+
+from ActiveLearning.evaluation import evaluate_detections, evaluate_validation_set
+from ActiveLearning.perform_active_learning import divert_validation_outputs
+from s3_helper import S3Ref
+
+
+def ground_truth(boxes, classes):
+    return np.array(boxes, dtype=float).reshape(-1, 4), np.array(classes, dtype=np.int64)
+
+
+def reference_average_precisions(ground_truths, detections, iou_threshold=0.5):
+    """
+    Straightforward VOC all-point AP, one detection and one box at a time.
+    """
+    def iou(a, b):
+        width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+        height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+        union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - width * height
+        return width * height / union if union > 0 else 0.0
+
+    results = {}
+    for class_id in sorted({int(c) for _, classes in ground_truths for c in classes}):
+        scored = sorted(((d[1], image, d) for image, image_detections in enumerate(detections)
+                         for d in image_detections if int(d[0]) == class_id), key=lambda x: -x[0])
+        matched = set()
+        true_positives = []
+        for _, image, detection in scored:
+            boxes, classes = ground_truths[image]
+            candidates = [(iou(detection[2:], box), i) for i, box in enumerate(boxes) if classes[i] == class_id]
+            best_iou, best = max(candidates, default=(0.0, None))
+            hit = best_iou >= iou_threshold and (image, best) not in matched
+            if hit:
+                matched.add((image, best))
+            true_positives.append(hit)
+        n_ground_truth = sum(int(c) == class_id for _, classes in ground_truths for c in classes)
+        precisions, recalls, hits = [], [], 0
+        for rank, hit in enumerate(true_positives, 1):
+            hits += hit
+            precisions.append(hits / rank)
+            recalls.append(hits / n_ground_truth)
+        ap, previous_recall = 0.0, 0.0
+        for i, recall in enumerate(recalls):
+            ap += (recall - previous_recall) * max(precisions[i:])
+            previous_recall = recall
+        results[str(class_id)] = ap
+    return results
+
+
+def test_evaluate_detections_small_case():
+    ground_truths = [ground_truth([[0, 0, 0.5, 0.5], [0.5, 0.5, 1, 1]], [0, 1]), ground_truth([[0, 0, 1, 1]], [0])]
+    detections = [
+        [[0, 0.9, 0, 0, 0.5, 0.5], [0, 0.8, 0, 0, 0.5, 0.45], [1, 0.7, 0.5, 0.5, 1, 1]],
+        [[0, 0.6, 0.6, 0.6, 0.9, 0.9], [1, 0.5, 0, 0, 1, 1]]
+    ]
+    evaluation = evaluate_detections(ground_truths, detections)
+    # Class 0: hit, duplicate, miss for 2 boxes. Class 1: hit, false positive of another image.
+    assert evaluation['ap'] == pytest.approx({'0': 0.5, '1': 1.0})
+    assert evaluation['map'] == pytest.approx(0.75)
+    assert (evaluation['images'], evaluation['ground_truth_boxes'], evaluation['detections']) == (2, 3, 5)
+
+
+def test_evaluate_detections_matches_reference_implementation():
+    rng = random.Random(0)
+    ground_truths, detections = [], []
+    for _ in range(60):
+        boxes = []
+        for _ in range(rng.randint(0, 5)):
+            x, y = rng.uniform(0, 0.7), rng.uniform(0, 0.7)
+            boxes.append([x, y, x + rng.uniform(0.05, 0.3), y + rng.uniform(0.05, 0.3)])
+        classes = [rng.randrange(3) for _ in boxes]
+        ground_truths.append(ground_truth(boxes, classes))
+        image_detections = []
+        for box, class_id in zip(boxes, classes):
+            jitter = [rng.gauss(0, 0.03) for _ in range(4)]
+            image_detections.append([class_id, rng.random()] + [v + j for v, j in zip(box, jitter)])
+        for _ in range(rng.randint(0, 2)):
+            x, y = rng.uniform(0, 0.7), rng.uniform(0, 0.7)
+            image_detections.append([rng.randrange(3), rng.random(), x, y, x + 0.2, y + 0.2])
+        detections.append(image_detections)
+
+    evaluation = evaluate_detections(ground_truths, detections)
+    assert evaluation['ap'] == pytest.approx(reference_average_precisions(ground_truths, detections))
+
+
+def test_validation_outputs_are_evaluated_instead_of_autoannotated():
+    validation = [{"source-ref": "s3://bucket/frames/7.jpg", "id": 7,
+                   "category": {"annotations": [{"class_id": 0, "left": 0, "top": 0, "width": 100, "height": 50}],
+                                "image_size": [{"width": 200, "height": 100, "depth": 3}]}}]
+    outputs = [(S3Ref("bucket", "out/1/1.jpg.out"), {"prediction": []}),
+               (S3Ref("bucket", "out/7/7.jpg.out"), {"prediction": [[0, 0.9, 0, 0, 0.5, 0.5]]})]
+    validation_predictions = []
+    remaining = list(divert_validation_outputs(outputs, validation, validation_predictions))
+    assert [ref.key for ref, _ in remaining] == ["out/1/1.jpg.out"]
+
+    evaluation = evaluate_validation_set(validation_predictions, "category")
+    assert evaluation['map'] == pytest.approx(1.0)
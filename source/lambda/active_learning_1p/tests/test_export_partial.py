@@ -25,3 +25,20 @@ def test_export_partial():
     print(expected_manifest_content)
     assert body == expected_manifest_content
 
+
+
+def test_merge_manifests_keeps_human_labels():
+    from Output.export_partial import merge_manifests
+    full_input = ['{"id": 0}\n', '{"id": 1}\n', '{"id": 2}\n']
+    human = '{"id": 0, "category": 1, "category-metadata": {"human-annotated": "yes"}}\n'
+    # Autoannotations computed while record 0 was being labeled by humans.
+    auto = ['{"id": 0, "category": 2, "category-metadata": {"human-annotated": "no"}}\n',
+            '{"id": 1, "category": 2, "category-metadata": {"human-annotated": "no"}}\n']
+
+    merged = merge_manifests(full_input, auto, [human])
+    assert merged[0]["category"] == 1
+    assert merged[1]["category"] == 2
+    assert merged[2] == {"id": 2}
+
+    merged = merge_manifests([human], auto)
+    assert merged[0]["category"] == 1
@@ -0,0 +1,64 @@
+from io import StringIO
+
+from idempotency import get_completed_result, get_fingerprint, mark_completed, merge_result
+from s3_helper import S3Ref, upload
+from string_helper import generate_job_id_and_s3_path
+
+
+def test_fingerprint_follows_input_content_and_parameters(local_storage):
+    manifest = S3Ref('input', 'input.manifest')
+    upload(StringIO('{"id": 0}\n'), manifest)
+    fingerprint = get_fingerprint([manifest.get_uri()], {'a': 1})
+
+    assert get_fingerprint([manifest.get_uri()], {'a': 1}) == fingerprint
+    assert get_fingerprint([manifest.get_uri()], {'a': 2}) != fingerprint
+    upload(StringIO('{"id": 1}\n'), manifest)
+    assert get_fingerprint([manifest.get_uri()], {'a': 1}) != fingerprint
+
+    job_id, s3_uri = generate_job_id_and_s3_path("prefix", "s3://output/", fingerprint=fingerprint)
+    assert s3_uri == "s3://output/active-learning-{}/".format(fingerprint)
+    # Job names can never be reused, so only the output folder follows the inputs.
+    assert job_id.startswith("prefix-")
+    assert generate_job_id_and_s3_path("prefix", "s3://output/", fingerprint=fingerprint) != (job_id, s3_uri)
+
+
+def test_completed_result_requires_matching_fingerprint(local_storage):
+    assert get_completed_result("s3://output/folder/", "stage", "abc") is None
+    mark_completed("s3://output/folder/", "stage", "abc", {'uri': 's3://output/folder/x'})
+
+    assert (local_storage / 'output' / 'folder' / '_SUCCESS.stage.json').exists()
+    assert get_completed_result("s3://output/folder/", "stage", "abc") == {'uri': 's3://output/folder/x'}
+    assert get_completed_result("s3://output/folder/", "stage", "def") is None
+    assert get_completed_result("s3://output/folder/", "other", "abc") is None
+
+
+def test_merge_result():
+    meta_data = {'counts': {'input_total': 10}, 'a': 1}
+    merge_result(meta_data, {'counts': {'validation': 1}, 'b': 2})
+    assert meta_data == {'counts': {'input_total': 10, 'validation': 1}, 'a': 1, 'b': 2}
+
+
+def test_prepare_for_labeling_reuses_completed_outputs(local_storage, monkeypatch):
+    from Labeling import prepare_for_labeling
+    copies = []
+    monkeypatch.setattr(prepare_for_labeling, "copy_with_query", lambda *args: copies.append(args))
+    upload(StringIO('{"id": 0}\n'), S3Ref('input', 'input.manifest'))
+    event = {
+        'LabelingJobNamePrefix': 'jobprefix',
+        'input_total': 10000,
+        'human_label_done_count': 1000,
+        'IntermediateFolderUri': 's3://output/',
+        'LabelAttributeName': 'category',
+        'ManifestS3Uri': 's3://input/input.manifest'
+    }
+
+    first = prepare_for_labeling.lambda_handler(event, {})
+    second = prepare_for_labeling.lambda_handler(event, {})
+    assert second['labeling_job_output_uri'] == first['labeling_job_output_uri']
+    assert second['labeling_job_name'] != first['labeling_job_name']
+    assert len(copies) == 1
+
+    upload(StringIO('{"id": 0, "category": {}}\n'), S3Ref('input', 'input.manifest'))
+    third = prepare_for_labeling.lambda_handler(event, {})
+    assert third['labeling_job_output_uri'] != first['labeling_job_output_uri']
+    assert len(copies) == 2
@@ -0,0 +1,64 @@
+from io import BytesIO
+
+import metrics
+from s3_helper import S3Ref, download_bytesio, get_uris_inside_prefix, upload_bytes
+
+from ActiveLearning.image_cache import stage_resized_images
+
+CACHE_FOLDER = "s3://bucket/intermediate/resized-images/300/"
+
+
+def put_image(source_ref, size):
+    from PIL import Image
+    image = BytesIO()
+    Image.new("RGB", size).save(image, format="JPEG")
+    upload_bytes(image.getvalue(), S3Ref.from_uri(source_ref))
+
+
+def cache_counts():
+    values = metrics.get_metrics().values
+    return values["image_cache.hit"][0], values["image_cache.miss"][0]
+
+
+def test_stage_resized_images_reuses_cached_copies(local_storage):
+    from PIL import Image
+    sources = ["s3://bucket/frames/0.jpg", "s3://bucket/frames/1.jpg"]
+    records = list(enumerate(sources))
+    put_image(sources[0], (1920, 1080))
+    put_image(sources[1], (200, 100))
+
+    sizes = stage_resized_images(records, CACHE_FOLDER, "s3://bucket/iteration-1/staged/", 300)
+    assert sizes[sources[0]] == {"width": 1920, "height": 1080, "depth": 3}
+    assert cache_counts() == (0, 2)
+    staged = download_bytesio(S3Ref.from_uri("s3://bucket/iteration-1/staged/0/0.jpg"))
+    assert Image.open(staged).size == (533, 300)
+    staged = download_bytesio(S3Ref.from_uri("s3://bucket/iteration-1/staged/1/1.jpg"))
+    assert Image.open(staged).size == (200, 100)
+
+    metrics.get_metrics().reset()
+    assert stage_resized_images(records, CACHE_FOLDER, "s3://bucket/iteration-2/staged/", 300) == sizes
+    assert cache_counts() == (2, 0)
+
+    # A changed image has another ETag, so its stale copy is never used.
+    metrics.get_metrics().reset()
+    put_image(sources[0], (1280, 720))
+    sizes = stage_resized_images(records, CACHE_FOLDER, "s3://bucket/iteration-3/staged/", 300)
+    assert sizes[sources[0]]["width"] == 1280
+    assert cache_counts() == (1, 1)
+
+
+def test_images_with_the_same_name_are_staged_under_their_record_id(local_storage):
+    from PIL import Image
+    records = [(7, "s3://bucket/camera-a/0.jpg"), (8, "s3://bucket/camera-b/0.jpg")]
+    put_image(records[0][1], (400, 300))
+    put_image(records[1][1], (300, 200))
+
+    sizes = stage_resized_images(records, CACHE_FOLDER, "s3://bucket/staged/", 300)
+    assert sizes == {records[0][1]: {"width": 400, "height": 300, "depth": 3},
+                     records[1][1]: {"width": 300, "height": 200, "depth": 3}}
+    assert Image.open(download_bytesio(S3Ref.from_uri("s3://bucket/staged/7/0.jpg"))).size == (400, 300)
+    assert Image.open(download_bytesio(S3Ref.from_uri("s3://bucket/staged/8/0.jpg"))).size == (300, 200)
+    # Each cached copy carries the original size in its name, there is no shared file to update.
+    names = sorted(key.rpartition("/")[2].partition("_")[2]
+                   for key in get_uris_inside_prefix(S3Ref.from_uri(CACHE_FOLDER)))
+    assert names == ["300x200x3", "400x300x3"]
@@ -0,0 +1,104 @@
+'''
+Import time (cold start) budget for every lambda handler.
+
+Each handler is imported in a fresh interpreter with `python -X importtime` so that the
+measurement matches what a cold lambda pays before the first invocation. Run this file
+directly to print a report of every handler's startup cost:
+
+    python tests/test_import_time.py
+
+Wall clock budgets depend on the machine, so the test suite only checks them when
+BYOAL_CHECK_IMPORT_TIME is set. That heavy modules are deferred is always checked.
+'''
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+LAMBDA_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_ROOT = os.path.join(LAMBDA_ROOT, "dependency", "python")
+
+# Budget in milliseconds of cumulative import time for each handler module.
+HANDLER_BUDGETS_MS = {
+    "Bootstrap.add_record_id": 50,
+    "Bootstrap.compute_image_hashes": 50,
+    "Bootstrap.copy_input_manifest": 50,
+    "Labeling.prepare_for_labeling": 50,
+    "MetaData.get_counts": 50,
+    "MetaData.update": 25,
+    "Output.export_final": 50,
+    "Output.export_partial": 50,
+    "ActiveLearning.create_validation_set": 50,
+    "ActiveLearning.prepare_for_training": 50,
+    "ActiveLearning.prepare_for_inference": 50,
+    "ActiveLearning.perform_active_learning": 75,
+}
+
+# Set to check the budgets in the test suite, e.g. on a dedicated benchmark machine.
+CHECK_IMPORT_TIME_ENV = "BYOAL_CHECK_IMPORT_TIME"
+
+# Modules that must only be imported on first use, never at handler import time.
+DEFERRED_MODULES = ("boto3", "botocore", "numpy", "PIL")
+
+
+def run_in_fresh_interpreter(args):
+    """
+    Run python with the given arguments the way the lambda runtime would see the code.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([LAMBDA_ROOT, LAYER_ROOT])
+    return subprocess.run([sys.executable] + args, cwd=LAMBDA_ROOT, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def measure_import_time_ms(module_name):
+    """
+    Return the cumulative import time of the module in milliseconds.
+    """
+    result = run_in_fresh_interpreter(["-X", "importtime", "-c", "import {}".format(module_name)])
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, imported = line[len("import time:"):].split("|")
+        if imported.strip() == module_name:
+            return int(cumulative) / 1000.0
+    raise ValueError("No import time reported for {}".format(module_name))
+
+
+def get_deferred_modules_loaded(module_name):
+    """
+    Return the deferred modules that are loaded as a side effect of importing the module.
+    """
+    script = "import sys, json, {}; print(json.dumps([m for m in {} if m in sys.modules]))".format(
+        module_name, list(DEFERRED_MODULES))
+    result = run_in_fresh_interpreter(["-c", script])
+    return json.loads(result.stdout)
+
+
+@pytest.mark.parametrize("module_name", sorted(HANDLER_BUDGETS_MS))
+def test_handler_defers_heavy_imports(module_name):
+    assert get_deferred_modules_loaded(module_name) == []
+
+
+@pytest.mark.skipif(not os.environ.get(CHECK_IMPORT_TIME_ENV),
+                    reason="import time budgets are checked with {} set".format(CHECK_IMPORT_TIME_ENV))
+@pytest.mark.parametrize("module_name", sorted(HANDLER_BUDGETS_MS))
+def test_handler_import_time_within_budget(module_name):
+    import_time_ms = measure_import_time_ms(module_name)
+    budget_ms = HANDLER_BUDGETS_MS[module_name]
+    assert import_time_ms <= budget_ms, "{} takes {:.1f} ms to import, budget is {} ms".format(
+        module_name, import_time_ms, budget_ms)
+
+
+if __name__ == "__main__":
+    over_budget = False
+    print("{:<45} {:>10} {:>10}".format("handler", "import ms", "budget ms"))
+    for module_name, budget_ms in sorted(HANDLER_BUDGETS_MS.items()):
+        import_time_ms = measure_import_time_ms(module_name)
+        over_budget = over_budget or import_time_ms > budget_ms
+        print("{:<45} {:>10.1f} {:>10}".format(module_name, import_time_ms, budget_ms))
+    sys.exit(1 if over_budget else 0)
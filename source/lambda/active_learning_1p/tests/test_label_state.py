@@ -0,0 +1,61 @@
+import json
+import pytest
+from io import StringIO
+
+import metrics
+from label_state import AUTO, HUMAN, UNLABELED, LabelStateIndex, load_label_state_index
+from s3_helper import S3Ref, download_stringio, upload
+
+
+def human(record_id):
+    return {"id": record_id, "category": 1, "category-metadata": {"human-annotated": "yes"}}
+
+
+def auto(record_id):
+    return {"id": record_id, "category": 2, "category-metadata": {"human-annotated": "no"}}
+
+
+def test_label_state_index_counts_and_finds_records():
+    rows = [{"id": 0}, human(1), auto(2), {"id": 3}, {"id": 4, "category": 0}]
+    index = LabelStateIndex.from_rows(rows, "category")
+    assert index.get_counts() == {"input_total": 5, "human_label": 1, "auto_label": 1, "unlabeled": 3}
+    assert index.first_ids(UNLABELED, 5) == [0, 3]
+    assert index.first_ids(UNLABELED, 1) == [0]
+
+    index.update([human(0), auto(3)])
+    assert index.first_ids(HUMAN, 5) == [0, 1]
+    assert index.first_ids(AUTO, 5) == [2, 3]
+
+    restored = LabelStateIndex.deserialize(index.serialize())
+    assert restored.states == index.states
+    assert restored.label_attribute_name == "category"
+
+    with pytest.raises(ValueError):
+        LabelStateIndex.from_rows([{"id": 0}, {"id": 2}], "category")
+    with pytest.raises(ValueError):
+        index.update([{"id": 5}])
+
+
+def test_label_state_index_follows_manifest_writes(local_storage):
+    from Bootstrap.add_record_id import lambda_handler as add_record_id
+    from MetaData.get_counts import lambda_handler as get_counts
+    from Output.export_partial import lambda_handler as export_partial
+
+    manifest = S3Ref('bucket', 'intermediate/input.manifest')
+    upload(StringIO('{"source": "a"}\n{"source": "b"}\n{"source": "c"}\n'), manifest)
+    add_record_id({'ManifestS3Uri': manifest.get_uri(), 'LabelAttributeName': 'category'}, {})
+
+    count_event = {'LabelAttributeName': 'category', 'meta_data': {'IntermediateManifestS3Uri': manifest.get_uri()}}
+    assert get_counts(count_event, {})["unlabeled"] == 3
+
+    labeled = S3Ref('bucket', 'output/output.manifest')
+    upload(StringIO(json.dumps(human(1)) + "\n"), labeled)
+    export_partial({'ManifestS3Uri': manifest.get_uri(), 'OutputS3Uri': labeled.get_uri()}, {})
+    counts = get_counts(count_event, {})
+    assert (counts["human_label"], counts["unlabeled"]) == (1, 2)
+    assert "label_state.stale" not in metrics.get_metrics().values
+
+    # A manifest written without updating the index makes it stale instead of wrong.
+    rows = [json.loads(line) for line in download_stringio(manifest)]
+    upload(StringIO("".join(json.dumps(auto(row["id"])) + "\n" for row in rows)), manifest)
+    assert load_label_state_index(manifest, 'category') is None
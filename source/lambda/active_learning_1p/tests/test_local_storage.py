@@ -0,0 +1,37 @@
+import pytest
+from io import StringIO
+from botocore.exceptions import ClientError
+
+import s3_helper
+from s3_helper import S3Ref, copy, download_stringio, get_content_size, get_uris_inside_prefix, upload
+
+
+def test_upload_download_and_copy(local_storage):
+    source = S3Ref.from_uri('s3://bucket/folder/input.manifest')
+    dest = S3Ref.from_uri('s3://other/copy.manifest')
+    upload(StringIO('{"id": 0}\n'), source)
+    copy(source, dest)
+
+    assert (local_storage / 'bucket' / 'folder' / 'input.manifest').read_text() == '{"id": 0}\n'
+    assert download_stringio(dest).read() == '{"id": 0}\n'
+    assert get_content_size(dest) == 10
+
+
+def test_missing_object_raises_client_error(local_storage):
+    with pytest.raises(ClientError):
+        download_stringio(S3Ref.from_uri('s3://bucket/missing.manifest'))
+
+
+def test_list_paginates_like_s3(local_storage):
+    for i in range(1005):
+        upload(StringIO(str(i)), S3Ref('bucket', 'outputs/{:04d}.jpg.out'.format(i)))
+    upload(StringIO('x'), S3Ref('bucket', 'other/file'))
+
+    client = s3_helper.get_s3_client()
+    first_page = client.list_objects_v2(Bucket='bucket', Prefix='outputs/')
+    assert first_page['KeyCount'] == 1000
+    assert first_page['IsTruncated']
+
+    keys = get_uris_inside_prefix(S3Ref('bucket', 'outputs/'))
+    assert len(keys) == 1005
+    assert keys[0] == 'outputs/0000.jpg.out'
@@ -0,0 +1,71 @@
+import json
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+import metrics
+from s3_helper import S3Ref, copy, download_stringio, upload
+
+
+def test_s3_operations_are_recorded(local_storage):
+    source = S3Ref('bucket', 'input.manifest')
+    upload(StringIO('{"id": 0}\n'), source)
+    copy(source, S3Ref('bucket', 'copy.manifest'))
+    download_stringio(source)
+    download_stringio(source)
+
+    io = metrics.get_metrics().io
+    assert io['put']['count'] == 1
+    assert io['put']['bytes'] == 10
+    assert io['copy']['count'] == 1
+    assert io['get']['count'] == 2
+    assert io['get']['bytes'] == 20
+
+
+def test_instrument_handler_emits_one_emf_record(local_storage, capsys):
+    class Context:
+        aws_request_id = 'request-1'
+
+    @metrics.instrument_handler
+    def lambda_handler(event, context):
+        with metrics.timer("work"):
+            upload(StringIO('abc'), S3Ref('bucket', 'out'))
+        return event['value']
+
+    assert lambda_handler({'value': 42}, Context()) == 42
+
+    lines = capsys.readouterr().out.strip().splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])
+    assert record['Handler'] == 'test_metrics'
+    assert record['RequestId'] == 'request-1'
+    assert record['s3.put.count'] == 1
+    assert record['s3.put.bytes'] == 3
+    assert record['phase.total'] >= record['phase.work']
+    names = {metric['Name'] for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert {'s3.put.latency', 'phase.work', 'phase.total'} <= names
+
+
+def test_instrument_handler_emits_when_handler_fails(local_storage, capsys):
+    @metrics.instrument_handler
+    def lambda_handler(event, context):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        lambda_handler({}, {})
+    assert 'phase.total' in json.loads(capsys.readouterr().out)
+
+
+def test_updates_from_threads_are_not_lost():
+    invocation_metrics = metrics.InvocationMetrics()
+
+    def record(_):
+        for _ in range(5000):
+            invocation_metrics.increment("retries")
+            invocation_metrics.record_io("get", 0.001, 10)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(record, range(8)))
+    assert invocation_metrics.values["retries"] == (40000, "Count")
+    assert invocation_metrics.io["get"]["count"] == 40000
+    assert invocation_metrics.io["get"]["bytes"] == 400000
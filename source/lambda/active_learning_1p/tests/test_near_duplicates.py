@@ -0,0 +1,98 @@
+import random
+import pytest
+from io import BytesIO, StringIO
+
+from near_duplicates import (NearDuplicateIndex, cluster_hashes, difference_hash, get_representatives,
+                             hamming_distance, load_near_duplicate_index)
+from s3_helper import S3Ref, upload, upload_bytes
+
+from ActiveLearning.helper import ImageActiveLearning
+from ActiveLearning.perform_active_learning import join_manifest_and_inference_outputs
+from Bootstrap.compute_image_hashes import lambda_handler
+
+MANIFEST = "s3://bucket/intermediate/input.manifest"
+
+
+def make_frame(offset, size=(320, 200), quality=90):
+    from PIL import Image, ImageDraw
+    image = Image.new("RGB", size, (40, 40, 40))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([offset, 50, offset + 120, 150], fill=(220, 220, 220))
+    draw.ellipse([200 - offset, 20, 260 - offset, 80], fill=(120, 0, 0))
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def test_difference_hash_is_stable_across_recompression():
+    value, image_size = difference_hash(make_frame(10))
+    assert image_size == {"width": 320, "height": 200, "depth": 3}
+    assert hamming_distance(value, difference_hash(make_frame(10, quality=50))[0]) <= 4
+    assert hamming_distance(value, difference_hash(make_frame(150))[0]) > 4
+
+
+def brute_force_clusters(hashes, max_distance):
+    representatives = []
+    for record_id, value in enumerate(hashes):
+        candidates = [(hamming_distance(value, hashes[r]), r) for r in set(representatives)
+                      if hamming_distance(value, hashes[r]) <= max_distance]
+        representatives.append(min(candidates)[1] if candidates else record_id)
+    return representatives
+
+
+@pytest.mark.parametrize("max_distance", [3, 4, 7])
+def test_cluster_hashes_matches_exhaustive_search(max_distance):
+    rng = random.Random(max_distance)
+    hashes = []
+    for _ in range(300):
+        if hashes and rng.random() < 0.7:
+            value = rng.choice(hashes)
+            for bit in rng.sample(range(64), rng.randint(0, 8)):
+                value ^= 1 << bit
+        else:
+            value = rng.getrandbits(64)
+        hashes.append(value)
+    assert cluster_hashes(hashes, max_distance) == brute_force_clusters(hashes, max_distance)
+
+
+def test_compute_image_hashes_groups_near_duplicates(local_storage):
+    frames = [make_frame(10), make_frame(10, quality=60), make_frame(150), make_frame(11)]
+    rows = []
+    for record_id, frame in enumerate(frames):
+        source_ref = "s3://bucket/frames/{}.jpg".format(record_id)
+        upload_bytes(frame, S3Ref.from_uri(source_ref))
+        rows.append('{{"source-ref": "{}", "id": {}}}\n'.format(source_ref, record_id))
+    rows.append('{"source-ref": "s3://bucket/frames/missing.jpg", "id": 4}\n')
+    upload(StringIO("".join(rows)), S3Ref.from_uri(MANIFEST))
+
+    lambda_handler({"ManifestS3Uri": MANIFEST}, {})
+
+    index = load_near_duplicate_index(S3Ref.from_uri(MANIFEST))
+    assert index.representatives == [0, 0, 2, 0, 4]
+    assert index.get_size(2) == {"width": 320, "height": 200, "depth": 3}
+    assert index.get_size(4) is None
+    assert index.get_cluster(7) == 7
+    # Representatives are chosen among the rows still unlabeled.
+    assert get_representatives(index, [{"id": 1}, {"id": 2}, {"id": 3}]) == {1: [3], 2: []}
+    assert get_representatives(None, [{"id": 1}, {"id": 3}]) == {1: [], 3: []}
+
+
+def test_index_round_trip():
+    index = NearDuplicateIndex.from_hashes([5, None, 7], [{"width": 4, "height": 3, "depth": 1}, None,
+                                                          {"width": 4, "height": 3, "depth": 3}])
+    restored = NearDuplicateIndex.deserialize(index.serialize())
+    assert restored.hashes == [5, None, 7]
+    assert restored.representatives == [0, 1, 0]
+    assert restored.sizes == index.sizes
+    with pytest.raises(ValueError):
+        NearDuplicateIndex.deserialize(index.serialize()[:-1])
+
+
+def test_near_duplicates_share_the_prediction_of_their_representative():
+    rows = [{"source-ref": "s3://bucket/frames/{}.jpg".format(record_id), "id": record_id} for record_id in range(4)]
+    outputs = [(S3Ref("bucket", "out/0/0.jpg.out"), "p0"), (S3Ref("bucket", "out/2/2.jpg.out"), "p2")]
+    aligned = join_manifest_and_inference_outputs(rows, outputs, {1: 0, 3: 0})
+    assert [(row["id"], prediction) for row, prediction in aligned] == [(0, "p0"), (1, "p0"), (3, "p0"), (2, "p2")]
+
+    image_al = ImageActiveLearning("job", "category", {}, 10, near_duplicates={1: 0, 3: 0})
+    assert sorted(image_al.select_ids_for_labeling(range(4), [2])) == [0]
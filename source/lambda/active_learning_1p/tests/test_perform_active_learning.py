@@ -1,59 +1,93 @@
-import boto3
-from moto import mock_s3
+import copy
+import json
+import pytest
 from io import StringIO
+
 from ActiveLearning.perform_active_learning import lambda_handler
+from ActiveLearning.s3_helper import S3Ref, download_stringio, upload
+
+TRANSFORM_OUTPUT = 's3://output/transform/'
 
-@mock_s3
-def test_peform_active_learning(monkeypatch):
-    def mock_download_with_query(*args, **kwargs):
-        output = StringIO()
-        output.write('{"label":"dog"}\n')
-        output.write('{"label":"cat"}\n')
-        output.seek(0)
-        return output
 
-    class MockSimpleActiveLearning:
-        def __init__(self, job_name, label_category_name,
-                  label_names, max_selections):
-            pass
+def put_json_lines(rows, s3_uri):
+    upload(StringIO("".join(json.dumps(row) + "\n" for row in rows)), S3Ref.from_uri(s3_uri))
 
-        def autoannotate(self, predictions, sources):
-            return ['{"source": "This is a message about cat", "category": 1, "category-metadata": {"confidence": 1.0, "human-annotated": "no", "type": "groundtruth/text-classification"}}']
 
-        def select_for_labeling(self, predictions, autoannotations):
-            return [0]
+def read_json_lines(s3_uri):
+    return [json.loads(line) for line in download_stringio(S3Ref.from_uri(s3_uri))]
 
-    from ActiveLearning import perform_active_learning
-    monkeypatch.setattr(perform_active_learning, "download_with_query", mock_download_with_query)
-    monkeypatch.setattr(perform_active_learning, "SimpleActiveLearning", MockSimpleActiveLearning)
+
+def test_peform_active_learning(local_storage):
+    '''
+       Images 0 to 3 are unlabeled, image 3 is a near-duplicate of image 0 and image 4 is a
+       validation image. The images themselves are never downloaded, their sizes were recorded
+       when they were staged.
+    '''
+    rows = [{"source-ref": "s3://input/images/{}.jpg".format(i), "id": i} for i in range(4)]
+    validation_row = {
+        "source-ref": "s3://input/images/4.jpg", "id": 4,
+        "category": {"annotations": [{"class_id": 0, "left": 20, "top": 10, "width": 80, "height": 40}],
+                     "image_size": [{"width": 200, "height": 100, "depth": 3}]},
+        "category-metadata": {"human-annotated": "yes"}
+    }
+    put_json_lines(rows + [validation_row], 's3://input/input.manifest')
+    put_json_lines(rows, TRANSFORM_OUTPUT + 'unlabeled.manifest')
+    put_json_lines([validation_row], 's3://input/validation.manifest')
+    upload(StringIO('{"class-map": {"0": "car"}}'), S3Ref('input', 'labels.json'))
+    image_sizes = {row['source-ref']: {"width": 200, "height": 100, "depth": 3} for row in rows}
+    upload(StringIO(json.dumps(image_sizes)), S3Ref.from_uri(TRANSFORM_OUTPUT + 'staged_images.json'))
+    upload(StringIO('{"3": 0}'), S3Ref.from_uri(TRANSFORM_OUTPUT + 'near_duplicates.json'))
+    predictions = {
+        0: [[0, 0.9, 0.1, 0.1, 0.5, 0.5]],
+        1: [[0, 0.2, 0.7, 0.7, 0.9, 0.9]],
+        2: [[0, 0.95, 0.2, 0.2, 0.6, 0.6]],
+        4: [[0, 0.9, 0.1, 0.1, 0.5, 0.5]],
+    }
+    for i, prediction in predictions.items():
+        upload(StringIO(json.dumps({"prediction": prediction})),
+               S3Ref.from_uri(TRANSFORM_OUTPUT + '{0}/{0}.jpg.out'.format(i)))
 
     event = {
         'LabelCategoryConfigS3Uri': 's3://input/labels.json',
         'LabelingJobNamePrefix': 'job-prefix',
-        'LabelAttributeName': 'Animal',
-        'meta_data' : {
+        'LabelAttributeName': 'category',
+        'meta_data': {
             'IntermediateFolderUri': 's3://output/',
-            'UnlabeledS3Uri': 's3://input/unlabeled.manifest',
+            'IntermediateManifestS3Uri': 's3://input/input.manifest',
+            'UnlabeledManifestS3Uri': TRANSFORM_OUTPUT + 'unlabeled.manifest',
+            'StagedImagesS3Uri': TRANSFORM_OUTPUT + 'staged_images.json',
+            'NearDuplicatesS3Uri': TRANSFORM_OUTPUT + 'near_duplicates.json',
+            'ValidationS3Uri': 's3://input/validation.manifest',
             'transform_config': {
-               'S3OutputPath': 's3://input/'
+                'S3OutputPath': TRANSFORM_OUTPUT
             },
-            'counts' : {
-                'input_total' : 10000
+            'counts': {
+                'input_total': 5
             }
         }
     }
-    s3r = boto3.resource('s3', region_name='us-east-1')
-    s3r.create_bucket(Bucket='input')
-    batch_tranform_input = b'{"source": "This is a dog.", "id": 0}\n{"source": "This is a message about cat", "id": 1}\n'
-    s3r.Object('input', 'unlabeled.manifest').put(Body=batch_tranform_input)
-    batch_tranform_output = b'{"id": 0, "prob": [0.6, 0.4], "label": ["__label__0", "__label__1"]}\n{"id": 1, "prob": [0.9, 0.1], "label": ["__label__1", "__label__0"]}\n'
-    s3r.Object('input', 'unlabeled.manifest.out').put(Body=batch_tranform_output)
-
-    output = lambda_handler(event, {})
+    # The handler updates the meta_data of its event, every call gets a copy.
+    output = lambda_handler(copy.deepcopy(event), {})
 
-    assert output['autoannotations'] == "s3://input/autoannotated.manifest"
-    assert output['selections_s3_uri'] == 's3://input/selection.manifest'
+    assert output['autoannotations'] == TRANSFORM_OUTPUT + 'autoannotated.manifest'
+    assert output['selections_s3_uri'] == TRANSFORM_OUTPUT + 'selection.manifest'
     assert output['selected_job_name'].startswith('job-prefix')
-    assert output['selected_job_output_uri'].startswith('s3://output/active-learning')
-    assert output['counts']['autoannotated'] == 1
-    assert output['counts']['selected'] == 1
+    assert output['selected_job_output_uri'].startswith('s3://output/')
+    # The near-duplicate is autoannotated with the prediction of image 0, the validation image is not.
+    assert output['counts'] == {'input_total': 5, 'autoannotated': 3, 'selected': 1}
+    auto_annotations = {row['id']: row for row in read_json_lines(output['autoannotations'])}
+    assert sorted(auto_annotations) == [0, 2, 3]
+    assert auto_annotations[3]['category']['annotations'] == auto_annotations[0]['category']['annotations']
+    annotation = auto_annotations[0]['category']['annotations'][0]
+    assert (annotation['left'], annotation['top'], annotation['width'], annotation['height']) == (20, 10, 80, 40)
+    assert auto_annotations[0]['category']['image_size'] == {"width": 200, "height": 100, "depth": 3}
+    assert read_json_lines(output['selections_s3_uri']) == [rows[1]]
+    # The validation output is evaluated instead.
+    assert output['evaluation']['images'] == 1
+    assert output['evaluation']['map'] == pytest.approx(1.0)
+    assert output['evaluation_history'] == [output['evaluation']['map']]
+
+    # A retry of the same iteration returns the recorded result, with a new labeling job name.
+    again = lambda_handler(copy.deepcopy(event), {})
+    assert again['selected_job_name'] != output['selected_job_name']
+    assert dict(again, selected_job_name=None) == dict(output, selected_job_name=None)
@@ -0,0 +1,92 @@
+import queue
+import time
+
+import pytest
+
+import metrics
+from pipeline import prefetch
+
+from ActiveLearning import s3_helper as handler_s3_helper
+from ActiveLearning.s3_helper import S3Ref, _ChunkReader, download_stringio, list_contents, upload_stream
+
+
+def test_prefetch_yields_results_in_order():
+    def slow_square(x):
+        time.sleep(0.001 * (x % 3))
+        return x * x
+
+    assert list(prefetch(slow_square, range(100), workers=8, queue_size=4)) == [x * x for x in range(100)]
+
+
+def test_prefetch_runs_a_bounded_number_of_items_ahead():
+    started = []
+    results = prefetch(started.append, iter(range(1000)), workers=2, queue_size=5)
+    time.sleep(0.1)
+    # Queued futures plus the one the producer is blocked on.
+    assert len(started) <= 6
+    assert len(list(results)) == 1000
+
+
+def test_prefetch_raises_errors_when_they_are_reached():
+    def fail_on_3(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    results = prefetch(fail_on_3, range(10))
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(results)
+
+    def items():
+        yield 1
+        raise KeyError("listing failed")
+
+    with pytest.raises(KeyError):
+        list(prefetch(lambda x: x, items()))
+
+
+def test_prefetch_stops_when_the_consumer_does():
+    results = prefetch(lambda x: x, iter(range(10 ** 6)), queue_size=4)
+    assert next(results) == 0
+    results.close()
+    assert not results.producer.is_alive()
+    assert list(results) == []
+
+    # Also when it was never iterated.
+    with prefetch(lambda x: x, iter(range(10 ** 6)), queue_size=4) as results:
+        pass
+    assert not results.producer.is_alive()
+
+
+def test_chunk_reader_stays_at_end_of_stream():
+    chunks = queue.Queue()
+    for chunk in (b"abc", b"de", None):
+        chunks.put(chunk)
+    reader = _ChunkReader(chunks)
+    assert reader.read() == b"abcde"
+    # Reading past the end must not wait for another chunk.
+    assert reader.read(10) == b""
+    assert reader.read() == b""
+
+
+def test_upload_stream(local_storage, monkeypatch):
+    monkeypatch.setattr(handler_s3_helper, "STREAM_CHUNK_SIZE", 16)
+    dest = S3Ref("bucket", "out/autoannotated.manifest")
+    lines = ['{{"id": {}}}\n'.format(i) for i in range(100)]
+    with upload_stream(dest) as write:
+        for line in lines:
+            write(line)
+    assert download_stringio(dest).read() == "".join(lines)
+    assert metrics.get_metrics().io['put']['bytes'] == len("".join(lines))
+
+
+def test_aborted_upload_stream_stores_nothing(local_storage, monkeypatch):
+    monkeypatch.setattr(handler_s3_helper, "STREAM_CHUNK_SIZE", 16)
+    dest = S3Ref("bucket", "out/autoannotated.manifest")
+    with pytest.raises(ZeroDivisionError):
+        with upload_stream(dest) as write:
+            for i in range(100):
+                write("line {}\n".format(i))
+            1 / 0
+    assert list(list_contents(S3Ref("bucket", "out/"))) == []
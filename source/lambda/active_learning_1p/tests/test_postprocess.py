@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from ActiveLearning.helper import ImageActiveLearning
+from ActiveLearning.postprocess import batched_iou, postprocess_predictions
+
+
+def test_batched_iou():
+    boxes = np.array([[
+        [0, 0.9, 0.0, 0.0, 0.5, 0.5],
+        [0, 0.8, 0.25, 0.0, 0.75, 0.5],
+        [0, 0.7, 0.6, 0.6, 1.0, 1.0],
+    ]])
+    iou = batched_iou(boxes)
+    assert iou.shape == (1, 3, 3)
+    assert iou[0, 0, 0] == pytest.approx(1.0)
+    assert iou[0, 0, 1] == pytest.approx(1.0 / 3.0)
+    assert iou[0, 0, 2] == 0.0
+
+
+def test_score_floor_nms_and_top_k():
+    predictions = [
+        [
+            [0.0, 0.05, 0.0, 0.0, 0.1, 0.1],   # under the score floor
+            [0.0, 0.8, 0.0, 0.0, 0.5, 0.5],    # suppressed by the next box
+            [0.0, 0.9, 0.0, 0.0, 0.5, 0.55],
+            [1.0, 0.7, 0.0, 0.0, 0.5, 0.5],    # same place, other class: kept
+            [0.0, 0.6, 0.6, 0.6, 1.0, 1.0],
+        ],
+        [],
+        [[1.0, 0.3, 0.1, 0.1, 0.2, 0.2]],
+    ]
+    detections = postprocess_predictions(predictions, score_floor=0.2, iou_threshold=0.45, top_k=10)
+    assert [d[:, 1].tolist() for d in detections] == [[0.9, 0.7, 0.6], [], [0.3]]
+
+    detections = postprocess_predictions(predictions, score_floor=0.2, iou_threshold=0.45, top_k=2)
+    assert detections[0][:, 1].tolist() == [0.9, 0.7]
+
+
+def test_suppressed_box_does_not_suppress():
+    # B is suppressed by A, so C which only overlaps B survives, as in sequential greedy NMS.
+    predictions = [[
+        [0.0, 0.9, 0.0, 0.0, 0.4, 1.0],
+        [0.0, 0.8, 0.2, 0.0, 0.6, 1.0],
+        [0.0, 0.7, 0.4, 0.0, 0.8, 1.0],
+    ]]
+    detections = postprocess_predictions(predictions, score_floor=0.0, iou_threshold=0.3)
+    assert detections[0][:, 1].tolist() == [0.9, 0.7]
+
+
+def test_frames_with_only_weak_boxes_go_to_humans():
+    image_sizes = {"s3://bucket/frames/{}.jpg".format(i): {"width": 100, "height": 100, "depth": 3} for i in range(4)}
+    aligned_predictions = [
+        ({"source-ref": "s3://bucket/frames/0.jpg", "id": 0}, {"prediction": [[0, 0.9, 0.1, 0.1, 0.5, 0.5]]}),
+        # Every box scores under the floor: the frame is uncertain, not empty.
+        ({"source-ref": "s3://bucket/frames/1.jpg", "id": 1}, {"prediction": [[0, 0.1, 0.1, 0.1, 0.5, 0.5],
+                                                                              [0, 0.05, 0.6, 0.6, 0.9, 0.9]]}),
+        ({"source-ref": "s3://bucket/frames/2.jpg", "id": 2}, {"prediction": []}),
+        ({"source-ref": "s3://bucket/frames/3.jpg", "id": 3}, {"prediction": [[0, 0.45, 0.1, 0.1, 0.5, 0.5]]}),
+    ]
+    image_al = ImageActiveLearning("job", "category", {"0": "car"}, 1, image_sizes)
+    autoannotations = list(image_al.generate_autoannotations(aligned_predictions))
+
+    assert [autoannotation["id"] for autoannotation in autoannotations] == [0, 2]
+    assert autoannotations[1]["category"]["annotations"] == []
+    # The detection closest to the threshold makes the most useful label.
+    assert image_al.margins == pytest.approx({1: 0.4, 3: 0.05})
+    assert image_al.select_ids_for_labeling(range(4), [0, 2]) == [3]
+    image_al.max_selections = 3
+    assert image_al.select_ids_for_labeling(range(5), [0, 2]) == [3, 1, 4]
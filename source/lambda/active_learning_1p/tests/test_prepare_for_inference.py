@@ -1,59 +1,89 @@
-from moto import mock_s3
-import boto3
-from io import StringIO
+import copy
+import json
+from io import BytesIO, StringIO
 
+import metrics
 from ActiveLearning.prepare_for_inference import lambda_handler
+from ActiveLearning.s3_helper import S3Ref, download_bytesio, download_stringio, get_uris_inside_prefix, upload, upload_bytes
+from near_duplicates import NearDuplicateIndex, save_near_duplicate_index
 
-@mock_s3
-def test_prepare_for_inference(monkeypatch):
+IMAGE_SIZE = {"width": 640, "height": 480, "depth": 3}
+
+
+def put_image(source_ref):
+    from PIL import Image
+    image = BytesIO()
+    Image.new("RGB", (IMAGE_SIZE["width"], IMAGE_SIZE["height"])).save(image, format="JPEG")
+    upload_bytes(image.getvalue(), S3Ref.from_uri(source_ref))
+
+
+def test_prepare_for_inference(local_storage):
     '''
-       There are only 2 records in the input.manifest and they both are sent to batch transform.
+       Records 0 to 3 are unlabeled, record 1 is a near-duplicate of record 0 and record 3 is out
+       for human labeling. Only 0 and 2 and the validation image 4 are staged for batch transform.
     '''
-    def mock_copy(*args, **kwargs):
-        source = args[0]
-        dest = args[1]
-        query = args[2]
-        transform = args[3]
-        mock_input = StringIO()
-        mock_input.write('{"source": "This is a dog.", "id": 0}\n')
-        mock_input.write('{"source": "This is a message about cat", "id": 1}\n')
-        mock_input.seek(0)
-        augmented_input = transform(mock_input)
-        s3r.Object('output', 'unlabeled.manifest').put(Body=augmented_input.getvalue().encode())
-        print("Copy with transform mocked out source {} dest {} query {}".format(source, dest, query))
-        return mock_input
-
-
-    from ActiveLearning import prepare_for_inference
-    monkeypatch.setattr(prepare_for_inference, "copy_with_query_and_transform", mock_copy)
+    from PIL import Image
+    rows = [{"source-ref": "s3://input/images/{}.jpg".format(i), "id": i} for i in range(4)]
+    labeled_rows = [
+        {"source-ref": "s3://input/images/{}.jpg".format(i), "id": i, "category": {"annotations": []},
+         "category-metadata": {"human-annotated": "yes"}} for i in (4, 5)
+    ]
+    for row in rows + labeled_rows:
+        put_image(row['source-ref'])
+    manifest = S3Ref('input', 'input.manifest')
+    upload(StringIO("".join(json.dumps(row) + "\n" for row in rows + labeled_rows)), manifest)
+    upload(StringIO(json.dumps(labeled_rows[0]) + "\n"), S3Ref('input', 'validation.manifest'))
+    upload(StringIO(json.dumps(rows[3]) + "\n"), S3Ref('input', 'selection.manifest'))
+    hashes = [0, 1, 0xFFFF, 0xFFFF0000, 0xFFFF00000000, 0xFFFF000000000000]
+    save_near_duplicate_index(manifest, NearDuplicateIndex.from_hashes(hashes, [IMAGE_SIZE] * len(hashes)))
 
     event = {
         'LabelAttributeName': 'category',
-        'meta_data' : {
+        'PendingSelections': {'s3_uri': 's3://input/selection.manifest'},
+        'meta_data': {
             'IntermediateManifestS3Uri': 's3://input/input.manifest',
-            'training_config' : {
-                'TrainingJobName' : 'job-name',
-                'S3OutputPath' : 's3://output/'
+            'IntermediateFolderUri': 's3://output/intermediate/',
+            'ValidationS3Uri': 's3://input/validation.manifest',
+            'training_config': {
+                'TrainingJobName': 'job-name',
+                'S3OutputPath': 's3://output/job-name/'
             }
         }
     }
+    # The handler updates the meta_data of its event, every call gets a copy.
+    output = lambda_handler(copy.deepcopy(event), {})
 
-    s3r = boto3.resource('s3', region_name='us-east-1')
-    s3r.create_bucket(Bucket='input')
-    s3r.create_bucket(Bucket='output')
-    input = b'{"source": "This is a dog.", "id": 0}\n{"source": "This is a message about cat", "id": 1}\n'
-    s3r.Object('input', 'input.manifest').put(Body=input)
-    output = lambda_handler(event, {})
+    assert output['UnlabeledManifestS3Uri'] == 's3://output/job-name/unlabeled.manifest'
+    assert output['UnlabeledPrefixS3Uri'] == 's3://output/job-name/labeled_by_active_learning'
+    assert output['transform_config'] == {
+        'TransformJobName': 'job-name',
+        'ModelName': 'job-name',
+        'S3OutputPath': 's3://output/job-name/'
+    }
+    batch_transform_input = [json.loads(line) for line in
+                             download_stringio(S3Ref.from_uri(output['UnlabeledManifestS3Uri']))]
+    assert batch_transform_input == [dict(row, k=1000000) for row in rows[:3]]
 
-    batch_transform_input = s3r.Object('output', 'unlabeled.manifest').get()['Body'].read()
-    expected_input = b'{"source": "This is a dog.", "id": 0, "k": 1000000}\n{"source": "This is a message about cat", "id": 1, "k": 1000000}\n'
+    staged = sorted(get_uris_inside_prefix(S3Ref.from_uri(output['UnlabeledPrefixS3Uri'] + '/')))
+    assert staged == ['job-name/labeled_by_active_learning/{0}/{0}.jpg'.format(i) for i in (0, 2, 4)]
+    assert Image.open(download_bytesio(S3Ref('output', staged[0]))).size == (400, 300)
+    image_sizes = json.loads(download_bytesio(S3Ref.from_uri(output['StagedImagesS3Uri'])).getvalue())
+    assert image_sizes == {"s3://input/images/{}.jpg".format(i): IMAGE_SIZE for i in (0, 1, 2, 4)}
+    near_duplicates = json.loads(download_bytesio(S3Ref.from_uri(output['NearDuplicatesS3Uri'])).getvalue())
+    assert near_duplicates == {"1": 0}
 
+    # A retry of the same iteration returns the recorded result.
+    assert lambda_handler(copy.deepcopy(event), {}) == output
+    # So does a new training job on the same data, under its own transform job name.
+    event['meta_data']['training_config']['TrainingJobName'] = 'job-name-2'
+    again = lambda_handler(copy.deepcopy(event), {})
+    assert again['transform_config']['TransformJobName'] == 'job-name-2'
+    assert again['StagedImagesS3Uri'] == output['StagedImagesS3Uri']
+    assert metrics.get_metrics().values['idempotency.reused'][0] == 1
 
-    assert output['UnlabeledS3Uri'] == 's3://output/unlabeled.manifest'
-    assert output['transform_config'] == {
-        'TransformJobName' : 'job-name',
-        'ModelName' : 'job-name',
-        'S3OutputPath': 's3://output/'
-    }
-    assert batch_transform_input == expected_input
 
+def test_augment_inference_input_excludes_pending_records():
+    from ActiveLearning.prepare_for_inference import augment_inference_input
+    inference_raw = StringIO('{"id": 0}\n{"id": 1}\n{"id": 2}\n')
+    augmented = augment_inference_input(inference_raw, excluded_ids={1})
+    assert augmented.getvalue() == '{"id": 0, "k": 1000000}\n{"id": 2, "k": 1000000}\n'
@@ -1,6 +1,10 @@
+import json
+from io import StringIO
 from moto import mock_s3
 
+import metrics
 from Labeling.prepare_for_labeling import lambda_handler
+from s3_helper import S3Ref, download_stringio, upload
 
 @mock_s3
 def test_prepare_for_labeling(monkeypatch):
@@ -29,3 +33,37 @@ def test_prepare_for_labeling(monkeypatch):
     assert output['labeling_job_name'].startswith('jobprefix')
     assert output['labeling_job_output_uri'].startswith('s3://output/labeling-job')
 
+
+
+def test_prepare_for_labeling_picks_unlabeled_ids_from_the_label_state_index(local_storage):
+    from Bootstrap.add_record_id import lambda_handler as add_record_id
+
+    manifest = S3Ref('input', 'input.manifest')
+    rows = [{"source-ref": "s3://input/images/{}.jpg".format(i)} for i in range(8)]
+    for i in (0, 2, 3):
+        rows[i].update({"category": {}, "category-metadata": {"human-annotated": "yes"}})
+    upload(StringIO("".join(json.dumps(row) + "\n" for row in rows)), manifest)
+    add_record_id({'ManifestS3Uri': manifest.get_uri(), 'LabelAttributeName': 'category'}, {})
+    event = {
+        'LabelingJobNamePrefix': 'jobprefix',
+        'input_total': 8,
+        'human_label_done_count': 3,
+        'IntermediateFolderUri': 's3://output/',
+        'LabelAttributeName': 'category',
+        'ManifestS3Uri': manifest.get_uri()
+    }
+
+    output = lambda_handler(event, {})
+    human_input = [json.loads(line) for line in download_stringio(S3Ref.from_uri(output['human_input_s3_uri']))]
+    assert [row['id'] for row in human_input] == [1, 4, 5, 6, 7]
+    assert not {"label_state.missing", "label_state.stale"} & set(metrics.get_metrics().values)
+
+    # Without a current index the records are selected by their missing label.
+    labeled = [json.loads(line) for line in download_stringio(manifest)]
+    labeled[1].update({"category": {}, "category-metadata": {"human-annotated": "yes"}})
+    upload(StringIO("".join(json.dumps(row) + "\n" for row in labeled)), manifest)
+    event['human_label_done_count'] = 4
+    output = lambda_handler(event, {})
+    human_input = [json.loads(line) for line in download_stringio(S3Ref.from_uri(output['human_input_s3_uri']))]
+    assert [row['id'] for row in human_input] == [4, 5, 6, 7]
+    assert metrics.get_metrics().values["label_state.stale"][0] == 1
@@ -1,36 +1,28 @@
 from moto import mock_s3
 import boto3
-from io import StringIO
-import string_helper
+import json
+from io import BytesIO
+from recordio import iter_records, unpack_image_record
 from ActiveLearning.prepare_for_training import lambda_handler
 
 @mock_s3
 def test_prepare_for_training(monkeypatch):
+    from PIL import Image
 
-    def mock_copy(*args, **kwargs):
-        source = args[0]
-        dest = args[1]
-        query = args[2]
-        transform = args[3]
-        mock_input = StringIO()
-        mock_input.write('{"source": "This is a dog.", "id": 0}\n')
-        mock_input.write('{"source": "This is a message about cat", "id": 1}\n')
-        mock_input.seek(0)
-        augmented_input = transform(mock_input)
-        s3r.Object('output', 'active-learning-0ypM8t7c/training_input.manifest').put(Body=augmented_input.getvalue().encode())
-        print("Copy with transform mocked out source {} dest {} query {}".format(source, dest, query))
-        return mock_input
+    def labeled_row(record_id):
+        return {"source-ref": "s3://input/images/{}.jpg".format(record_id), "id": record_id,
+                "category": {"annotations": [{"class_id": 1, "left": 10, "top": 10, "width": 100, "height": 50}]},
+                "category-metadata": {"human-annotated": "yes"}}
 
-    def mock_download_query(*args, **kwargs):
-        mock_validation = StringIO()
-        mock_validation.write('{"id": 0}\n')
-        mock_validation.seek(0)
-        return mock_validation
+    def mock_query(*args, **kwargs):
+        source = args[0]
+        query = args[1]
+        print("Query mocked out source {} query {}".format(source, query))
+        for record_id in range(2):
+            yield json.dumps(labeled_row(record_id))
 
     from ActiveLearning import prepare_for_training
-    monkeypatch.setattr(prepare_for_training, "copy_with_query_and_transform", mock_copy)
-    monkeypatch.setattr(prepare_for_training, "download_with_query", mock_download_query)
-    monkeypatch.setattr(string_helper, "generate_random_string", lambda: "0ypM8t7c")
+    monkeypatch.setattr(prepare_for_training, "iter_query_lines", mock_query)
     event = {
         'LabelingJobNamePrefix': 'job-prefix',
         'LabelAttributeName': 'category',
@@ -48,22 +40,44 @@ def test_prepare_for_training(monkeypatch):
     s3r = boto3.resource('s3', region_name='us-east-1')
     s3r.create_bucket(Bucket='input')
     s3r.create_bucket(Bucket='output')
-    input = b'{"source": "This is a dog.", "id": 0}\n{"source": "This is a message about cat", "id": 1}\n'
-    s3r.Object('input', 'input.manifest').put(Body=input)
-    validation_input = b'{"source": "This is a dog.", "id": 0}\n'
-    s3r.Object('input', 'validation.manifest').put(Body=validation_input)
+    for record_id in range(2):
+        image = BytesIO()
+        Image.new("RGB", (1200, 600)).save(image, format="JPEG")
+        s3r.Object('input', 'images/{}.jpg'.format(record_id)).put(Body=image.getvalue())
+    validation_input = json.dumps(labeled_row(0)) + '\n'
+    s3r.Object('input', 'validation.manifest').put(Body=validation_input.encode())
 
     output = lambda_handler(event, {})
 
-    training_input = s3r.Object('output', 'active-learning-0ypM8t7c/training_input.manifest').get()['Body'].read()
-    expected_input = b'{"source": "This is a message about cat", "id": 1}\n'
+    def read_channel(uri):
+        bucket, key = uri[len("s3://"):].split("/", 1)
+        prefix, *shards = json.loads(s3r.Object(bucket, key).get()['Body'].read())
+        records = []
+        for shard in shards:
+            bucket, key = (prefix["prefix"] + shard)[len("s3://"):].split("/", 1)
+            records += [unpack_image_record(record) for record in iter_records(s3r.Object(bucket, key).get()['Body'].read())]
+        return records
+
+    training_records = read_channel(output['trainS3Uri'])
+    validation_records = read_channel(output['validationS3Uri'])
 
     assert output['TrainingJobName'].startswith('job-prefix')
-    assert output['trainS3Uri'] == 's3://output/active-learning-0ypM8t7c/training_input.manifest'
+    assert output['trainS3Uri'] == output['S3OutputPath'] + 'train_shards.manifest'
     assert output['ResourceConfig'] is not None
     assert output['AlgorithmSpecification'] is not None
-    assert output['HyperParameters'] is not None
-    assert output['S3OutputPath'] == 's3://output/active-learning-0ypM8t7c/'
-    assert output['AttributeNames'] == ["source", "category"]
-    assert training_input == expected_input
+    # The validation image is left out of the training data.
+    assert output['HyperParameters']['num_training_samples'] == '1'
+    assert output['S3OutputPath'].startswith('s3://output/active-learning-')
+    assert [record[0] for record in training_records] == [1]
+    assert [record[0] for record in validation_records] == [0]
+    assert Image.open(BytesIO(training_records[0][2])).size == (600, 300)
+
+    # A second execution with the same inputs reuses the training data under a new job name,
+    # since SageMaker never accepts a job name twice.
+    again = lambda_handler(event, {})
+    assert again['TrainingJobName'] != output['TrainingJobName']
+    assert dict(again, TrainingJobName=None) == dict(output, TrainingJobName=None)
 
+    # A new validation set changes the training data, so the completed result is not reused.
+    s3r.Object('input', 'validation.manifest').put(Body=(json.dumps(labeled_row(1)) + '\n').encode())
+    assert lambda_handler(event, {})['S3OutputPath'] != output['S3OutputPath']
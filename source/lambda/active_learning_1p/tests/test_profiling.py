@@ -0,0 +1,57 @@
+import marshal
+import pytest
+
+import profiling
+import s3_helper
+
+
+def allocate(event, context):
+    return len([str(i) for i in range(event.get('size', 1000))])
+
+
+@pytest.fixture
+def profile_output(tmp_path, monkeypatch):
+    monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+    monkeypatch.setenv(profiling.PROFILE_OUTPUT_ENV, str(tmp_path / 'profiles'))
+    return tmp_path / 'profiles'
+
+
+def test_disabled_by_default(profile_output):
+    handler = profiling.profile_handler(allocate)
+    assert handler({}, {}) == 1000
+    assert not profile_output.exists()
+
+
+def test_enabled_by_environment(profile_output, monkeypatch):
+    monkeypatch.setenv(profiling.PROFILE_ENV, '1')
+    handler = profiling.profile_handler(allocate)
+    assert handler({}, {}) == 1000
+
+    pstats_files = list(profile_output.glob('test_profiling-*.pstats'))
+    report_files = list(profile_output.glob('test_profiling-*.txt'))
+    assert len(pstats_files) == 1
+    assert len(report_files) == 1
+    stats = marshal.loads(pstats_files[0].read_bytes())
+    assert any(function_name == 'allocate' for _, _, function_name in stats)
+    report = report_files[0].read_text()
+    assert 'tracemalloc peak' in report
+    assert 'cumulative' in report
+
+
+def test_enabled_by_event_flag_memory_only(profile_output):
+    handler = profiling.profile_handler(allocate)
+    assert handler({'Profile': 'memory'}, {}) == 1000
+
+    assert list(profile_output.glob('*.pstats')) == []
+    assert 'tracemalloc peak' in list(profile_output.glob('*.txt'))[0].read_text()
+
+
+def test_writes_to_s3_prefix(tmp_path, monkeypatch):
+    monkeypatch.setenv(s3_helper.LOCAL_S3_ROOT_ENV, str(tmp_path))
+    monkeypatch.setenv(profiling.PROFILE_OUTPUT_ENV, 's3://bucket/profiles/')
+    s3_helper.reset_s3_client()
+    handler = profiling.profile_handler(allocate)
+    handler({'Profile': 'cpu'}, {})
+    s3_helper.reset_s3_client()
+
+    assert len(list((tmp_path / 'bucket' / 'profiles').glob('*.pstats'))) == 1
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import metrics
+from ActiveLearning.helper import ImageActiveLearning
+from ActiveLearning.propagation import get_frame_position, iou_matrix, load_labeled_frames, match_boxes
+
+
+def human_row(frame, annotations):
+    return {
+        "source-ref": "s3://bucket/drive-1/front_{:06d}.jpg".format(frame),
+        "category": {"annotations": annotations, "image_size": [{"width": 200, "height": 100, "depth": 3}]},
+        "category-metadata": {"human-annotated": "yes"}
+    }
+
+
+def test_get_frame_position():
+    assert get_frame_position("s3://bucket/drive-1/front_000012.jpg") == ("s3://bucket/drive-1/front_.jpg", 12)
+    assert get_frame_position("s3://bucket/drive-1/rear_000012.jpg")[0] != "s3://bucket/drive-1/front_.jpg"
+    assert get_frame_position("s3://bucket/drive-1/front.jpg") is None
+
+
+def test_iou_matrix():
+    boxes = np.array([[0, 0, 2, 2], [0, 0, 1, 1]], dtype=float)
+    ious = iou_matrix(boxes, np.array([[1, 1, 3, 3], [0, 0, 2, 2], [5, 5, 5, 5]], dtype=float))
+    assert ious == pytest.approx(np.array([[1 / 7, 1, 0], [0, 0.25, 0]]))
+
+
+def test_match_boxes_requires_one_to_one_matches_of_the_same_class():
+    boxes = np.array([[0, 0, 0.5, 0.5], [0.5, 0.5, 1, 1]])
+    moved = boxes + 0.02
+    classes = np.array([0, 1])
+    assert match_boxes(boxes, classes, moved[::-1], classes[::-1])
+    assert not match_boxes(boxes, classes, moved, classes[::-1])
+    assert not match_boxes(boxes, classes, moved[:1], classes[:1])
+    assert not match_boxes(boxes, classes, boxes + 0.3, classes)
+
+
+def test_detections_confirmed_by_an_adjacent_human_label_are_autoannotated():
+    metrics.get_metrics().reset()
+    annotations = [{"class_id": 1, "left": 20, "top": 10, "width": 100, "height": 50}]
+    unlabeled = [{"source-ref": "s3://bucket/drive-1/front_{:06d}.jpg".format(frame), "id": frame}
+                 for frame in (11, 12, 30)]
+    labeled_frames = load_labeled_frames(
+        [human_row(10, annotations), human_row(50, annotations)],
+        (row["source-ref"] for row in unlabeled), "category")
+    assert len(labeled_frames) == 1
+
+    # A single box moved slightly since frame 10 with a score too low to be autoannotated.
+    detection = [[1, 0.3, 0.11, 0.12, 0.61, 0.62]]
+    predictions = [{"prediction": detection}, {"prediction": detection}, {"prediction": detection}]
+    sizes = {row["source-ref"]: {"width": 200, "height": 100, "depth": 3} for row in unlabeled}
+    image_al = ImageActiveLearning("job", "category", {}, 10, sizes, labeled_frames=labeled_frames)
+
+    autoannotations = list(image_al.generate_autoannotations(zip(unlabeled, predictions)))
+    assert [autoannotation["id"] for autoannotation in autoannotations] == [11, 12]
+    assert autoannotations[0]["category"]["annotations"][0]["left"] == 22
+    assert autoannotations[0]["category-metadata"]["human-annotated"] == "no"
+    assert metrics.get_metrics().values["propagation.promoted"][0] == 2
@@ -0,0 +1,38 @@
+from io import StringIO
+
+import metrics
+import s3_helper
+from s3_helper import S3Ref, download_cached, upload
+
+
+def counts():
+    values = metrics.get_metrics().values
+    return {name[len("s3.cache."):]: value for name, (value, _) in values.items() if name.startswith("s3.cache.")}
+
+
+def test_download_cached_revalidates_with_etag(local_storage):
+    labels = S3Ref('bucket', 'labels.json')
+    upload(StringIO('{"class-map": {"0": "pedestrian"}}'), labels)
+
+    assert download_cached(labels) == b'{"class-map": {"0": "pedestrian"}}'
+    assert download_cached(labels) == b'{"class-map": {"0": "pedestrian"}}'
+    assert counts() == {'miss': 1, 'revalidated': 1}
+
+    upload(StringIO('{"class-map": {"0": "car"}}'), labels)
+    assert download_cached(labels) == b'{"class-map": {"0": "car"}}'
+    assert counts() == {'miss': 2, 'revalidated': 1}
+
+
+def test_download_cached_serves_fresh_copies_without_requests(local_storage, tmp_path):
+    labels = S3Ref('bucket', 'labels.json')
+    upload(StringIO('{}'), labels)
+    download_cached(labels, max_age=60)
+    gets = metrics.get_metrics().io['get']['count']
+
+    assert download_cached(labels, max_age=60) == b'{}'
+    # A cold container of the same function finds the copy in /tmp.
+    s3_helper.reset_s3_client()
+    assert download_cached(labels, max_age=60) == b'{}'
+    assert metrics.get_metrics().io['get']['count'] == gets
+    assert counts() == {'miss': 1, 'memory_hit': 1, 'disk_hit': 1}
+    assert list((tmp_path / "cache").glob("*.body"))
@@ -0,0 +1,27 @@
+import random
+from collections import Counter
+
+from sampling import StratifiedReservoir, get_allocation
+
+
+def test_get_allocation_balances_strata():
+    assert get_allocation({"a": 100, "b": 100}, 10) == {"a": 5, "b": 5}
+    assert get_allocation({"a": 100, "b": 2, "c": 100}, 10) == {"a": 4, "b": 2, "c": 4}
+    assert get_allocation({"a": 100, "b": 100, "c": 100}, 10) == {"a": 4, "b": 3, "c": 3}
+    assert get_allocation({"a": 3, "b": 2}, 10) == {"a": 3, "b": 2}
+    # Uneven slots go by first appearance, not by count.
+    assert get_allocation({"a": 100, "b": 50, "c": 100}, 10) == {"a": 4, "b": 3, "c": 3}
+    assert get_allocation({"b": 50, "a": 100, "c": 100}, 10) == {"b": 4, "a": 3, "c": 3}
+
+
+def test_stratified_reservoir_is_balanced_and_uniform():
+    picks = Counter()
+    for seed in range(200):
+        reservoir = StratifiedReservoir(20, random.Random(seed))
+        for item in range(1000):
+            reservoir.add("rare" if item % 100 == 0 else "common", item)
+        assert reservoir.get_counts() == {"rare": 10, "common": 10}
+        picks.update(item // 100 for item in reservoir.items() if item % 100)
+
+    # Common items are picked evenly across the stream, not from its start.
+    assert max(picks.values()) < 1.3 * min(picks.values())
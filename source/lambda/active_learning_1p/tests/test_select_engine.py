@@ -0,0 +1,95 @@
+import json
+import pytest
+
+from select_engine import SelectSyntaxError, parse, select_lines
+
+ROWS = [
+    '{"source-ref": "s3://b/0.jpg", "id": 0, "label": {}, "label-metadata": {"human-annotated": "yes"}}\n',
+    '{"source-ref": "s3://b/1.jpg", "id": 1, "label": {}, "label-metadata": {"human-annotated": "no"}}\n',
+    '{"source-ref": "s3://b/2.jpg", "id": 2}\n',
+    '\n',
+    '{"source-ref": "s3://b/3.jpg", "id": 3}\n',
+]
+JSON_OUTPUT = {'JSON': {}}
+
+
+def select(expression, output_serialization=JSON_OUTPUT):
+    return list(select_lines(expression, ROWS, output_serialization))
+
+
+def test_queries_used_by_the_handlers():
+    unlabeled = select("""select * from s3object[*] s where s."label" is missing LIMIT 1""")
+    assert [json.loads(line)['id'] for line in unlabeled] == [2]
+
+    human = select("""select * from s3object[*] s where s."label-metadata"."human-annotated" IN ('yes')""")
+    assert [json.loads(line)['id'] for line in human] == [0]
+
+    ids = select("""select s."id" from s3object[*] s where s."label-metadata"."human-annotated" IN ('no')""")
+    assert ids == ['{"id":1}\n']
+
+    assert select("select count(*) from s3object s", {'CSV': {}}) == ['4\n']
+    assert select("""select count(*) from s3object[*] s where s."label-metadata"."human-annotated" IN ('yes')""",
+                  {'CSV': {}}) == ['1\n']
+
+
+def test_conditions():
+    ids = select("""SELECT s.id FROM S3Object s WHERE (s.id > 0 AND s.id <= 2) OR s."label" IS NOT MISSING""")
+    assert [json.loads(line)['id'] for line in ids] == [0, 1, 2]
+    ids = select("""select s.id from s3object s where not s.id in (1, 2)""")
+    assert [json.loads(line)['id'] for line in ids] == [0, 3]
+    # Comparisons with a missing value are unknown, so neither the condition nor its negation selects the row.
+    assert select("""select s.id from s3object s where s."label-metadata"."human-annotated" = 'yes'""") == ['{"id":0}\n']
+    assert select("""select s.id from s3object s where not s."label-metadata"."human-annotated" = 'yes'""") == \
+        ['{"id":1}\n']
+
+
+def test_unsupported_syntax():
+    with pytest.raises(SelectSyntaxError):
+        parse("select * from s3object s where s.id like '1%'")
+
+
+def test_compiled_conditions_match_the_interpreter():
+    import random
+    from select_engine import compile_condition, evaluate, get_required_literals, parse_json_lines
+
+    rng = random.Random(0)
+    conditions = [
+        """s."label" is missing""",
+        """s."label-metadata"."human-annotated" IN ('yes')""",
+        """s."label-metadata"."human-annotated" = 'no' OR s.id < 2""",
+        """NOT (s.id IN (1, 3) AND s."label" IS NOT NULL)""",
+        """s."label-metadata"."human-annotated" IN ('yes', 'no') AND s.id >= 1""",
+        """'yes' = s."label-metadata"."human-annotated" AND NOT s."label" IS MISSING""",
+    ]
+    lines = []
+    for i in range(300):
+        row = {"source-ref": "s3://b/{}.jpg".format(i), "id": rng.choice([i, None, "x"])}
+        if rng.random() < 0.6:
+            row["label"] = rng.choice([{}, None])
+            row["label-metadata"] = {"human-annotated": rng.choice(["yes", "no", None])}
+        lines.append(json.dumps(row) + "\n")
+
+    for condition in conditions:
+        query = parse("select * from s3object s where " + condition)
+        compiled = compile_condition(query.where, query.alias)
+        records = list(parse_json_lines(lines))
+        assert [compiled(record) for record in records] == [evaluate(query.where, record, query.alias)
+                                                            for record in records]
+        # The byte level pre-filter only drops lines which can not match.
+        kept = list(parse_json_lines(lines, get_required_literals(query.where)))
+        assert [record for record in records if compiled(record) is True] == \
+            [record for record in kept if compiled(record) is True]
+
+
+def test_required_literals():
+    from select_engine import get_required_literals
+
+    def required(condition):
+        return get_required_literals(parse("select * from s3object s where " + condition).where)
+
+    assert required("""s."label-metadata"."human-annotated" IN ('yes')""") == {b'"yes"'}
+    assert required("""s.a = 'x' AND s.b IN ('y', 'z')""") == {b'"x"'}
+    assert required("""s.a = 'x' OR s.b = 'y'""") == {b'"x"', b'"y"'}
+    assert required("""s.a = 'x' OR s.b is missing""") is None
+    assert required("""s.a NOT IN ('x')""") is None
+    assert required("""s.a = 'needs "escaping"'""") is None
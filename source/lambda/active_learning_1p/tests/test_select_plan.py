@@ -0,0 +1,94 @@
+import json
+from io import StringIO
+
+import pytest
+
+import metrics
+import s3_helper
+from s3_helper import S3Ref, download_with_query, get_count_with_query, iter_query_lines, plan_select, upload
+
+MANIFEST = S3Ref("bucket", "intermediate/input.manifest")
+HUMAN_QUERY = """select * from s3object[*] s where s."category-metadata"."human-annotated" IN ('yes')"""
+UNLABELED_QUERY = """select s."source-ref", s."id" from s3object[*] s where s."category" is missing LIMIT 25"""
+COUNT_QUERY = """select count(*) from s3object[*] s where s."category" is missing"""
+
+
+@pytest.fixture
+def manifest(local_storage):
+    rows = []
+    for i in range(500):
+        row = {"source-ref": "s3://bucket/frames/{}.jpg".format(i) + "x" * (i % 37), "id": i}
+        if i % 3 == 0:
+            row["category"] = {"annotations": []}
+            row["category-metadata"] = {"human-annotated": "yes" if i % 2 else "no"}
+        rows.append(row)
+    upload(StringIO("".join(json.dumps(row) + "\n" for row in rows)), MANIFEST)
+    return rows
+
+
+def force(monkeypatch, strategy, size):
+    # Make the wanted strategy the cheapest one for this object size.
+    if strategy == "local":
+        monkeypatch.setattr(s3_helper, "SELECT_REQUEST_SECONDS", 1000.0)
+    else:
+        monkeypatch.setattr(s3_helper, "LOCAL_SCAN_BYTES_PER_SECOND", 1)
+    monkeypatch.setattr(s3_helper, "SCAN_RANGE_MIN_BYTES", size // 7 if strategy == "ranged" else size + 1)
+
+
+def run_queries():
+    return (list(iter_query_lines(MANIFEST, HUMAN_QUERY)), download_with_query(MANIFEST, UNLABELED_QUERY).read(),
+            get_count_with_query(MANIFEST, COUNT_QUERY))
+
+
+def test_small_objects_are_scanned_locally(manifest):
+    assert plan_select(MANIFEST, COUNT_QUERY).strategy == "local"
+    # The local engine does not parse LIKE, s3_select is left to handle it.
+    assert plan_select(MANIFEST, "select * from s3object s where s.id like '1%'").strategy == "select"
+
+
+def test_ranged_plan_covers_the_object(manifest, monkeypatch):
+    size = s3_helper.get_content_size(MANIFEST)
+    force(monkeypatch, "ranged", size)
+    plan = plan_select(MANIFEST, COUNT_QUERY)
+    assert plan.strategy == "ranged"
+    assert len(plan.ranges) == 7
+    assert plan.ranges[0][0] == 0 and plan.ranges[-1][1] == size - 1
+    assert all(end + 1 == start for (_, end), (start, _) in zip(plan.ranges, plan.ranges[1:]))
+
+
+def test_every_strategy_returns_the_same_results(manifest, monkeypatch):
+    size = s3_helper.get_content_size(MANIFEST)
+    results = {}
+    for strategy in ("local", "select", "ranged"):
+        with monkeypatch.context() as patch:
+            force(patch, strategy, size)
+            results[strategy] = run_queries()
+            assert metrics.get_metrics().values["s3.select.plan.{}".format(strategy)][0] == 3
+
+    human, unlabeled, count = results["select"]
+    assert [json.loads(line)["id"] for line in human] == [row["id"] for row in manifest if row["id"] % 6 == 3]
+    assert [json.loads(line)["id"] for line in unlabeled.splitlines()] == \
+        [row["id"] for row in manifest if "category" not in row][:25]
+    assert count == sum(1 for row in manifest if "category" not in row)
+    assert results["local"] == results["select"] == results["ranged"]
+
+
+def test_queries_fall_back_to_the_local_engine_without_s3_select(manifest, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    size = s3_helper.get_content_size(MANIFEST)
+    force(monkeypatch, "ranged", size)
+    requests = []
+
+    def unavailable(**kwargs):
+        requests.append(kwargs)
+        raise ClientError({'Error': {'Code': 'MethodNotAllowed', 'Message': 'The specified method is not allowed'}},
+                          'SelectObjectContent')
+
+    expected = run_queries()
+    monkeypatch.setattr(s3_helper.get_s3_client(), "select_object_content", unavailable)
+    assert run_queries() == expected
+    assert metrics.get_metrics().values["s3.select.fallback"][0] == 1
+    # Once known to be unavailable, s3_select is not tried again.
+    assert len(requests) <= s3_helper.SCAN_RANGE_WORKERS
+    assert plan_select(MANIFEST, COUNT_QUERY).strategy == "local"
@@ -0,0 +1,21 @@
+import pytest
+
+import s3_helper
+from ActiveLearning import s3_helper as active_learning_s3_helper
+from simulator.run import parse_args, simulate
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_simulated_loop_labels_every_row(tmp_path, monkeypatch, pipelined):
+    monkeypatch.setenv(s3_helper.LOCAL_S3_ROOT_ENV, str(tmp_path))
+    argv = ["--rows", "40", "--root", str(tmp_path)] + (["--pipelined"] if pipelined else [])
+    report = simulate(parse_args(argv))
+    s3_helper.reset_s3_client()
+    active_learning_s3_helper.reset_s3_client()
+
+    assert report['final_labels']['unlabeled'] == 0
+    assert report['final_labels']['human'] == report['labeling']['images']
+    assert report['iterations']['active_learning'] >= 1
+    assert report['states']['ActiveLearningLoop-simulation.GetCounts']['count'] >= 2
+    assert report['output']['FinalManifestS3Uri'].endswith('final_output.manifest')
+    assert ('ActiveLearningLoop-simulation.LabelAndRetrain' in report['states']) == pipelined
@@ -0,0 +1,65 @@
+import json
+import pytest
+from io import StringIO
+from PIL import Image
+
+from ActiveLearning import s3_helper
+from ActiveLearning.helper import ImageActiveLearning
+from ActiveLearning.perform_active_learning import (
+    collect_inference_outputs_from_prefix, get_predictions, join_manifest_and_inference_outputs,
+    write_auto_annotations, write_selector_file)
+from ActiveLearning.s3_helper import S3Ref, download_stringio, upload
+
+
+def test_get_predictions_is_lazy_and_flattens_sagemaker_output():
+    lines = iter(['{"id": 0, "SageMakerOutput": {"prob": [0.9]}}\n', 'not json\n'])
+    predictions = get_predictions(lines)
+    assert next(predictions) == {"id": 0, "prob": [0.9]}
+    with pytest.raises(ValueError):
+        next(predictions)
+    with pytest.raises(ValueError):
+        next(get_predictions(['{"SageMakerOutput": [0.9]}\n']))
+
+
+def test_stream_outputs_into_autoannotations_and_selections(local_storage):
+    manifest_dicts = [
+        {"source-ref": "s3://input/images/{}.jpg".format(i), "id": i} for i in range(3)
+    ]
+    predictions = {
+        0: {"prediction": [[0.0, 0.9, 0.1, 0.1, 0.5, 0.5]]},
+        1: {"prediction": [[1.0, 0.2, 0.1, 0.1, 0.5, 0.5]]},
+        2: {"SageMakerOutput": {"prediction": [[1.0, 0.95, 0.2, 0.2, 0.6, 0.6]]}},
+    }
+    for i, prediction in predictions.items():
+        upload(StringIO(json.dumps(prediction)), S3Ref('input', 'output/{0}/{0}.jpg.out'.format(i)))
+    upload(StringIO("{}"), S3Ref('input', 'output/_SUCCESS'))
+    upload(StringIO(json.dumps(predictions[0])), S3Ref('input', 'output/unknown.jpg.out'))
+    (local_storage / 'input' / 'images').mkdir(parents=True)
+    for i in range(3):
+        Image.new("RGB", (20, 10)).save(str(local_storage / 'input' / 'images' / '{}.jpg'.format(i)))
+
+    inference_outputs = collect_inference_outputs_from_prefix('s3://input/output/')
+    aligned_predictions = join_manifest_and_inference_outputs(manifest_dicts, inference_outputs)
+    image_al = ImageActiveLearning("labeling-job/test", "label", {"0": "car", "1": "bike"}, 10)
+    input_ref = S3Ref('input', 'unlabeled.manifest')
+
+    uri, auto_annotation_ids = write_auto_annotations(image_al, aligned_predictions, input_ref)
+    assert uri == 's3://input/autoannotated.manifest'
+    assert sorted(auto_annotation_ids) == [0, 2]
+    auto_annotations = [json.loads(line) for line in download_stringio(S3Ref.from_uri(uri))]
+    assert sorted(annotation['id'] for annotation in auto_annotations) == [0, 2]
+
+    uri, selections = write_selector_file(image_al, manifest_dicts, input_ref, auto_annotation_ids)
+    assert selections == [1]
+    assert [json.loads(line) for line in download_stringio(S3Ref.from_uri(uri))] == [manifest_dicts[1]]
+
+
+def test_outputs_are_joined_by_record_id():
+    # Both images are named 0.jpg, each output goes to the row it was staged for.
+    rows = [{"source-ref": "s3://input/camera-a/0.jpg", "id": 3}, {"source-ref": "s3://input/camera-b/0.jpg", "id": 4}]
+    outputs = [(S3Ref("input", "output/4/0.jpg.out"), "p4"), (S3Ref("input", "output/3/0.jpg.out"), "p3")]
+    aligned = join_manifest_and_inference_outputs(rows, outputs)
+    assert [(row["id"], prediction) for row, prediction in aligned] == [(4, "p4"), (3, "p3")]
+
+    with pytest.raises(ValueError):
+        list(join_manifest_and_inference_outputs(rows + [dict(rows[0])], outputs))
@@ -0,0 +1,62 @@
+import json
+import pytest
+from io import BytesIO
+
+import metrics
+from recordio import iter_records, unpack_image_record
+from s3_helper import S3Ref, download_bytesio, upload_bytes
+
+from ActiveLearning.training_shards import build_shards, write_shard_manifest
+
+FOLDER = "s3://bucket/intermediate/training-shards/train/"
+
+
+def make_row(record_id, class_id=0):
+    from PIL import Image
+    image = BytesIO()
+    Image.new("RGB", (640, 480), (record_id, 0, 0)).save(image, format="JPEG")
+    source_ref = "s3://bucket/images/{}.jpg".format(record_id)
+    upload_bytes(image.getvalue(), S3Ref.from_uri(source_ref))
+    return {"source-ref": source_ref, "id": record_id,
+            "category": {"annotations": [{"class_id": class_id, "left": 64, "top": 48, "width": 320, "height": 240}]}}
+
+
+def read_records(manifest_uri):
+    prefix, *keys = json.loads(download_bytesio(S3Ref.from_uri(manifest_uri)).getvalue())
+    records = {}
+    for key in keys:
+        for record in iter_records(download_bytesio(S3Ref.from_uri(prefix["prefix"] + key)).getvalue()):
+            record_id, labels, image_bytes = unpack_image_record(record)
+            records[record_id] = (labels, image_bytes)
+    return records
+
+
+def packed():
+    return metrics.get_metrics().values["training_shards.packed"][0]
+
+
+def test_build_shards_packs_only_new_and_changed_records(local_storage):
+    from PIL import Image
+    rows = [make_row(record_id) for record_id in range(3)]
+    manifest = S3Ref.from_uri("s3://bucket/intermediate/iteration-1/train_shards.manifest")
+    assert write_shard_manifest(FOLDER, build_shards(rows, FOLDER, "category", 300), manifest) == 3
+
+    records = read_records(manifest.get_uri())
+    labels, image_bytes = records[1]
+    assert labels == pytest.approx([2, 5, 0, 0.1, 0.1, 0.6, 0.6])
+    assert Image.open(BytesIO(image_bytes)).size == (400, 300)
+
+    # A new record is packed, a relabeled one is repacked and the others are copied.
+    metrics.get_metrics().reset()
+    rows = [rows[0], make_row(1, class_id=2), rows[2], make_row(3)]
+    manifest = S3Ref.from_uri("s3://bucket/intermediate/iteration-2/train_shards.manifest")
+    assert write_shard_manifest(FOLDER, build_shards(rows, FOLDER, "category", 300), manifest) == 4
+    assert packed() == 2
+
+    records = read_records(manifest.get_uri())
+    assert sorted(records) == [0, 1, 2, 3]
+    assert records[1][0][2] == 2
+
+    metrics.get_metrics().reset()
+    build_shards(rows, FOLDER, "category", 300)
+    assert packed() == 0
@@ -1,42 +1,70 @@
 import json
 import numpy as np
-from package.manifest import read_image, dump_manifest_rows
+from concurrent.futures import ThreadPoolExecutor
+from package.manifest import read_image_size, dump_manifest_rows
 
 from sagemaker.s3 import S3Uploader
 
+PEDESTRIAN_CLASS_ID = 2
+PREPARE_WORKERS = 32
+
 def unlabeled_input():
     pass
 
+def get_image_sizes(image_paths, max_workers=PREPARE_WORKERS):
+    # Header reads are dominated by S3 latency, threads overlap them.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read_image_size, image_paths))
+
+def get_pedestrian_annotations(manifest_rows):
+    """
+    Return the pedestrian boxes of every row, relabeled as class 0. The class ids of all rows
+    are compared in a single vectorized pass and the matching boxes regrouped by row.
+    """
+    if not manifest_rows:
+        return []
+    annotations = [row['true-labels']['annotations'] for row in manifest_rows]
+    counts = np.fromiter((len(row_annotations) for row_annotations in annotations), dtype=np.int64,
+                         count=len(annotations))
+    flat_annotations = [annotation for row_annotations in annotations for annotation in row_annotations]
+    class_ids = np.fromiter((int(annotation['class_id']) for annotation in flat_annotations), dtype=np.int64,
+                            count=len(flat_annotations))
+    row_indices = np.repeat(np.arange(len(annotations)), counts)
+    kept = np.flatnonzero(class_ids == PEDESTRIAN_CLASS_ID)
+    groups = np.split(kept, np.searchsorted(row_indices[kept], np.arange(1, len(annotations))))
+    return [
+        [{
+            "class_id": 0,
+            "top": flat_annotations[i]['top'],
+            "left": flat_annotations[i]['left'],
+            "width": flat_annotations[i]['width'],
+            "height": flat_annotations[i]['height']
+        } for i in group]
+        for group in groups
+    ]
+
 def partially_labeled_input(s3_location, manifest_rows, ratio_unlabeled=0.8):
 
     with open("./artifacts/annotations_metadata.json", "r") as f:
         label_metadata = json.load(f)
 
+    labeled_rows = [(row, annotations) for row, annotations in zip(manifest_rows, get_pedestrian_annotations(manifest_rows))
+                    if annotations]
+    # Image sizes are probed from the headers, only for the rows which are kept.
+    image_sizes = get_image_sizes([row['source-ref'] for row, _ in labeled_rows])
+
     partially_labelled_manifest_rows = []
-    for row in manifest_rows:
-        image = read_image(row['source-ref'])
-        height, width, depth = image.shape
+    for (row, annotations), (width, height, depth) in zip(labeled_rows, image_sizes):
         image_size = {
             "width": width, "height": height, "depth": depth
         }
-
         manifest_row = dict()
         # image_path = os.path.basename(row['source-ref'])
         # manifest_row['source-ref'] = "{}/images/{}".format(s3_location, image_path)
         manifest_row['source-ref'] = row['source-ref']
-        manifest_row['label'] = {"annotations": [], "image_size": [image_size]}
-        for annotation in row['true-labels']['annotations']:
-            if annotation["class_id"] == 2: # get for pedestrians
-                manifest_row['label']['annotations'].append({
-                    "class_id": 0,
-                    "top": annotation['top'],
-                    "left": annotation['left'],
-                    "width": annotation['width'],
-                    "height": annotation['height']
-                })
-                manifest_row['label-metadata'] = label_metadata
-        if len(manifest_row['label']['annotations']):
-            partially_labelled_manifest_rows.append(manifest_row)
+        manifest_row['label'] = {"annotations": annotations, "image_size": [image_size]}
+        manifest_row['label-metadata'] = label_metadata
+        partially_labelled_manifest_rows.append(manifest_row)
 
 
     n_unlabeled = int(len(partially_labelled_manifest_rows) * ratio_unlabeled)
@@ -45,11 +73,13 @@ def partially_labeled_input(s3_location, manifest_rows, ratio_unlabeled=0.8):
     print("{} examples will be labeled".format(n_labeled))
     print("{} examples will be unlabeled".format(n_unlabeled))
 
-    # Destroy labels
-    unlabeled_idx = np.random.choice(np.arange(len(partially_labelled_manifest_rows)), n_unlabeled, replace=False)
-    for i in unlabeled_idx:
-        del partially_labelled_manifest_rows[i]['label']
-        del partially_labelled_manifest_rows[i]['label-metadata']
+    # Destroy labels, in a single pass over a mask of the rows to unlabel.
+    unlabeled_mask = np.zeros(len(partially_labelled_manifest_rows), dtype=bool)
+    unlabeled_mask[np.random.permutation(len(partially_labelled_manifest_rows))[:n_unlabeled]] = True
+    for manifest_row, unlabeled in zip(partially_labelled_manifest_rows, unlabeled_mask):
+        if unlabeled:
+            del manifest_row['label']
+            del manifest_row['label-metadata']
 
     manifest_path = "./manifests/partially_labeled_input.manifest"
     dump_manifest_rows(partially_labelled_manifest_rows, manifest_path)
@@ -59,4 +89,4 @@ def partially_labeled_input(s3_location, manifest_rows, ratio_unlabeled=0.8):
 def labels_config_and_template(s3_location):
     s3_labels_path = S3Uploader.upload("./artifacts/class_labels.json", s3_location)
     s3_template_path = S3Uploader.upload("./artifacts/instructions.template", s3_location)
-    return s3_labels_path, s3_template_path
\ No newline at end of file
+    return s3_labels_path, s3_template_path
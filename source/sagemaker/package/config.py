@@ -1,7 +1,5 @@
 import json
 import os
-import boto3
-import sagemaker
 from pathlib import Path
 
 
@@ -15,32 +13,108 @@ def get_current_folder(global_variables):
         current_folder = Path(os.getcwd())
     return current_folder
 
-region = boto3.session.Session().region_name
-account_id = boto3.client('sts').get_caller_identity().get('Account')
-default_bucket = sagemaker.session.Session(boto3.session.Session()).default_bucket()
-default_role = sagemaker.get_execution_role()
-
 cfn_stack_outputs = {}
 current_folder = get_current_folder(globals())
 cfn_stack_outputs_filepath = Path(current_folder, '../stack_outputs.json').resolve()
+config_cache_filepath = Path(current_folder, '../.config_cache.json').resolve()
 
 if os.path.exists(cfn_stack_outputs_filepath):
     with open(cfn_stack_outputs_filepath) as f:
         cfn_stack_outputs = json.load(f)
 
-aws_account = cfn_stack_outputs.get('AccountID', account_id)
-region_name = cfn_stack_outputs.get('AWSRegion', region)
 
-solution_name = cfn_stack_outputs.get('SolutionName', 'Visual-perception-with-active-learning')
-solution_upstream_bucket = cfn_stack_outputs.get('SolutionUpstreamS3Bucket', 'sagemaker-solutions-{}'.format(region))
+def get_region():
+    import boto3
+    return boto3.session.Session().region_name
+
+def get_account_id():
+    import boto3
+    return boto3.client('sts').get_caller_identity().get('Account')
+
+def get_default_bucket():
+    import boto3
+    import sagemaker
+    return sagemaker.session.Session(boto3.session.Session()).default_bucket()
+
+def get_default_role():
+    import sagemaker
+    return sagemaker.get_execution_role()
+
+
+def get_cache_key():
+    # Cached values belong to the credentials and region they were resolved with.
+    return "{}:{}".format(os.environ.get('AWS_PROFILE', 'default'), get_region())
+
+def read_config_cache():
+    try:
+        with open(config_cache_filepath) as f:
+            return json.load(f).get(get_cache_key(), {})
+    except (IOError, ValueError):
+        return {}
 
-solution_prefix = cfn_stack_outputs.get('SolutionPrefix', 'sagemaker-soln-entity-res')
-solution_bucket = cfn_stack_outputs.get('SolutionS3Bucket', default_bucket)
-s3_data_prefix = cfn_stack_outputs.get('S3InputDataPrefix', 'raw-data')
+def write_config_cache(name, value):
+    try:
+        with open(config_cache_filepath) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    cache.setdefault(get_cache_key(), {})[name] = value
+    try:
+        with open(config_cache_filepath, "w") as f:
+            json.dump(cache, f, indent=2)
+    except IOError:
+        pass
 
-cognito_user_pool = cfn_stack_outputs.get('CognitoUserPool', None)
-cognito_user_pool_group = cfn_stack_outputs.get('CognitoUserPoolGroup', None)
-cognito_user_pool_group = cfn_stack_outputs.get('CognitoClientID', None)
-step_functions_active_learning = cfn_stack_outputs.get('StepFunctionsActiveLearningPipeline', None)
+def cached(name, resolve):
+    cache = read_config_cache()
+    if name in cache:
+        return cache[name]
+    value = resolve()
+    write_config_cache(name, value)
+    return value
+
+
+# Values which need AWS calls are only resolved when first read. The region comes from the
+# local boto3 configuration, the others are memoized in config_cache_filepath.
+RESOLVERS = {
+    'region': get_region,
+    'account_id': lambda: cached('account_id', get_account_id),
+    'default_bucket': lambda: cached('default_bucket', get_default_bucket),
+    'default_role': lambda: cached('default_role', get_default_role),
+}
+
+# attribute: (stack output key, fallback used when the stack outputs do not have it)
+STACK_OUTPUTS = {
+    'aws_account': ('AccountID', lambda: __getattr__('account_id')),
+    'region_name': ('AWSRegion', lambda: __getattr__('region')),
+    'solution_name': ('SolutionName', lambda: 'Visual-perception-with-active-learning'),
+    'solution_upstream_bucket': ('SolutionUpstreamS3Bucket',
+                                 lambda: 'sagemaker-solutions-{}'.format(__getattr__('region'))),
+    'solution_prefix': ('SolutionPrefix', lambda: 'sagemaker-soln-entity-res'),
+    'solution_bucket': ('SolutionS3Bucket', lambda: __getattr__('default_bucket')),
+    's3_data_prefix': ('S3InputDataPrefix', lambda: 'raw-data'),
+    'cognito_user_pool': ('CognitoUserPool', lambda: None),
+    'cognito_user_pool_group': ('CognitoUserPoolGroup', lambda: None),
+    'cognito_clientId': ('CognitoClientID', lambda: None),
+    'step_functions_active_learning': ('StepFunctionsActiveLearningPipeline', lambda: None),
+    'role': ('IamRole', lambda: __getattr__('default_role')),
+}
+
+_resolved = {}
+
+
+def __getattr__(name):
+    if name in _resolved:
+        return _resolved[name]
+    if name in STACK_OUTPUTS:
+        key, fallback = STACK_OUTPUTS[name]
+        value = cfn_stack_outputs[key] if key in cfn_stack_outputs else fallback()
+    elif name in RESOLVERS:
+        value = RESOLVERS[name]()
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    _resolved[name] = value
+    return value
 
-role = cfn_stack_outputs.get('IamRole', default_role)
\ No newline at end of file
+def __dir__():
+    return sorted(set(globals()) | set(RESOLVERS) | set(STACK_OUTPUTS))
@@ -1,5 +1,10 @@
+import copy
 import json
-from io import BytesIO, TextIOWrapper
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
 from parse import parse
 import boto3
 import numpy as np
@@ -9,23 +14,283 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 import pylab
 pylab.rcParams['figure.figsize'] = (8.0, 10.0)
-from PIL import Image
+from PIL import Image, ImageDraw
+
+PREFETCH_WORKERS = 16
+IMAGE_HEADER_BYTES = 64 * 1024
+THUMBNAIL_SIZE = 256
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_ROWS = 4
+PREDICTION_COLOR = (255, 0, 0)
+GROUND_TRUTH_COLOR = (0, 0, 255)
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    # boto3 clients are thread safe, one is shared by every download.
+    return boto3.client('s3')
+
+
+MISSING = object()
+
+SQL_OPERATORS = {
+    '==': '=',
+    '!=': '!=',
+    '<': '<',
+    '<=': '<=',
+    '>': '>',
+    '>=': '>=',
+}
+
+LOCAL_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+}
+
+
+def parse_field(field):
+    return tuple(field.split(".")) if isinstance(field, str) else tuple(field)
+
+
+def lookup(row, path):
+    value = row
+    for name in path:
+        if not isinstance(value, dict) or name not in value:
+            return MISSING
+        value = value[name]
+    return value
+
+
+def sql_literal(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    raise ValueError("Can not use {!r} in an S3 Select expression".format(value))
+
+
+def sql_path(path):
+    return "s." + ".".join('"{}"'.format(name) for name in path)
+
+
+class Condition:
+    """
+    A comparison of a manifest field with a value, evaluated by S3 Select when the manifest is
+    on S3 and locally otherwise. As in S3 Select, a comparison with a missing field is false.
+    """
+
+    def __init__(self, field, operator, value=None):
+        if operator not in LOCAL_OPERATORS and operator not in ('is missing', 'is not missing'):
+            raise ValueError("Unsupported operator {}".format(operator))
+        self.path = parse_field(field)
+        self.operator = operator
+        self.value = value
+
+    def sql(self):
+        if self.operator in ('is missing', 'is not missing'):
+            return "{} {}".format(sql_path(self.path), self.operator)
+        if self.operator in ('in', 'not in'):
+            expression = "{} in ({})".format(sql_path(self.path), ", ".join(sql_literal(v) for v in self.value))
+            return expression if self.operator == 'in' else "not ({})".format(expression)
+        return "{} {} {}".format(sql_path(self.path), SQL_OPERATORS[self.operator], sql_literal(self.value))
+
+    def matches(self, row):
+        value = lookup(row, self.path)
+        if self.operator == 'is missing':
+            return value is MISSING
+        if self.operator == 'is not missing':
+            return value is not MISSING
+        if value is MISSING or value is None:
+            return False
+        try:
+            return LOCAL_OPERATORS[self.operator](value, self.value)
+        except TypeError:
+            return False
+
+
+def project(row, paths):
+    projected = {}
+    for path in paths:
+        value = lookup(row, path)
+        if value is MISSING:
+            continue
+        target = projected
+        for name in path[:-1]:
+            target = target.setdefault(name, {})
+        target[path[-1]] = value
+    return projected
+
+
+def iter_select_lines(response):
+    """
+    Split the record events of a select_object_content response into lines, records may
+    span events.
+    """
+    pending = b""
+    for event in response['Payload']:
+        if 'Records' in event:
+            pending += event['Records']['Payload']
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+    if pending.strip():
+        yield pending
+
+
+class ManifestDataset:
+    """
+    A lazy view of a local or S3 manifest. Operations return a new dataset and nothing is read
+    until it is iterated, one row at a time:
+
+        dataset = ManifestDataset("s3://bucket/output.manifest")
+        auto = dataset.where("label-metadata.human-annotated", "==", "no").select("source-ref", "label")
+        auto.count()
+        auto.has_class(0).sample(0.1, seed=0).head(20)
+
+    Conditions are combined with AND. On S3 they run in S3 Select along with the projection of
+    the top level fields, so only matching rows and requested fields are transferred; local
+    manifests are scanned as a stream. Python predicates (filter, has_class) and sampling always
+    run locally, limit applies last.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.conditions = []
+        self.predicates = []
+        self.columns = None
+        self.fraction = None
+        self.seed = None
+        self.max_rows = None
+
+    def _derive(self, **changes):
+        dataset = copy.copy(self)
+        dataset.conditions = list(self.conditions)
+        dataset.predicates = list(self.predicates)
+        for name, value in changes.items():
+            setattr(dataset, name, value)
+        return dataset
+
+    def where(self, field, operator, value=None):
+        """
+        Keep rows where the field, e.g. "label-metadata.human-annotated", compares to value with
+        one of ==, !=, <, <=, >, >=, in, not in, or is missing / is not missing.
+        """
+        dataset = self._derive()
+        dataset.conditions.append(Condition(field, operator, value))
+        return dataset
+
+    def filter(self, predicate):
+        dataset = self._derive()
+        dataset.predicates.append(predicate)
+        return dataset
+
+    def has_class(self, class_id, attribute_name="label"):
+        def predicate(row):
+            annotations = row.get(attribute_name, {}).get('annotations', [])
+            return any(int(annotation['class_id']) == class_id for annotation in annotations)
+        return self.filter(predicate)
+
+    def select(self, *fields):
+        return self._derive(columns=[parse_field(field) for field in fields])
+
+    def sample(self, fraction, seed=None):
+        return self._derive(fraction=fraction, seed=seed)
+
+    def limit(self, n):
+        return self._derive(max_rows=n if self.max_rows is None else min(n, self.max_rows))
+
+    def head(self, n=5):
+        return self.limit(n).to_list()
+
+    def to_list(self):
+        return list(self)
+
+    def count(self):
+        if self._is_s3() and not self.predicates and self.fraction is None:
+            line = next(self._select("select count(*) from s3object[*] s" + self._where_clause()))
+            count = json.loads(line)['_1']
+            return count if self.max_rows is None else min(count, self.max_rows)
+        return sum(1 for _ in self)
+
+    def _is_s3(self):
+        return "s3://" in self.manifest_path
+
+    def _where_clause(self):
+        if not self.conditions:
+            return ""
+        return " where " + " and ".join(condition.sql() for condition in self.conditions)
+
+    def _select(self, expression):
+        bucket, key = parse("s3://{}/{}", self.manifest_path)
+        return iter_select_lines(get_s3_client().select_object_content(
+            Bucket=bucket, Key=key, ExpressionType='SQL', Expression=expression,
+            InputSerialization={'JSON': {'Type': 'LINES'}}, OutputSerialization={'JSON': {}}))
+
+    def _scan(self):
+        """
+        Yield the rows, and whether the conditions were already applied.
+        """
+        if self._is_s3() and (self.conditions or self.columns):
+            # Predicates may read any field, the projection is only pushed down without them.
+            if self.columns and not self.predicates:
+                projection = ", ".join(sql_path(field) for field in sorted({path[:1] for path in self.columns}))
+            else:
+                projection = "*"
+            expression = "select {} from s3object[*] s{}".format(projection, self._where_clause())
+            if self.max_rows is not None and not self.predicates and self.fraction is None:
+                expression += " limit {}".format(self.max_rows)
+            return (json.loads(line) for line in self._select(expression)), True
+        return self._stream_lines(), False
+
+    def _stream_lines(self):
+        if self._is_s3():
+            bucket, key = parse("s3://{}/{}", self.manifest_path)
+            body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body']
+            try:
+                for line in body.iter_lines():
+                    if line.strip():
+                        yield json.loads(line)
+            finally:
+                body.close()
+        else:
+            with open(self.manifest_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def __iter__(self):
+        if self.max_rows == 0:
+            return
+        rows, conditions_applied = self._scan()
+        conditions = [] if conditions_applied else self.conditions
+        rng = random.Random(self.seed) if self.fraction is not None else None
+        returned = 0
+        for row in rows:
+            if not all(condition.matches(row) for condition in conditions):
+                continue
+            if not all(predicate(row) for predicate in self.predicates):
+                continue
+            if rng is not None and rng.random() >= self.fraction:
+                continue
+            yield project(row, self.columns) if self.columns else row
+            returned += 1
+            if self.max_rows is not None and returned >= self.max_rows:
+                return
 
 
 def get_manifest_rows_from_path(manifest_path):
-    if "s3://" in manifest_path:
-        s3 = boto3.client('s3')
-        bucket, key = parse("s3://{}/{}", manifest_path)
-        bytestream = BytesIO()
-        s3.download_fileobj(bucket, key, bytestream)
-        bytestream.seek(0)
-        manifest_stringio = TextIOWrapper(bytestream, encoding='utf-8')
-        manifest_lines = manifest_stringio.readlines()
-    else:
-        with open(manifest_path, "r") as f:
-            manifest_lines = f.readlines()
-    manifest_rows = [json.loads(s) for s in manifest_lines]
-    return manifest_rows
+    return ManifestDataset(manifest_path).to_list()
 
 
 def dump_manifest_rows(manifest_rows, manifest_path):
@@ -35,51 +300,143 @@ def dump_manifest_rows(manifest_rows, manifest_path):
             f.write(manifest_row_json)
             f.write("\n")
 
-def read_image(image_path):
+def read_image_bytes(image_path):
     if "s3://" in image_path:
-        s3 = boto3.client('s3')
         bucket, key = parse("s3://{}/{}", image_path)
         bytestream = BytesIO()
-        s3.download_fileobj(bucket, key, bytestream)
+        get_s3_client().download_fileobj(bucket, key, bytestream)
         bytestream.seek(0)
     else:
         with open(image_path, "rb") as f:
-            bytestream = f.read()
-    image = np.array(Image.open(bytestream))
+            bytestream = BytesIO(f.read())
+    return bytestream
+
+def read_image(image_path):
+    image = np.array(Image.open(read_image_bytes(image_path)))
     return image
 
-def visualize_manifest_images(manifest_path, max_images=10, verbose=False):
-    manifest_rows = get_manifest_rows_from_path(manifest_path)
+def read_image_size(image_path, header_bytes=IMAGE_HEADER_BYTES):
+    """
+    Return the width, height and depth of an image from its header. Only the first
+    header_bytes are fetched from S3, the whole image is read when they do not hold the header.
+    """
+    if "s3://" in image_path:
+        bucket, key = parse("s3://{}/{}", image_path)
+        response = get_s3_client().get_object(Bucket=bucket, Key=key, Range="bytes=0-{}".format(header_bytes - 1))
+        try:
+            image = Image.open(BytesIO(response['Body'].read()))
+        except (IOError, SyntaxError):
+            image = Image.open(read_image_bytes(image_path))
+    else:
+        # Image.open only parses the header of a local file.
+        image = Image.open(image_path)
+    width, height = image.size
+    return width, height, len(image.getbands())
+
+def load_thumbnail(image_path, max_size=THUMBNAIL_SIZE):
+    """
+    Decode an image to at most max_size x max_size pixels. JPEGs are decoded at reduced
+    size by the DCT scaling of draft mode instead of being decoded in full and resized.
+    Returns the RGB thumbnail and its scale relative to the original image.
+    """
+    image = Image.open(read_image_bytes(image_path))
+    original_width = image.size[0]
+    image.draft('RGB', (max_size, max_size))
+    image = image.convert('RGB')
+    image.thumbnail((max_size, max_size))
+    return image, image.size[0] / float(original_width)
 
-    for i, manifest_row in enumerate(manifest_rows):
-        if i == max_images:
-            return
-        source_ref = manifest_row["source-ref"]
+def prefetch_thumbnails(image_paths, max_size=THUMBNAIL_SIZE, max_workers=PREFETCH_WORKERS):
+    """
+    Download and decode images over a thread pool, yielding (thumbnail, scale) in the order
+    of image_paths. At most 2 * max_workers images are in flight or waiting to be consumed.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for image_path in image_paths:
+            pending.append(executor.submit(load_thumbnail, image_path, max_size))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-        image = read_image(source_ref)
-        plt.figure()
-        ax = plt.subplot()
-        ax.axis("off")
-        ax.imshow(image)
-        annotations = manifest_row['label']['annotations'] if 'label' in manifest_row else []
-        for annotation in annotations:
-            top = int(annotation['top'])
-            left = int(annotation['left'])
-            width = int(annotation['width'])
-            height = int(annotation['height'])
-            if verbose:
-                print(top, left, width, height)
-            rect = Rectangle((left, top), width, height, edgecolor='r', linewidth=3, fill=False)
-            ax.add_patch(rect)
-        groundtruth = manifest_row['true-labels']['annotations'] if 'true-labels' in manifest_row else []
-        for annotation in groundtruth:
+def get_annotations(manifest_row, attribute_name):
+    return manifest_row[attribute_name]['annotations'] if attribute_name in manifest_row else []
+
+def draw_boxes(draw, annotations, scale, offset, color, verbose=False):
+    for annotation in annotations:
+        top = int(annotation['top'])
+        left = int(annotation['left'])
+        width = int(annotation['width'])
+        height = int(annotation['height'])
+        if verbose:
+            print(top, left, width, height)
+        x0 = offset[0] + left * scale
+        y0 = offset[1] + top * scale
+        draw.rectangle([x0, y0, x0 + width * scale, y0 + height * scale], outline=color, width=2)
+
+def render_contact_sheet(manifest_rows, thumbnails, columns=CONTACT_SHEET_COLUMNS, cell_size=THUMBNAIL_SIZE,
+                         verbose=False):
+    """
+    Paste thumbnails into a grid and draw the predicted ('label', red) and ground truth
+    ('true-labels', blue) boxes of each row onto its cell.
+    """
+    rows = (len(manifest_rows) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * cell_size, rows * cell_size), BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(sheet)
+    for i, (manifest_row, (thumbnail, scale)) in enumerate(zip(manifest_rows, thumbnails)):
+        offset = ((i % columns) * cell_size, (i // columns) * cell_size)
+        sheet.paste(thumbnail, offset)
+        draw_boxes(draw, get_annotations(manifest_row, 'label'), scale, offset, PREDICTION_COLOR, verbose)
+        draw_boxes(draw, get_annotations(manifest_row, 'true-labels'), scale, offset, GROUND_TRUTH_COLOR, verbose)
+    return sheet
+
+def show_image(manifest_row, image, verbose=False):
+    plt.figure()
+    ax = plt.subplot()
+    ax.axis("off")
+    ax.imshow(image)
+    for attribute_name, color in (('label', 'r'), ('true-labels', 'b')):
+        for annotation in get_annotations(manifest_row, attribute_name):
             top = int(annotation['top'])
             left = int(annotation['left'])
             width = int(annotation['width'])
             height = int(annotation['height'])
             if verbose:
                 print(top, left, width, height)
-            rect = Rectangle((left, top), width, height, edgecolor='b', linewidth=3, fill=False)
+            rect = Rectangle((left, top), width, height, edgecolor=color, linewidth=3, fill=False)
             ax.add_patch(rect)
-        print("Showing image for {}".format(manifest_row['source-ref']))
-        plt.show()
\ No newline at end of file
+    print("Showing image for {}".format(manifest_row['source-ref']))
+    plt.show()
+
+def visualize_manifest_images(manifest_path, max_images=10, verbose=False, contact_sheet=True,
+                              columns=CONTACT_SHEET_COLUMNS, thumbnail_size=THUMBNAIL_SIZE):
+    """
+    Show the images of a manifest, or of a ManifestDataset, with their predicted (red) and
+    ground truth (blue) boxes. Only the first max_images rows are read.
+    Images are prefetched over a thread pool. By default they are drawn as thumbnails on
+    contact sheets of columns x CONTACT_SHEET_ROWS images, set contact_sheet=False to show
+    each image at full resolution in its own figure.
+    """
+    dataset = manifest_path if isinstance(manifest_path, ManifestDataset) else ManifestDataset(manifest_path)
+    manifest_rows = dataset.head(max_images)
+    source_refs = [manifest_row["source-ref"] for manifest_row in manifest_rows]
+    if not contact_sheet:
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+            for manifest_row, image in zip(manifest_rows, executor.map(read_image, source_refs)):
+                show_image(manifest_row, image, verbose)
+        return
+
+    thumbnails = prefetch_thumbnails(source_refs, thumbnail_size)
+    sheet_size = columns * CONTACT_SHEET_ROWS
+    for start in range(0, len(manifest_rows), sheet_size):
+        sheet_rows = manifest_rows[start:start + sheet_size]
+        sheet = render_contact_sheet(sheet_rows, thumbnails, columns, thumbnail_size, verbose)
+        print("Showing images {} to {}, left to right and top to bottom:".format(start, start + len(sheet_rows) - 1))
+        for manifest_row in sheet_rows:
+            print("  {}".format(manifest_row['source-ref']))
+        plt.figure(figsize=(2.5 * columns, 2.5 * sheet.size[1] / float(thumbnail_size)))
+        ax = plt.subplot()
+        ax.axis("off")
+        ax.imshow(np.asarray(sheet))
+        plt.show()